@@ -1,8 +1,16 @@
-import requests
+import argparse
 import json
+import logging
+import os
+import requests
+
+from util.catalogue import CompactRecords, load_catalogue
+from util.ingest import NDJSONWriter, ingest, pooled_session, read_ndjson
+
+COMPLETION_URL = 'http://localhost:8080/completion'
 
-def get_llm_annotations(movie):
-    url = 'http://localhost:8080/completion'
+def get_llm_annotations(movie, session=requests):
+    url = COMPLETION_URL
     headers = {'Content-Type': 'application/json'}
     
     system_prompt = (
@@ -28,41 +36,100 @@ def get_llm_annotations(movie):
         "temperature": 0.20,
     }
     
-    response = requests.post(url, headers=headers, json=data)
+    response = session.post(url, headers=headers, json=data)
     if response.status_code == 200:
-        print(f"Successfully annotated movie '{movie['title']}'")
-        annotations = response.json().get("content", "")
-        print(f"Annotations: {annotations}")
-        return annotations
+        logging.info(f"Successfully annotated movie '{movie['title']}'")
+        return response.json().get("content", "")
     else:
-        print(f"Error annotating movie '{movie['title']}': {response.status_code}, {response.text}")
+        logging.error(f"Error annotating movie '{movie['title']}': {response.status_code}, {response.text}")
         return None
-def process_movies(file_path):
+def load_movies(file_path):
+    """The catalogue from a JSON array or an NDJSON file; compact records if it is large."""
+    return load_catalogue(file_path)
+
+def unannotated_rows(movies, done):
+    """Row of each movie id without annotations and not in `done`; compact records answer from their columns."""
+    if isinstance(movies, CompactRecords):
+        ids = [None if movie_id == -1 else movie_id for movie_id in movies.ids.tolist()]  # -1: no id
+        annotated = movies.has('annotations').tolist()
+    else:
+        ids, annotated = [movie.get('id') for movie in movies], ['annotations' in movie for movie in movies]
+    return {movie_id: row for row, (movie_id, has) in enumerate(zip(ids, annotated))
+            if not has and movie_id is not None and movie_id not in done}
+
+def write_annotated(movies, journal_path, output_path):
+    """
+    Merge the journaled annotations into the catalogue and write it in one atomic replace.
+
+    Movies are materialized and written one at a time, so the output never exists as one big list.
+    """
+    annotations = {entry['id']: entry['annotations'] for entry in read_ndjson(journal_path)}
+    annotated = 0
+    tmp_path = f"{output_path}.tmp"
+    with open(tmp_path, 'w') as file:
+        file.write("[")
+        for i, movie in enumerate(movies):
+            if movie.get('id') in annotations:
+                movie['annotations'] = annotations[movie['id']]
+            annotated += 'annotations' in movie
+            file.write(",\n  " if i else "\n  ")
+            file.write(json.dumps(movie, indent=2).replace("\n", "\n  "))
+        file.write("\n]" if len(movies) else "]")
+    os.replace(tmp_path, output_path)
+    return annotated
+
+def process_movies(file_path, journal_path="movie_annotations.ndjson", output_path="movie_annotations.json", workers=4):
+    """
+    Annotate every movie without annotations, `workers` LLM requests at a time.
+
+    Each annotation is appended to the NDJSON journal as soon as it arrives, and ids already
+    in the journal are skipped, so an interrupted run resumes where it stopped.
+    """
     try:
-        with open(file_path, 'r') as file:
-            movies = json.load(file)
+        movies = load_movies(file_path)
     except FileNotFoundError:
         print(f"File not found: {file_path}")
         return
 
-    total_movies = len(movies)
-    for index, movie in enumerate(movies, start=1):
-        if 'annotations' in movie:
-            print(f"Movie '{movie['title']}' already annotated. [{index}/{total_movies}]")
-            continue
+    done = {entry['id'] for entry in read_ndjson(journal_path)}
+    # Rows rather than movies: a compact catalogue builds each movie's dict only when it is annotated
+    rows = unannotated_rows(movies, done)
+    logging.info(f"{len(movies) - len(rows)} of {len(movies)} movies already annotated; annotating {len(rows)}")
+
+    session = pooled_session(workers)
+
+    def annotate(movie_id):
+        movie = movies[rows[movie_id]]
+        annotations = get_llm_annotations(movie, session)
+        if not annotations:
+            raise ValueError(f"No annotations for movie '{movie['title']}'")
+        return [{'id': movie_id, 'annotations': annotations}]
+
+    journal = NDJSONWriter(journal_path)
+    try:
+        ingest(list(rows), annotate, journal, workers=workers, log_every=10, total=len(rows))
+    finally:
+        journal.close()
 
-        print(f"Processing movie '{movie['title']}'... [{index}/{total_movies}]")
-        annotations = get_llm_annotations(movie)
-        if annotations:
-            movie['annotations'] = annotations
+    annotated = write_annotated(movies, journal_path, output_path)
+    print(f"Saved {annotated}/{len(movies)} annotated movies to {output_path}")
 
-    # Save all annotations at the end
-    with open("movie_annotations.json", 'w') as file:
-        json.dump(movies, file, indent=2)
-    print("All movies processed and saved.")
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Annotate movies with the LLM, resuming from the journal after a crash")
+    parser.add_argument("--input", default="assets/all_movies.json", help="Movie catalogue (.json or .ndjson)")
+    parser.add_argument("--journal", default="movie_annotations.ndjson", help="NDJSON journal of finished annotations")
+    parser.add_argument("--output", default="movie_annotations.json", help="Annotated catalogue written at the end")
+    parser.add_argument("--workers", type=int, default=4, help="LLM requests in flight (match the server's parallel slots)")
+    parser.add_argument("--update_db", nargs="?", const="assets/movies_db", metavar="DB",
+                        help="Then refresh this DB from the annotated catalogue, embedding only new or changed movies")
+    parsed = parser.parse_args(args)
 
-# Path to your movies JSON file
-file_path = 'assets/all_movies.json'
+    process_movies(parsed.input, parsed.journal, parsed.output, parsed.workers)
+    if parsed.update_db and os.path.exists(parsed.output):
+        # Imported here so annotating alone doesn't load the server module
+        from vector_db_flask import update_db
+        update_db(parsed.output, parsed.update_db)
 
-# Process and annotate movies
-process_movies(file_path)
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
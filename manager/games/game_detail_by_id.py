@@ -1,35 +1,58 @@
-import requests
+import argparse
 import json
-import time
-from dotenv import load_dotenv
+import logging
 import os
+from dotenv import load_dotenv
+
+from util.ingest import Checkpoint, NDJSONWriter, TokenBucket, clear_run, compact, ingest, pooled_session
 
 # Load environment variables from .env file
 load_dotenv()
 
-def fetch_game_details(appid, api_key):
-    url = f"https://api.steampowered.com/ISteamUserStats/GetSchemaForGame/v2/?key={api_key}&appid={appid}"
-    response = requests.get(url)
+STEAM_API_URL = os.getenv("STEAM_API_URL", "https://api.steampowered.com")
+REQUESTS_PER_SECOND = 1.1  # the Steam Web API allows 100,000 calls per day
+NOT_FOUND_STATUSES = (404, 410)
+
+def fetch_game_details(session, appid, api_key):
+    url = f"{STEAM_API_URL}/ISteamUserStats/GetSchemaForGame/v2/"
+    response = session.get(url, params={"key": api_key, "appid": appid}, timeout=(5, 30))
     if response.status_code == 200:
-        return response.json()
-    else:
-        return None
+        return [{"appid": appid, **response.json()}]
+    if response.status_code in NOT_FOUND_STATUSES:
+        return []  # the app has no schema; don't ask again
+    # Still throttled or failing after retries, or the key was refused; leave it for the next run
+    response.raise_for_status()
+    return []
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Fetch Steam game schemas for every app id, resuming after a crash")
+    parser.add_argument("--app_list", default="assets/steam_games.json", help="Output of fetch_all_games.sh")
+    parser.add_argument("--output", default="assets/games_details.json", help="Details JSON written at the end")
+    parser.add_argument("--workers", type=int, default=4, help="Concurrent requests")
+    parser.add_argument("--rate", type=float, default=REQUESTS_PER_SECOND, help="Requests per second across all workers")
+    parsed = parser.parse_args(args)
 
-def main():
     api_key = os.getenv('STEAM_API_KEY')
-    with open('steam_games.json', 'r') as file:
+    with open(parsed.app_list, 'r') as file:
         data = json.load(file)
+    appids = [game['appid'] for game in data['applist']['apps']]
 
-    games_details = []
-    for game in data['applist']['apps']:
-        appid = game['appid']
-        details = fetch_game_details(appid, api_key)
-        if details:
-            games_details.append(details)
-        time.sleep(1)  # To respect rate limits
+    # Records stream to <output>.ndjson and finished app ids to <output>.appids, so a rerun picks up where this one stopped.
+    # Both are cleared once every app id is in the details file, so the next scheduled run fetches it afresh.
+    base = os.path.splitext(parsed.output)[0]
+    session = pooled_session(parsed.workers)
+    output = NDJSONWriter(f"{base}.ndjson")
+    try:
+        stats = ingest(appids, lambda appid: fetch_game_details(session, appid, api_key), output,
+                       Checkpoint(f"{base}.appids"), TokenBucket(parsed.rate), workers=parsed.workers)
+    finally:
+        output.close()
 
-    with open('assets/games_details.json', 'w') as outfile:
-        json.dump(games_details, outfile)
+    count = compact(f"{base}.ndjson", parsed.output, key='appid')
+    if not stats["failed"]:
+        clear_run(f"{base}.ndjson", f"{base}.appids")
+    print(f"Wrote details for {count} games to {parsed.output}")
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
     main()
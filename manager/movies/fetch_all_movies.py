@@ -1,42 +1,55 @@
-import requests
-import json
+import argparse
+import logging
 import os
 from dotenv import load_dotenv
 
+from util.ingest import Checkpoint, NDJSONWriter, TokenBucket, clear_run, compact, ingest, pooled_session
+
 # Load environment variables from .env file
 load_dotenv()
 
-def fetch_movies(api_key, page=1):
-    url = f"https://api.themoviedb.org/3/discover/movie?sort_by=popularity.desc&page={page}"
-
-    headers = {
-        "accept": "application/json",
-        "Authorization": f"Bearer {api_key}"
-    }
+TMDB_API_URL = os.getenv("TMDB_API_URL", "https://api.themoviedb.org/3")
+MAX_PAGES = 500  # discover serves at most 500 pages
+REQUESTS_PER_SECOND = 40  # TMDB allows roughly 50 requests/s per IP
 
-    response = requests.get(url, headers=headers)
+def fetch_movies(session, page=1):
+    url = f"{TMDB_API_URL}/discover/movie"
+    response = session.get(url, params={"sort_by": "popularity.desc", "page": page}, timeout=(5, 30))
+    response.raise_for_status()
+    return response.json()
 
-    if response.status_code == 200:
-        return response.json()['results']
-    else:
-        print(f"Error fetching page {page}: {response.status_code} - {response.reason}")
-        return []
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Fetch TMDB discover pages into a movie catalogue, resuming after a crash")
+    parser.add_argument("--output", default="assets/all_movies.json", help="Catalogue JSON written at the end")
+    parser.add_argument("--pages", type=int, default=MAX_PAGES, help="Most discover pages to fetch")
+    parser.add_argument("--workers", type=int, default=8, help="Concurrent requests")
+    parser.add_argument("--rate", type=float, default=REQUESTS_PER_SECOND, help="Requests per second across all workers")
+    parsed = parser.parse_args(args)
 
-def main():
     api_key = os.getenv('TMDB_API_KEY')
-    unique_movies = {}
-
-    # Fetch movies - Example: Loop through first 10000 pages
-    for page in range(1, 10000):
-        movies = fetch_movies(api_key, page)
-        if not movies:
-            break
-        for movie in movies:
-            unique_movies[movie['id']] = movie
-        print(f"Fetched page {page}, Total unique movies: {len(unique_movies)}")
-
-    with open('assets/all_movies.json', 'w') as file:
-        json.dump(list(unique_movies.values()), file, indent=4)
+    session = pooled_session(parsed.workers, headers={
+        "accept": "application/json",
+        "Authorization": f"Bearer {api_key}"
+    })
+
+    # Records stream to <output>.ndjson and finished pages to <output>.pages, so a rerun picks up where this one stopped.
+    # Both are cleared once every page is in the catalogue, so the next scheduled run fetches it afresh.
+    base = os.path.splitext(parsed.output)[0]
+    total_pages = min(fetch_movies(session, 1)['total_pages'], parsed.pages)
+    logging.info(f"Fetching {total_pages} discover pages")
+
+    output = NDJSONWriter(f"{base}.ndjson")
+    try:
+        stats = ingest(range(1, total_pages + 1), lambda page: fetch_movies(session, page)['results'], output,
+                       Checkpoint(f"{base}.pages"), TokenBucket(parsed.rate), workers=parsed.workers)
+    finally:
+        output.close()
+
+    count = compact(f"{base}.ndjson", parsed.output, key='id')
+    if not stats["failed"]:
+        clear_run(f"{base}.ndjson", f"{base}.pages")
+    print(f"Wrote {count} unique movies to {parsed.output}")
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
     main()
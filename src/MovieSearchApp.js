@@ -94,6 +94,35 @@ const theme = createTheme({
 
 const API_URL = "http://127.0.0.1:8081/";
 
+// Calls onEvent(event, data) for each server-sent event of a fetch response
+const readEventStream = async (response, onEvent) => {
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+
+  const dispatch = (frame) => {
+    let event = "message";
+    const data = [];
+    for (const line of frame.split("\n")) {
+      if (line.startsWith("event: ")) event = line.slice(7);
+      else if (line.startsWith("data: ")) data.push(line.slice(6));
+    }
+    if (data.length) onEvent(event, JSON.parse(data.join("\n")));
+  };
+
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) break;
+
+    buffer += decoder.decode(value, { stream: true });
+    const frames = buffer.split("\n\n");
+    buffer = frames.pop(); // Save incomplete part for the next loop
+    frames.filter((frame) => frame.trim()).forEach(dispatch);
+  }
+  if (buffer.trim()) dispatch(buffer);
+  reader.releaseLock();
+};
+
 const MovieSearchApp = () => {
   const [query, setQuery] = useState("");
   const [results, setResults] = useState([]);
@@ -144,11 +173,11 @@ const MovieSearchApp = () => {
       updateLog("Standardized Query: ", true);
       updateLog(standardized);
 
-      const response = await fetch(`${API_URL}/search`, {
+      const response = await fetch(`${API_URL}/search/stream`, {
         method: "POST",
         headers: {
           "Content-Type": "application/json",
-          Accept: "application/json",
+          Accept: "text/event-stream",
         },
         body: JSON.stringify({ query: standardized }),
       });
@@ -160,8 +189,19 @@ const MovieSearchApp = () => {
         );
       }
 
-      const movies = await response.json();
-      setResults(movies);
+      // The first movies arrive as soon as they are ranked; the rest follow in batches
+      await readEventStream(response, (event, data) => {
+        if (event === "results") {
+          setResults((prevResults) => [...prevResults, ...data.results]);
+          setIsLoading(false);
+        } else if (event === "reorder") {
+          setResults((prevResults) => data.order.map((i) => prevResults[i]));
+        } else if (event === "done") {
+          updateLog(`Found ${data.count} movies in ${data.total_ms} ms`);
+        } else if (event === "error") {
+          throw new Error(data.error);
+        }
+      });
     } catch (error) {
       console.error("Fetch error:", error);
       updateLog(`Error: ${error.message}`, true);
@@ -181,79 +221,37 @@ const MovieSearchApp = () => {
     setCurrentMessage("");
 
     try {
+      // rag: the server retrieves movies for the latest message and passes them to the chat model
       const response = await fetch(`${API_URL}/chat`, {
         method: "POST",
         headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({ messages: newMessages }),
+        body: JSON.stringify({ messages: newMessages, rag: true }),
       });
 
       if (!response.ok) {
         throw new Error(`HTTP error! Status: ${response.status}`);
       }
 
-      const reader = response.body.getReader();
-      const decoder = new TextDecoder();
-      let buffer = "";
-
-      while (true) {
-        const { done, value } = await reader.read();
-        if (done) break;
-
-        buffer += decoder.decode(value, { stream: true });
-
-        const parts = buffer.split("\n\n");
-        buffer = parts.pop(); // Save incomplete part for the next loop
-
-        for (const part of parts) {
-          if (part.trim()) {
-            try {
-              const data = JSON.parse(part.replace("data: ", ""));
-              const content = data.message.content;
-
-              setChatMessages((prevMessages) => {
-                const lastMessage = prevMessages[prevMessages.length - 1];
-                if (lastMessage && lastMessage.role === "assistant") {
-                  // Append to the last message if it is from the assistant
-                  lastMessage.content += content;
-                  return [...prevMessages];
-                } else {
-                  // Create a new message if the last one is not from the assistant
-                  return [
-                    ...prevMessages,
-                    { role: "assistant", content: content },
-                  ];
-                }
-              });
-            } catch (e) {
-              console.error("Error parsing JSON:", e);
-            }
-          }
-        }
-      }
-
-      // Process any remaining buffer after the loop
-      if (buffer.trim()) {
-        try {
-          const data = JSON.parse(buffer.replace("data: ", ""));
-          const content = data.message.content;
-
-          setChatMessages((prevMessages) => {
-            const lastMessage = prevMessages[prevMessages.length - 1];
-            if (lastMessage && lastMessage.role === "assistant") {
-              // Append to the last message if it is from the assistant
-              lastMessage.content += content;
-              return [...prevMessages];
-            } else {
-              // Create a new message if the last one is not from the assistant
-              return [...prevMessages, { role: "assistant", content: content }];
-            }
-          });
-        } catch (e) {
-          console.error("Error parsing JSON:", e);
+      await readEventStream(response, (event, data) => {
+        if (event === "movies") {
+          updateLog("Chat context: ", true);
+          updateLog(data.map((movie) => movie.title).join(", "));
+          return;
         }
-      }
-
-      reader.releaseLock();
+        const content = data.message.content;
+
+        setChatMessages((prevMessages) => {
+          const lastMessage = prevMessages[prevMessages.length - 1];
+          if (lastMessage && lastMessage.role === "assistant") {
+            // Append to the last message if it is from the assistant
+            lastMessage.content += content;
+            return [...prevMessages];
+          } else {
+            // Create a new message if the last one is not from the assistant
+            return [...prevMessages, { role: "assistant", content: content }];
+          }
+        });
+      });
     } catch (error) {
       console.error("Chat error:", error);
       updateLog(`Chat Error: ${error.message}`, true);
@@ -0,0 +1,55 @@
+import json
+
+import pytest
+
+from util import catalogue
+from util.catalogue import CompactRecords, load_catalogue
+
+MOVIES = [
+    {"adult": False, "genre_ids": [18, 80], "id": 1, "overview": "A heist été", "popularity": 12.5,
+     "release_date": "1999-03-01", "title": "One", "vote_average": 7.1, "vote_count": 10},
+    {"id": 2, "title": "Two", "popularity": None, "annotations": "- Theme: loss"},
+    {"title": "No id", "extra": {"nested": [1, 2]}},
+    {"id": 4, "title": "Four", "genre_ids": [], "vote_count": 2 ** 70},
+]
+
+
+def write(tmp_path, movies, ndjson=False, indent=4):
+    path = tmp_path / ("movies.ndjson" if ndjson else "movies.json")
+    with open(path, "w", encoding="utf-8") as f:
+        if ndjson:
+            f.writelines(json.dumps(movie) + "\n" for movie in movies)
+        else:
+            json.dump(movies, f, indent=indent)
+    return str(path)
+
+
+@pytest.mark.parametrize("ndjson", [False, True])
+def test_small_catalogue_loads_as_dicts(tmp_path, ndjson):
+    records = load_catalogue(write(tmp_path, MOVIES, ndjson))
+    assert isinstance(records, list)
+    assert records == MOVIES
+
+
+@pytest.mark.parametrize("ndjson", [False, True])
+@pytest.mark.parametrize("workers", [1, 2])
+def test_compact_records_round_trip_across_pieces(tmp_path, ndjson, workers):
+    movies = [dict(movie, id=i) if "id" in movie else movie for i, movie in enumerate(MOVIES * 50)]
+    records = load_catalogue(write(tmp_path, movies, ndjson), workers=workers, chunk_bytes=1024, compact=True)
+    assert isinstance(records, CompactRecords)
+    assert list(records) == movies
+
+
+def test_size_threshold_picks_the_loader(tmp_path, monkeypatch):
+    path = write(tmp_path, MOVIES)
+    monkeypatch.setattr(catalogue, "COMPACT_MIN_BYTES", 1)
+    assert isinstance(load_catalogue(path), CompactRecords)
+    assert isinstance(load_catalogue(path, compact=False), list)
+
+
+def test_has_reads_columns_and_rest():
+    records = CompactRecords.from_records(MOVIES)
+    assert records.has("annotations").tolist() == [False, True, False, False]
+    assert records.has("popularity").tolist() == [True, True, False, False]  # a null popularity is kept in the rest
+    assert records.has("extra").tolist() == [False, False, True, False]
+    assert records.ids.tolist() == [1, 2, -1, 4]
@@ -0,0 +1,105 @@
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import aiohttp
+import pytest
+
+import vector_db_async
+from util.embedding_client import EmbeddingClient
+
+BAD = "an oversized text"
+
+
+class StubEmbeddings:
+    """Ollama's /api/embed and /api/embeddings; /api/embed refuses any batch holding BAD, or is missing."""
+
+    def __init__(self):
+        self.requests = []  # (path, texts)
+        self.embed_status = None  # set to answer every /api/embed with this status
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                texts = body.get("input", [body.get("prompt")])
+                stub.requests.append((self.path, texts))
+                if self.path == "/api/embed" and stub.embed_status is not None:
+                    status, payload = stub.embed_status, {"error": "not found"}
+                elif self.path == "/api/embed" and BAD in texts:
+                    status, payload = 400, {"error": "input length exceeds the context length"}
+                elif self.path == "/api/embed":
+                    status, payload = 200, {"embeddings": [[float(len(text)), 1.0] for text in texts]}
+                elif texts[0] == BAD:
+                    status, payload = 400, {"error": "input length exceeds the context length"}
+                else:
+                    status, payload = 200, {"embedding": [float(len(texts[0])), 1.0]}
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/api/embeddings"
+
+    def paths(self):
+        return [path for path, _ in self.requests]
+
+
+@pytest.fixture
+def stub():
+    api = StubEmbeddings()
+    thread = threading.Thread(target=api.server.serve_forever, daemon=True)
+    thread.start()
+    yield api
+    api.server.shutdown()
+    api.server.server_close()
+
+
+def test_a_rejected_batch_falls_back_only_for_itself(stub):
+    client = EmbeddingClient(stub.url, "model", workers=2, backoff_factor=0)
+    embeddings = client.embed_batch(["a", BAD, "ccc"])
+    assert embeddings[0].tolist() == [1.0, 1.0] and embeddings[1] is None and embeddings[2].tolist() == [3.0, 1.0]
+    assert client.batch_url is not None
+
+    stub.requests.clear()
+    assert [e.tolist() for e in client.embed_batch(["dd", "e"])] == [[2.0, 1.0], [1.0, 1.0]]
+    assert stub.paths() == ["/api/embed"]
+
+
+@pytest.mark.parametrize("status", [404, 405])
+def test_a_missing_batch_endpoint_turns_batching_off(stub, status):
+    stub.embed_status = status
+    client = EmbeddingClient(stub.url, "model", workers=2, backoff_factor=0)
+    assert [e.tolist() for e in client.embed_batch(["a", "bb"])] == [[1.0, 1.0], [2.0, 1.0]]
+    assert client.batch_url is None
+
+    stub.requests.clear()
+    client.embed_batch(["ccc"])
+    assert stub.paths() == ["/api/embeddings"]
+
+
+def test_async_batcher_keeps_batching_after_a_rejected_batch(stub, monkeypatch):
+    monkeypatch.setitem(vector_db_async.API_URLS, "embeddings", stub.url)
+
+    async def main():
+        async with aiohttp.ClientSession() as session:
+            batcher = vector_db_async.AsyncEmbeddingBatcher(session, vector_db_async.UpstreamLimiter("embedding", 2, 10),
+                                                            window=0.05, max_batch=8)
+            results = await asyncio.gather(*(batcher.embed(text) for text in ("a", BAD, "ccc")),
+                                           return_exceptions=True)
+            assert results[0].tolist() == [1.0, 1.0] and results[2].tolist() == [3.0, 1.0]
+            assert isinstance(results[1], aiohttp.ClientResponseError) and results[1].status == 400
+            assert batcher.batch_url is not None
+
+            stub.requests.clear()
+            await asyncio.gather(batcher.embed("dd"), batcher.embed("e"))
+            assert stub.paths() == ["/api/embed"]
+
+    asyncio.run(main())
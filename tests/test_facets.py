@@ -0,0 +1,123 @@
+import numpy as np
+import pytest
+
+from util.facets import FACET_KEYS, FacetIndex, parse_facets
+from util.incremental import content_hash
+
+DIM = 8
+N_DOCS = 40
+
+
+def embedder(calls):
+    def embed_many(texts):
+        calls.extend(texts)
+        return [np.random.default_rng(content_hash(text) % 2 ** 32).standard_normal(DIM).astype(np.float32)
+                for text in texts]
+    return embed_many
+
+
+def docs(seed=0):
+    """Every third movie lacks its mood, id 5 has no facets and id 7 is not indexed at all."""
+    rng = np.random.default_rng(seed)
+    for doc_id in range(N_DOCS):
+        if doc_id in (5, 7):
+            continue
+        facets = {key: f"{key} {rng.integers(12)}" for key in FACET_KEYS}
+        if doc_id % 3 == 0:
+            del facets["mood"]
+        yield doc_id, facets
+
+
+def unit(vector):
+    return vector / np.linalg.norm(vector)
+
+
+def brute_force(queries, weights, embed_many):
+    """Weighted mean facet cosine of every indexed movie; a missing facet counts as 0."""
+    scores = {}
+    total = sum(weights[key] for key in queries)
+    for doc_id, facets in docs():
+        score = 0.0
+        for key, query in queries.items():
+            if key in facets:
+                score += weights[key] * float(unit(query) @ unit(embed_many([facets[key]])[0]))
+        scores[doc_id] = score / total
+    return scores
+
+
+@pytest.fixture(scope="module")
+def facet_index():
+    return FacetIndex.build(docs(), N_DOCS, embedder([]), dtype="float32")
+
+
+def queries(seed=1):
+    rng = np.random.default_rng(seed)
+    return {key: rng.standard_normal(DIM).astype(np.float32) for key in ("theme", "mood", "genre")}
+
+
+WEIGHTS = {"theme": 1.0, "mood": 2.0, "genre": 0.5, "setting": 1.0}
+
+
+def test_parse_facets():
+    text = "- Theme: loss\n  and grief\n- Mood: Dark\nunrelated\n* stylistic feature: long takes"
+    assert parse_facets(text) == {"theme": "loss and grief", "mood": "Dark unrelated", "stylistic_features": "long takes"}
+
+
+@pytest.mark.parametrize("dtype, tolerance", [("float32", 1e-5), ("float16", 2e-3)])
+def test_search_matches_brute_force(dtype, tolerance):
+    index = FacetIndex.build(docs(), N_DOCS, embedder([]), dtype=dtype)
+    expected = brute_force(queries(), WEIGHTS, embedder([]))
+    doc_ids, scores = index.search(queries(), WEIGHTS, k=10)
+    best = sorted(expected, key=expected.get, reverse=True)[:10]
+    assert len(doc_ids) == 10 and 5 not in doc_ids and 7 not in doc_ids
+    np.testing.assert_allclose(scores, [expected[doc_id] for doc_id in best], atol=tolerance)
+    np.testing.assert_allclose(scores, [expected[int(doc_id)] for doc_id in doc_ids], atol=tolerance)
+
+
+def test_mask_and_k_beyond_the_index(facet_index):
+    mask = np.zeros(N_DOCS, dtype=bool)
+    mask[[3, 5, 7, 20]] = True
+    doc_ids, _ = facet_index.search(queries(), WEIGHTS, k=10, mask=mask)
+    assert sorted(doc_ids.tolist()) == [3, 20]
+    doc_ids, scores = facet_index.search(queries(), WEIGHTS, k=100)
+    assert len(doc_ids) == N_DOCS - 2 and np.all(np.diff(scores) <= 0)
+
+
+def test_no_queried_facets(facet_index):
+    doc_ids, scores = facet_index.search(queries(), {"setting": 1.0}, k=10)
+    assert len(doc_ids) == 0 and len(scores) == 0
+
+
+def test_round_trip_through_arrays(facet_index):
+    restored = FacetIndex.from_arrays(facet_index.to_arrays())
+    expected, restored_result = facet_index.search(queries(), WEIGHTS, 10), restored.search(queries(), WEIGHTS, 10)
+    np.testing.assert_array_equal(restored_result[0], expected[0])
+    np.testing.assert_allclose(restored_result[1], expected[1])
+
+
+def test_packed_layout_is_converted(facet_index):
+    # The facet-by-facet layout databases were saved with before the FAISS facet index
+    vectors, doc_ids, hashes, offsets = [], [], [], [0]
+    for f in range(len(FACET_KEYS)):
+        for row, doc_id in enumerate(facet_index.doc_ids):
+            if facet_index.present[row, f]:
+                vectors.append(facet_index.facet_vector(row, f))
+                doc_ids.append(doc_id)
+                hashes.append(facet_index.hashes[row, f])
+        offsets.append(len(doc_ids))
+    converted = FacetIndex.from_arrays({'vectors': np.array(vectors, dtype=np.float16),
+                                        'offsets': np.array(offsets), 'doc_ids': np.array(doc_ids),
+                                        'hashes': np.array(hashes), 'n_docs': np.array([N_DOCS])})
+    expected, result = facet_index.search(queries(), WEIGHTS, 10), converted.search(queries(), WEIGHTS, 10)
+    np.testing.assert_array_equal(result[0], expected[0])
+    np.testing.assert_allclose(result[1], expected[1], atol=2e-3)
+
+
+def test_rebuild_embeds_only_changed_texts(facet_index):
+    changed = [(doc_id, dict(facets, theme="a new theme") if doc_id == 1 else facets) for doc_id, facets in docs()]
+    calls = []
+    rebuilt = FacetIndex.build(changed, N_DOCS, embedder(calls), dtype="float32", previous=facet_index)
+    assert calls == ["a new theme"]
+    assert len(rebuilt.doc_ids) == len(facet_index.doc_ids)
+    row = rebuilt.doc_ids.tolist().index(2)
+    np.testing.assert_allclose(rebuilt.facet_vector(row, 0), facet_index.facet_vector(row, 0))
@@ -0,0 +1,106 @@
+import faiss
+import numpy as np
+import pytest
+
+from util.filters import BATCH_SELECTOR_BELOW, MetadataColumns, filtered_search_parameters, id_selector
+
+RECORDS = [
+    {"genre_ids": [28, 878], "release_date": "1999-03-31", "original_language": "en", "vote_average": 8.2,
+     "popularity": 90.0},
+    {"genre_ids": [18], "release_date": "2005-06-01", "original_language": "fr", "vote_average": 6.5,
+     "popularity": 12.0},
+    {"genre_ids": [28], "release_date": "", "original_language": "en", "vote_average": 5.0},
+    {"genre_ids": [878, 18], "release_date": "1987", "original_language": "ja", "popularity": 40.0},
+]
+# FAISS id -> record row; id 2 was removed
+ROWS = [0, 1, None, 2, 3]
+
+
+@pytest.fixture(scope="module")
+def metadata():
+    return MetadataColumns.build(ROWS, RECORDS)
+
+
+def ids(mask):
+    return np.flatnonzero(mask).tolist()
+
+
+def test_no_filters(metadata):
+    assert metadata.mask(None) is None
+    assert metadata.mask({}) is None
+
+
+def test_genres_any_and_all(metadata):
+    assert ids(metadata.mask({"genre_ids": [878]})) == [0, 4]
+    assert ids(metadata.mask({"genre_ids": [28, 18]})) == [0, 1, 3, 4]
+    assert ids(metadata.mask({"genre_ids": [878, 18], "genre_match": "all"})) == [4]
+    assert ids(metadata.mask({"genre_ids": [878, 99], "genre_match": "all"})) == []
+    assert ids(metadata.mask({"genre_ids": [99]})) == []
+    assert ids(metadata.mask({"genre_ids": 18})) == [1, 4]
+
+
+def test_years_are_inclusive_and_exclude_unknown_dates(metadata):
+    assert ids(metadata.mask({"year_min": 1999})) == [0, 1]
+    assert ids(metadata.mask({"year_max": 1999})) == [0, 4]  # id 3 has no release date
+    assert ids(metadata.mask({"year_min": "1990", "year_max": 2005.0})) == [0, 1]
+
+
+def test_language_and_numeric_bounds(metadata):
+    assert ids(metadata.mask({"original_language": "en"})) == [0, 3]
+    assert ids(metadata.mask({"original_language": ["fr", "ja", "xx"]})) == [1, 4]
+    assert ids(metadata.mask({"min_vote_average": 6.5})) == [0, 1]  # a missing score never matches
+    assert ids(metadata.mask({"min_popularity": 40})) == [0, 4]
+
+
+def test_filters_combine(metadata):
+    assert ids(metadata.mask({"genre_ids": [28], "original_language": "en", "year_min": 1990})) == [0]
+
+
+@pytest.mark.parametrize("filters, message", [
+    ({"year_min": "nineties"}, "year_min must be an integer, got 'nineties'"),
+    ({"year_max": 1999.5}, "year_max must be an integer"),
+    ({"min_vote_average": "high"}, "min_vote_average must be a number"),
+    ({"min_popularity": True}, "min_popularity must be a number"),
+    ({"genre_ids": ["action"]}, "genre_ids must be an integer"),
+    ({"genre_ids": [28], "genre_match": "most"}, "genre_match must be 'any' or 'all'"),
+    ({"year": 1999}, "Unknown filters: year"),
+    (["year_min"], "filters must be an object"),
+])
+def test_invalid_filters(metadata, filters, message):
+    with pytest.raises(ValueError, match=message):
+        metadata.mask(filters)
+
+
+def test_round_trip_through_arrays(metadata):
+    restored = MetadataColumns.from_arrays(metadata.to_arrays())
+    for filters in ({"genre_ids": [878]}, {"original_language": "en"}, {"year_max": 2000, "min_popularity": 1}):
+        np.testing.assert_array_equal(restored.mask(filters), metadata.mask(filters))
+
+
+@pytest.mark.parametrize("selected", [3, 500])
+def test_selectors_restrict_the_search(selected):
+    n = 1000
+    vectors = np.random.default_rng(0).standard_normal((n, 8)).astype(np.float32)
+    index = faiss.IndexFlatIP(8)
+    index.add(vectors)
+    mask = np.zeros(n, dtype=bool)
+    mask[np.random.default_rng(1).choice(n, selected, replace=False)] = True
+    selector = id_selector(mask)
+    expected_type = faiss.IDSelectorBatch if selected < BATCH_SELECTOR_BELOW * n else faiss.IDSelectorBitmap
+    assert isinstance(selector, expected_type)
+
+    _, labels = index.search(vectors[:4], 10, params=filtered_search_parameters(index, mask=mask))
+    returned = labels[labels >= 0]
+    assert mask[returned].all()
+    assert len(returned) == 4 * min(10, selected)
+
+
+def test_filtered_search_widens_ivf_probes():
+    vectors = np.random.default_rng(0).standard_normal((2000, 8)).astype(np.float32)
+    index = faiss.index_factory(8, "IVF16,Flat", faiss.METRIC_INNER_PRODUCT)
+    index.train(vectors)
+    index.add(vectors)
+    mask = np.zeros(2000, dtype=bool)
+    mask[:500] = True  # a quarter of the ids: four times the probes, capped at nlist
+    assert filtered_search_parameters(index, nprobe=2, mask=mask).nprobe == 8
+    assert filtered_search_parameters(index, nprobe=8, mask=mask).nprobe == 16
@@ -0,0 +1,237 @@
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+import requests
+
+import manager.games.game_detail_by_id as games
+import manager.movies.fetch_all_movies as movies
+from util import ingest
+from util.ingest import Checkpoint, NDJSONWriter, TokenBucket, compact, pooled_session, read_ndjson
+
+PAGES = 10
+PER_PAGE = 5
+
+
+class StubAPI:
+    """
+    A local HTTP server standing in for TMDB and Steam.
+
+    `respond(path, params, attempt)` returns (status, body, headers); `attempt` counts the
+    requests for the same path and parameters so far, starting at 1.
+    """
+
+    def __init__(self):
+        self.requests = []  # (seconds since start, path, params)
+        self.respond = lambda path, params, attempt: (200, {}, {})
+        self._attempts = {}
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = {key: values[0] for key, values in parse_qs(url.query).items()}
+                with stub._lock:
+                    key = (url.path, tuple(sorted(params.items())))
+                    stub._attempts[key] = stub._attempts.get(key, 0) + 1
+                    stub.requests.append((time.perf_counter() - stub._start, url.path, params))
+                    attempt = stub._attempts[key]
+                status, body, headers = stub.respond(url.path, params, attempt)
+                payload = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def paths(self, path):
+        return [params for _, requested, params in self.requests if requested == path]
+
+
+@pytest.fixture
+def stub():
+    api = StubAPI()
+    thread = threading.Thread(target=api.server.serve_forever, daemon=True)
+    thread.start()
+    yield api
+    api.server.shutdown()
+    api.server.server_close()
+
+
+def discover_page(page):
+    return {"page": page, "total_pages": PAGES,
+            "results": [{"id": (page - 1) * PER_PAGE + i, "title": f"Movie {page}.{i}"} for i in range(PER_PAGE)]}
+
+
+@pytest.fixture
+def tmdb(stub, monkeypatch):
+    monkeypatch.setattr(movies, "TMDB_API_URL", stub.base_url)
+    monkeypatch.setenv("TMDB_API_KEY", "test-key")
+    stub.respond = lambda path, params, attempt: (200, discover_page(int(params["page"])), {})
+    return stub
+
+
+def test_token_bucket_paces_requests():
+    bucket = TokenBucket(rate=50, burst=5)
+    start = time.perf_counter()
+    for _ in range(30):
+        bucket.acquire()
+    # The burst goes out at once, the other 25 at 50/s
+    assert 0.45 <= time.perf_counter() - start < 1.5
+
+
+def test_ingest_stays_within_the_rate_across_workers(tmdb):
+    session = pooled_session(8)
+    output = NDJSONWriter(os.devnull)
+    stats = ingest.ingest(range(1, 31), lambda page: movies.fetch_movies(session, page)["results"], output,
+                          limiter=TokenBucket(rate=40, burst=1), workers=8)
+    output.close()
+    assert stats["fetched"] == 30
+    times = sorted(t for t, _, _ in tmdb.requests)
+    assert times[-1] - times[0] >= 29 / 40 * 0.9
+    for i in range(len(times) - 10):
+        assert times[i + 10] - times[i] >= 10 / 40 * 0.8  # never more than the rate in any window
+
+
+def test_429_is_retried_after_retry_after(tmdb):
+    tmdb.respond = lambda path, params, attempt: \
+        (429, {}, {"Retry-After": "1"}) if attempt == 1 else (200, discover_page(int(params["page"])), {})
+    result = movies.fetch_movies(pooled_session(1, backoff_factor=0), 3)
+    assert result["page"] == 3
+    (first, _, _), (second, _, _) = tmdb.requests
+    assert second - first >= 0.9
+
+
+def test_5xx_is_retried_then_raised(tmdb):
+    tmdb.respond = lambda path, params, attempt: \
+        (503, {}, {}) if attempt <= 2 else (200, discover_page(int(params["page"])), {})
+    assert movies.fetch_movies(pooled_session(1, backoff_factor=0), 2)["page"] == 2
+    assert len(tmdb.requests) == 3
+
+    tmdb.respond = lambda path, params, attempt: (500, {}, {})
+    with pytest.raises(requests.HTTPError):
+        movies.fetch_movies(pooled_session(1, max_retries=2, backoff_factor=0), 4)
+    assert len(tmdb.paths("/discover/movie")) == 3 + 3  # first request plus two retries
+
+
+def test_movies_resume_after_an_interrupted_run(tmdb, tmp_path):
+    output = str(tmp_path / "all_movies.json")
+    ndjson = str(tmp_path / "all_movies.ndjson")
+
+    # First run: page 6 fails without being retried, as if the run had stopped before it
+    tmdb.respond = lambda path, params, attempt: \
+        (400, {}, {}) if params["page"] == "6" else (200, discover_page(int(params["page"])), {})
+    movies.main(["--output", output, "--workers", "4", "--rate", "1000"])
+    ids = [record["id"] for record in read_ndjson(ndjson)]
+    assert len(ids) == len(set(ids)) == (PAGES - 1) * PER_PAGE
+    assert "6" not in Checkpoint(str(tmp_path / "all_movies.pages"))
+
+    # ... and the process died mid-write of another page's records
+    with open(ndjson, "a", encoding="utf-8") as f:
+        f.write('{"id": 25, "title": "Mov')
+
+    tmdb.requests.clear()
+    tmdb.respond = lambda path, params, attempt: (200, discover_page(int(params["page"])), {})
+    movies.main(["--output", output, "--workers", "4", "--rate", "1000"])
+    # Only the unfinished page is fetched again (page 1 is also read for total_pages)
+    assert sorted(int(params["page"]) for params in tmdb.paths("/discover/movie")) == [1, 6]
+    with open(output, "r", encoding="utf-8") as f:
+        catalogue = json.load(f)
+    assert sorted(movie["id"] for movie in catalogue) == list(range(PAGES * PER_PAGE))
+    # The run is complete, so its journals are gone
+    assert not os.path.exists(ndjson) and not os.path.exists(str(tmp_path / "all_movies.pages"))
+
+
+def test_movies_refresh_on_the_next_full_run(tmdb, tmp_path):
+    output = str(tmp_path / "all_movies.json")
+    args = ["--output", output, "--workers", "4", "--rate", "1000"]
+    movies.main(args)
+
+    def renamed(path, params, attempt):
+        page = discover_page(int(params["page"]))
+        page["results"] = [dict(movie, title=movie["title"] + " (restored)") for movie in page["results"]]
+        return 200, page, {}
+
+    tmdb.requests.clear()
+    tmdb.respond = renamed
+    movies.main(args)
+    assert sorted(int(params["page"]) for params in tmdb.paths("/discover/movie")) == [1] + list(range(1, PAGES + 1))
+    with open(output, "r", encoding="utf-8") as f:
+        catalogue = json.load(f)
+    assert len(catalogue) == PAGES * PER_PAGE
+    assert all(movie["title"].endswith(" (restored)") for movie in catalogue)
+
+
+def test_games_retry_skip_and_resume(stub, tmp_path, monkeypatch):
+    monkeypatch.setattr(games, "STEAM_API_URL", stub.base_url)
+    monkeypatch.setattr(games, "pooled_session", lambda workers: pooled_session(workers, backoff_factor=0))
+    app_list = tmp_path / "steam_games.json"
+    app_list.write_text(json.dumps({"applist": {"apps": [{"appid": appid} for appid in range(1, 9)]}}))
+    output = str(tmp_path / "games_details.json")
+    args = ["--app_list", str(app_list), "--output", output, "--workers", "2", "--rate", "1000"]
+
+    def respond(path, params, attempt):
+        appid = int(params["appid"])
+        if appid == 3:
+            return 404, {}, {}  # no schema: recorded as done, never asked again
+        if appid == 5 and failing:
+            return 500, {}, {}  # still failing after the retries: left for the next run
+        if appid == 7 and attempt == 1:
+            return 429, {}, {"Retry-After": "0"}
+        return 200, {"game": {"gameName": f"Game {appid}"}}, {}
+
+    failing = True
+    stub.respond = respond
+    games.main(args)
+    assert len([p for p in stub.paths("/ISteamUserStats/GetSchemaForGame/v2/") if p["appid"] == "5"]) == 6
+    assert len([p for p in stub.paths("/ISteamUserStats/GetSchemaForGame/v2/") if p["appid"] == "3"]) == 1
+
+    failing = False
+    stub.requests.clear()
+    games.main(args)
+    assert [params["appid"] for _, _, params in stub.requests] == ["5"]
+    with open(output, "r", encoding="utf-8") as f:
+        details = json.load(f)
+    assert sorted(game["appid"] for game in details) == [1, 2, 4, 5, 6, 7, 8]
+
+    # A complete run clears its journals, so the next one asks for every app again
+    stub.requests.clear()
+    games.main(args)
+    assert sorted(int(params["appid"]) for _, _, params in stub.requests) == list(range(1, 9))
+
+
+def test_games_refused_key_aborts_without_checkpointing(stub, tmp_path, monkeypatch):
+    monkeypatch.setattr(games, "STEAM_API_URL", stub.base_url)
+    app_list = tmp_path / "steam_games.json"
+    app_list.write_text(json.dumps({"applist": {"apps": [{"appid": appid} for appid in range(1, 101)]}}))
+    output = str(tmp_path / "games_details.json")
+    stub.respond = lambda path, params, attempt: (403, {}, {})
+    with pytest.raises(requests.HTTPError, match="403"):
+        games.main(["--app_list", str(app_list), "--output", output, "--workers", "2", "--rate", "1000"])
+    assert len(stub.requests) < 100
+    assert not Checkpoint(str(tmp_path / "games_details.appids")).done
+    assert not os.path.exists(output)
+
+
+def test_compact_keeps_the_last_record_per_key(tmp_path):
+    ndjson = tmp_path / "records.ndjson"
+    ndjson.write_text('{"id": 1, "v": "old"}\n{"id": 2, "v": "b"}\n\n{"id": 1, "v": "new"}\n{"id": 3, "v"',
+                      encoding="utf-8")
+    json_path = tmp_path / "records.json"
+    assert compact(str(ndjson), str(json_path), key="id") == 2
+    assert json.loads(json_path.read_text(encoding="utf-8")) == [{"id": 1, "v": "new"}, {"id": 2, "v": "b"}]
+    assert not os.path.exists(f"{json_path}.tmp")
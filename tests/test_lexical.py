@@ -0,0 +1,91 @@
+import math
+
+import numpy as np
+import pytest
+
+from util.lexical import B, K1, TITLE_WEIGHT, LexicalIndex, reciprocal_rank_fusion, tokenize
+
+DOCS = [
+    (0, "Alien", "A space crew meets an alien."),
+    (1, "Heat", "A heist crew in Los Angeles."),
+    (2, "Space Jam", "Basketball in space."),
+    (4, "Ｈeat", "Remake."),  # id 3 is a removed document
+]
+
+
+@pytest.fixture(scope="module")
+def index():
+    return LexicalIndex.build(DOCS, n_docs=5)
+
+
+def bm25(tf, df, length, n_docs, avg_length):
+    idf = math.log(1.0 + (n_docs - df + 0.5) / (df + 0.5))
+    return idf * tf * (K1 + 1.0) / (tf + K1 * (1.0 - B + B * length / avg_length))
+
+
+def test_tokenize_normalizes_case_and_width():
+    assert tokenize("Ｈeat, SPACE-jam!") == ["heat", "space", "jam"]
+
+
+def test_bm25_scores(index):
+    lengths = {0: TITLE_WEIGHT + 6, 1: TITLE_WEIGHT + 6, 2: 2 * TITLE_WEIGHT + 3, 4: TITLE_WEIGHT + 1}
+    avg_length = sum(lengths.values()) / len(lengths)
+    doc_ids, scores = index.search("alien", k=10)
+    assert doc_ids.tolist() == [0]
+    # "alien" is both a title token and an overview token of doc 0
+    assert scores[0] == pytest.approx(bm25(TITLE_WEIGHT + 1, 1, lengths[0], 4, avg_length), rel=1e-5)
+
+    doc_ids, scores = index.search("space crew", k=10)
+    expected = {
+        0: bm25(1, 2, lengths[0], 4, avg_length) + bm25(1, 2, lengths[0], 4, avg_length),
+        1: bm25(1, 2, lengths[1], 4, avg_length),
+        2: bm25(TITLE_WEIGHT + 1, 2, lengths[2], 4, avg_length),
+    }
+    assert doc_ids.tolist() == sorted(expected, key=expected.get, reverse=True)
+    np.testing.assert_allclose(scores, sorted(expected.values(), reverse=True), rtol=1e-5)
+
+
+def test_title_match_outranks_overview_match(index):
+    doc_ids, _ = index.search("space", k=10)
+    assert doc_ids.tolist() == [2, 0]
+
+
+def test_top_k_and_mask(index):
+    doc_ids, _ = index.search("crew space", k=1)
+    assert len(doc_ids) == 1
+    mask = np.array([False, True, True, False, True])
+    doc_ids, _ = index.search("space crew", k=10, mask=mask)
+    assert set(doc_ids.tolist()) == {1, 2}
+
+
+def test_unknown_terms_match_nothing(index):
+    doc_ids, scores = index.search("zzz qqq", k=10)
+    assert len(doc_ids) == 0 and len(scores) == 0
+
+
+def test_exact_title_lookup(index):
+    assert sorted(index.exact_title("heat").tolist()) == [1, 4]
+    assert index.exact_title("  SPACE   jam ").tolist() == [2]
+    assert len(index.exact_title("space")) == 0
+
+
+def test_round_trip_through_arrays(index):
+    restored = LexicalIndex.from_arrays(index.to_arrays())
+    for query in ("alien", "space crew", "heist"):
+        expected, restored_result = index.search(query, 10), restored.search(query, 10)
+        np.testing.assert_array_equal(restored_result[0], expected[0])
+        np.testing.assert_allclose(restored_result[1], expected[1])
+
+
+def test_reciprocal_rank_fusion():
+    fused = reciprocal_rank_fusion([[1, 2, 3], [3, 1]], k=60)
+    assert [doc_id for doc_id, _ in fused] == [1, 3, 2]
+    scores = dict(fused)
+    assert scores[1] == pytest.approx(1 / 61 + 1 / 62)
+    assert scores[3] == pytest.approx(1 / 63 + 1 / 61)
+    assert scores[2] == pytest.approx(1 / 62)
+
+
+def test_reciprocal_rank_fusion_accepts_numpy_ids():
+    fused = reciprocal_rank_fusion([np.array([7, 8], dtype=np.int32), [8]], k=1)
+    assert fused == [(8, pytest.approx(1 / 3 + 1 / 2)), (7, pytest.approx(1 / 2))]
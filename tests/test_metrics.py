@@ -0,0 +1,70 @@
+import logging
+import re
+
+from util.metrics import CONTENT_TYPE, Counter, Histogram, Registry, Span, sampled
+
+# One sample line of the Prometheus text format: name{labels} value
+SAMPLE_RE = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*(\{([a-zA-Z_][a-zA-Z0-9_]*="[^"]*",?)*\})? -?[0-9.e+-]+$')
+
+
+def test_histogram_buckets_are_cumulative_with_inclusive_bounds():
+    histogram = Histogram("test_seconds", "Test latency", "stage", buckets=(0.1, 0.5, 1.0))
+    for seconds in (0.05, 0.1, 0.3, 0.7, 2.0):
+        histogram.observe("search", seconds)
+    lines = histogram.render()
+    assert lines[:2] == ["# HELP test_seconds Test latency", "# TYPE test_seconds histogram"]
+    assert lines[2:] == [
+        'test_seconds_bucket{stage="search",le="0.1"} 2',  # 0.1 itself falls in le="0.1"
+        'test_seconds_bucket{stage="search",le="0.5"} 3',
+        'test_seconds_bucket{stage="search",le="1.0"} 4',
+        'test_seconds_bucket{stage="search",le="+Inf"} 5',
+        'test_seconds_sum{stage="search"} 3.15',
+        'test_seconds_count{stage="search"} 5',
+    ]
+
+
+def test_histogram_series_per_label_and_snapshot():
+    histogram = Histogram("test_seconds", "Test latency", "endpoint", buckets=(1.0,))
+    histogram.observe("search", 0.5)
+    histogram.observe("chat", 2.0)
+    histogram.observe("chat", 4.0)
+    counts = [line for line in histogram.render() if "_count" in line]
+    assert counts == ['test_seconds_count{endpoint="chat"} 2', 'test_seconds_count{endpoint="search"} 1']
+    assert histogram.snapshot() == {"search": {"count": 1, "sum": 0.5, "mean": 0.5},
+                                    "chat": {"count": 2, "sum": 6.0, "mean": 3.0}}
+
+
+def test_span_observes_its_block():
+    histogram = Histogram("test_seconds", "Test latency", "stage")
+    with Span(histogram, "embed"):
+        pass
+    with histogram.time("embed"):
+        pass
+    assert histogram.snapshot()["embed"]["count"] == 2
+
+
+def test_registry_renders_valid_exposition_format():
+    registry = Registry()
+    histogram = registry.histogram("test_request_seconds", "Request time", "endpoint")
+    counter = registry.counter("test_events_total", "Events", "event")
+    histogram.observe("search", 0.02)
+    counter.inc("missing_hit", 3)
+    counter.inc("missing_hit")
+    text = registry.render()
+    assert text.endswith("\n")
+    assert 'test_events_total{event="missing_hit"} 4' in text
+    for line in text.splitlines():
+        assert line.startswith(("# HELP ", "# TYPE ")) or SAMPLE_RE.match(line), line
+    assert CONTENT_TYPE.startswith("text/plain; version=0.0.4")
+
+
+def test_counter_without_observations_renders_only_headers():
+    assert Counter("test_total", "Nothing yet", "event").render() == ["# HELP test_total Nothing yet",
+                                                                     "# TYPE test_total counter"]
+
+
+def test_sampled_respects_level_and_rate(caplog):
+    caplog.set_level(logging.INFO)
+    assert not sampled(logging.DEBUG, 1.0)
+    assert sampled(logging.INFO, 1.0)
+    assert not any(sampled(logging.INFO, 0.0) for _ in range(100))
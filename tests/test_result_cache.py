@@ -0,0 +1,89 @@
+import types
+
+import faiss
+import numpy as np
+
+from util import result_cache
+from util.generation import Generation, GenerationSwitch
+from util.result_cache import SemanticCache, mask_digest
+
+DIM = 16
+
+
+def unit(seed):
+    vector = np.random.default_rng(seed).standard_normal(DIM).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def at_cosine(vector, cosine, seed=99):
+    """A unit vector whose cosine with `vector` is exactly `cosine`."""
+    other = np.random.default_rng(seed).standard_normal(DIM).astype(np.float32)
+    other -= other.dot(vector) * vector
+    other /= np.linalg.norm(other)
+    return cosine * vector + np.sqrt(1 - cosine ** 2) * other
+
+
+def test_similarity_threshold():
+    cache = SemanticCache(threshold=0.95)
+    query = unit(0)
+    cache.put(query * 3.0, "sig", ["hit"])  # stored normalized, so scale does not matter
+    assert cache.get(query, "sig") == ["hit"]
+    assert cache.get(at_cosine(query, 0.97), "sig") == ["hit"]
+    assert cache.get(at_cosine(query, 0.90), "sig") is None
+    assert cache.stats()["hits"] == 2 and cache.stats()["misses"] == 1
+
+
+def test_signature_must_match():
+    cache = SemanticCache()
+    query = unit(1)
+    mask = np.array([True, False, True])
+    cache.put(query, ("hybrid", 50, mask_digest(mask)), ["filtered"])
+    assert cache.get(query, ("hybrid", 50, mask_digest(mask.copy()))) == ["filtered"]
+    assert cache.get(query, ("hybrid", 50, mask_digest(~mask))) is None
+    assert cache.get(query, ("hybrid", 50, None)) is None
+    assert mask_digest(None) is None
+
+
+def test_returned_results_are_a_copy():
+    cache = SemanticCache()
+    cache.put(unit(2), "sig", ["a", "b"])
+    cache.get(unit(2), "sig").append("c")
+    assert cache.get(unit(2), "sig") == ["a", "b"]
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(result_cache, "time", types.SimpleNamespace(time=lambda: clock[0]))
+    cache = SemanticCache(ttl=60)
+    cache.put(unit(3), "sig", ["old"])
+    clock[0] += 30
+    cache.put(unit(4), "sig", ["young"])
+    clock[0] += 45  # the first entry is now 75s old, the second 45s
+    assert cache.get(unit(3), "sig") is None
+    assert cache.get(unit(4), "sig") == ["young"]
+    assert cache.stats()["entries"] == 1 and cache.stats()["evictions"] == 1
+
+
+def test_oldest_entry_evicted_beyond_max_entries():
+    cache = SemanticCache(max_entries=2)
+    for seed in range(3):
+        cache.put(unit(10 + seed), "sig", [seed])
+    assert cache.get(unit(10), "sig") is None
+    assert cache.get(unit(11), "sig") == [1] and cache.get(unit(12), "sig") == [2]
+
+
+def test_reload_starts_with_an_empty_cache():
+    index = faiss.IndexFlatIP(DIM)
+
+    def load():
+        return Generation([], index, [], result_cache=SemanticCache())
+
+    switch = GenerationSwitch(load)
+    switch.reload(force=True)
+    first = switch.current
+    first.result_cache.put(unit(5), "sig", ["stale"])
+    assert first.result_cache.get(unit(5), "sig") == ["stale"]
+
+    switch.reload(force=True)
+    assert switch.current is not first
+    assert switch.current.result_cache.get(unit(5), "sig") is None
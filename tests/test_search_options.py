@@ -0,0 +1,25 @@
+import pytest
+
+from vector_db_flask import search_options
+
+
+def test_defaults_and_overrides():
+    assert search_options({}) == (50, 0.5, None, None)
+    assert search_options({}, top_k=5) == (5, 0.5, None, None)
+    assert search_options({"top_k": 3, "min_similarity": 0, "nprobe": 16, "efSearch": 64}) == (3, 0.0, 16, 64)
+    assert search_options({"nprobe": None, "efSearch": None}) == (50, 0.5, None, None)
+
+
+@pytest.mark.parametrize("data, message", [
+    ({"top_k": "x"}, "top_k must be a positive integer, got 'x'"),
+    ({"top_k": 0}, "top_k must be a positive integer"),
+    ({"top_k": True}, "top_k must be a positive integer"),
+    ({"min_similarity": "high"}, "min_similarity must be a number"),
+    ({"nprobe": "x"}, "nprobe must be a positive integer, got 'x'"),
+    ({"nprobe": 0}, "nprobe must be a positive integer, got 0"),
+    ({"efSearch": 12.5}, "efSearch must be a positive integer"),
+    ({"efSearch": -1}, "efSearch must be a positive integer"),
+])
+def test_invalid_options(data, message):
+    with pytest.raises(ValueError, match=message):
+        search_options(data)
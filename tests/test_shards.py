@@ -0,0 +1,124 @@
+import multiprocessing
+import socket
+import time
+
+import faiss
+import numpy as np
+import pytest
+
+from util.shards import ShardClient, ShardedIndex, serve, shard_authkey, spawn_local, split_index
+
+N_SHARDS = 3
+
+
+def flat_index(n=2000, d=32, seed=0):
+    vectors = np.random.default_rng(seed).standard_normal((n, d)).astype(np.float32)
+    faiss.normalize_L2(vectors)
+    index = faiss.IndexIDMap2(faiss.IndexFlatIP(d))
+    index.add_with_ids(vectors, np.arange(n, dtype=np.int64))
+    return index, vectors
+
+
+def queries(d=32, n=5, seed=1):
+    matrix = np.random.default_rng(seed).standard_normal((n, d)).astype(np.float32)
+    faiss.normalize_L2(matrix)
+    return matrix
+
+
+@pytest.fixture(scope="module")
+def local_shards(tmp_path_factory):
+    index, vectors = flat_index()
+    shard_dir = str(tmp_path_factory.mktemp("shards"))
+    split_index(index, N_SHARDS, shard_dir, vectors)
+    addresses, processes, authkey = spawn_local(shard_dir)
+    yield index, addresses, processes, authkey
+    for process in processes:
+        process.terminate()
+
+
+def test_merged_top_k_matches_single_index(local_shards):
+    index, addresses, _, authkey = local_shards
+    sharded = ShardedIndex(addresses, authkey, timeout=5.0)
+    try:
+        assert sharded.ntotal == index.ntotal
+        expected_distances, expected_labels = index.search(queries(), 10)
+        distances, labels = sharded.search(queries(), 10)
+        np.testing.assert_array_equal(labels, expected_labels)
+        np.testing.assert_allclose(distances, expected_distances, rtol=1e-5)
+        assert sharded.stats()["partial"] == 0
+    finally:
+        sharded.close()
+
+
+def test_spawn_local_uses_a_random_key(local_shards):
+    _, addresses, _, authkey = local_shards
+    assert len(authkey) == 32
+    with pytest.raises(multiprocessing.AuthenticationError):
+        ShardClient(addresses[0], b"gpt-rex-shards").call(("info",), time.perf_counter() + 5.0)
+
+
+def test_killed_shard_is_left_out(local_shards):
+    index, addresses, processes, authkey = local_shards
+    sharded = ShardedIndex(addresses, authkey, timeout=5.0)
+    try:
+        sharded.search(queries(), 10)  # pools a connection to every shard
+        processes[0].terminate()
+        processes[0].join()
+        start = time.perf_counter()
+        distances, labels = sharded.search(queries(), 10)
+        assert time.perf_counter() - start < 5.0
+        assert sharded.stats()["partial"] == 1
+
+        # The answer is the single index's top-k over the ids the surviving shards own
+        surviving = np.flatnonzero(np.arange(index.ntotal) % N_SHARDS != 0)
+        params = faiss.SearchParameters(sel=faiss.IDSelectorBatch(surviving.astype(np.int64)))
+        expected_distances, expected_labels = index.search(queries(), 10, params=params)
+        np.testing.assert_array_equal(labels, expected_labels)
+        np.testing.assert_allclose(distances, expected_distances, rtol=1e-5)
+    finally:
+        sharded.close()
+
+
+def test_connect_gives_up_on_a_stuck_shard():
+    # A listener that never accepts: the TCP connect succeeds, the handshake never starts
+    with socket.socket() as stuck:
+        stuck.bind(("127.0.0.1", 0))
+        stuck.listen(1)
+        client = ShardClient(stuck.getsockname(), b"key", connect_timeout=0.2)
+        start = time.perf_counter()
+        with pytest.raises(TimeoutError):
+            client.call(("info",), time.perf_counter() + 5.0)
+        assert time.perf_counter() - start < 2.0
+
+
+def test_authkey_required_on_every_interface(monkeypatch):
+    monkeypatch.delenv("SHARD_AUTHKEY", raising=False)
+    with pytest.raises(ValueError, match="SHARD_AUTHKEY"):
+        shard_authkey()
+    with pytest.raises(ValueError, match="SHARD_AUTHKEY"):
+        serve("missing.faiss", ("127.0.0.1", 0))
+    with pytest.raises(ValueError, match="SHARD_AUTHKEY"):
+        ShardClient(("127.0.0.1", 1))
+    assert shard_authkey(b"secret") == b"secret"
+    monkeypatch.setenv("SHARD_AUTHKEY", "from-env")
+    assert shard_authkey() == b"from-env"
+
+
+def test_mismatched_shards_fail_the_load(tmp_path, monkeypatch):
+    import vector_db_flask
+
+    index, vectors = flat_index(n=300)
+    shard_dir = str(tmp_path / "shards")
+    split_index(index, 2, shard_dir, vectors)
+    monkeypatch.setitem(vector_db_flask.SHARDS, "local", True)
+    monkeypatch.setitem(vector_db_flask.SHARDS, "dir", shard_dir)
+
+    sharded = vector_db_flask.connect_shards(str(tmp_path / "db"), index)
+    try:
+        assert sharded.ntotal == index.ntotal
+    finally:
+        sharded.close()
+
+    newer, _ = flat_index(n=301)
+    with pytest.raises(ValueError, match="split it again"):
+        vector_db_flask.connect_shards(str(tmp_path / "db"), newer)
@@ -0,0 +1,129 @@
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+import faiss
+import numpy as np
+
+DEFAULT_FACTORY = "Flat"
+
+
+def create_index(vectors: np.ndarray, factory: str = DEFAULT_FACTORY, metric: int = faiss.METRIC_INNER_PRODUCT) -> Any:
+    """
+    Build an empty index from a FAISS factory string and train it on `vectors` if it needs training.
+
+    Examples: "Flat", "IVF256,Flat", "IVF1024,PQ32", "HNSW32", "OPQ32,IVF1024,PQ32".
+    The caller adds the vectors (possibly with ids) afterwards.
+    """
+    index = faiss.index_factory(vectors.shape[1], factory, metric)
+    if not index.is_trained:
+        logging.info(f"Training {factory} index on {len(vectors)} vectors")
+        index.train(vectors)
+    return index
+
+
+def unwrap(index: Any) -> Any:
+    """Return the index doing the actual search, looking through IDMap and pre-transform wrappers."""
+    while True:
+        if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+            index = faiss.downcast_index(index.index)
+        elif isinstance(index, faiss.IndexPreTransform):
+            index = faiss.downcast_index(index.index)
+        else:
+            return faiss.downcast_index(index)
+
+
+def search_parameters(index: Any, nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                      selector: Any = None) -> Optional[Any]:
+    """
+    Per-request search parameters for `index`, or None when nothing needs overriding.
+
+    `nprobe` applies to IVF indexes, `ef_search` to HNSW indexes and to HNSW coarse
+    quantizers of IVF indexes. `selector` is a faiss.IDSelector restricting the ids searched.
+    """
+    if nprobe is None and ef_search is None and selector is None:
+        return None
+
+    base = unwrap(index)
+    keep_alive = []
+    if isinstance(base, faiss.IndexIVF):
+        params = faiss.SearchParametersIVF()
+        if nprobe is not None:
+            params.nprobe = int(nprobe)
+        quantizer = faiss.downcast_index(base.quantizer)
+        if ef_search is not None and isinstance(quantizer, faiss.IndexHNSW):
+            quantizer_params = faiss.SearchParametersHNSW()
+            quantizer_params.efSearch = int(ef_search)
+            params.quantizer_params = quantizer_params
+            keep_alive.append(quantizer_params)
+    elif isinstance(base, faiss.IndexHNSW):
+        params = faiss.SearchParametersHNSW()
+        if ef_search is not None:
+            params.efSearch = int(ef_search)
+    else:
+        params = faiss.SearchParameters()
+
+    is_idmap = isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2))
+    inner = faiss.downcast_index(index.index) if is_idmap else index
+    if isinstance(inner, faiss.IndexPreTransform):
+        # IndexPreTransform only forwards `index_params`, so the selector goes on the inner
+        # parameters, translated from external ids by hand since IndexIDMap won't see it
+        if selector is not None:
+            keep_alive.append(selector)
+            if is_idmap:
+                selector = faiss.IDSelectorTranslated(index.id_map, selector)
+                keep_alive.append(selector)
+            params.sel = selector
+        wrapper = faiss.SearchParametersPreTransform()
+        wrapper.index_params = params
+        keep_alive.append(params)
+        params = wrapper
+    elif selector is not None:
+        params.sel = selector
+        keep_alive.append(selector)
+
+    # SWIG does not own the nested objects; keep them alive as long as the parameters
+    params.referenced_objects = keep_alive
+    return params
+
+
+def restricted_search(index: Any, query: np.ndarray, ids: np.ndarray, ef_search: Optional[int] = None) -> Dict[int, float]:
+    """Scores of a (1, d) query against the given ids, from a search restricted to them; absent ids are left out."""
+    ids = np.asarray(ids, dtype=np.int64)
+    if not len(ids):
+        return {}
+    # Probe every list so an id is scored wherever IVF put it
+    base = unwrap(index)
+    full_nprobe = base.nlist if isinstance(base, faiss.IndexIVF) else None
+    params = search_parameters(index, nprobe=full_nprobe, ef_search=ef_search, selector=faiss.IDSelectorBatch(ids))
+    distances, indices = index.search(query, len(ids), params=params)
+    return {int(idx): float(distance) for idx, distance in zip(indices[0], distances[0]) if idx >= 0}
+
+
+def exact_scores(vectors: np.ndarray, query: np.ndarray, ids: np.ndarray) -> np.ndarray:
+    """Inner products of one query with the full-precision rows `ids` of `vectors` (which may be memory-mapped)."""
+    ids = np.asarray(ids, dtype=np.int64)
+    order = np.argsort(ids, kind="stable")  # read the mapped rows front to back
+    scores = np.empty(len(ids), dtype=np.float32)
+    scores[order] = np.asarray(vectors[ids[order]], dtype=np.float32) @ query.astype(np.float32).ravel()
+    return scores
+
+
+def rescore(vectors: np.ndarray, queries: np.ndarray, indices: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Exact top-k of each query among its approximate candidates `indices` (-1 padded).
+
+    Candidates are rescored against the float32 rows of `vectors`, so a compressed index
+    (SQ8, PQ, ...) only has to get the right ids into the candidate list, not order them.
+    Returns (distances, indices) shaped and padded like `index.search` with inner product.
+    """
+    distances = np.full((len(queries), k), -np.finfo(np.float32).max, dtype=np.float32)
+    labels = np.full((len(queries), k), -1, dtype=np.int64)
+    for row, (query, candidates) in enumerate(zip(queries, indices)):
+        candidates = candidates[candidates >= 0]
+        if not len(candidates):
+            continue
+        scores = exact_scores(vectors, query, candidates)
+        top = np.argsort(-scores, kind="stable")[:k]
+        distances[row, :len(top)] = scores[top]
+        labels[row, :len(top)] = candidates[top]
+    return distances, labels
@@ -0,0 +1,170 @@
+import argparse
+import json
+import logging
+import os
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+import faiss
+import numpy as np
+
+from util.ann import create_index, rescore, search_parameters, unwrap
+from util.db_store import read_db
+
+DEFAULT_FACTORIES = ["Flat", "SQfp16", "SQ8", "PQ32", "IVF256,Flat", "IVF256,SQ8", "IVF256,PQ32", "HNSW32",
+                     "OPQ32,IVF256,PQ32"]
+
+
+def vectors_from_db(db_path: str) -> np.ndarray:
+    """Recover the stored (normalized) vectors from a DB whose index keeps full vectors or reconstructable codes."""
+    base = unwrap(read_db(db_path, mmap=False)['index'])
+    if isinstance(base, faiss.IndexIVF):
+        base.make_direct_map()
+    return base.reconstruct_n(0, base.ntotal)
+
+
+def synthetic_vectors(n: int, dim: int, clusters: int = 100, seed: int = 0) -> np.ndarray:
+    """Normalized Gaussian-mixture vectors; clustered data is a fairer stand-in for embeddings than uniform noise."""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, clusters, n)] + 0.6 * rng.standard_normal((n, dim)).astype(np.float32)
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def make_queries(vectors: np.ndarray, n: int, noise: float = 0.05, seed: int = 1) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    queries = vectors[rng.integers(0, len(vectors), n)] + noise * rng.standard_normal((n, vectors.shape[1])).astype(np.float32)
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    faiss.normalize_L2(queries)
+    return queries
+
+
+def recall_at_k(found: np.ndarray, truth: np.ndarray) -> float:
+    k = truth.shape[1]
+    return float(np.mean([len(np.intersect1d(f[f >= 0], t)) / k for f, t in zip(found, truth)]))
+
+
+def timed_search(index: Any, queries: np.ndarray, k: int, params: Optional[Any], batch_size: int,
+                 exact: Optional[np.ndarray] = None, factor: Optional[int] = None):
+    """
+    Search in request-sized batches (1 mimics /search, larger mimics /search/batch).
+
+    With `exact` vectors and a rescore `factor`, each batch fetches factor x k candidates
+    and ranks them exactly, as the server does for compressed indexes.
+    """
+    labels = []
+    start = time.perf_counter()
+    for i in range(0, len(queries), batch_size):
+        batch = queries[i:i + batch_size]
+        if exact is not None and factor:
+            labels.append(rescore(exact, batch, index.search(batch, k * factor, params=params)[1], k)[1])
+        else:
+            labels.append(index.search(batch, k, params=params)[1])
+    elapsed = time.perf_counter() - start
+    return np.vstack(labels), elapsed
+
+
+def benchmark(vectors: np.ndarray, queries: np.ndarray, factories: List[str], k: int = 10,
+              nprobes: List[int] = None, ef_searches: List[int] = None, batch_size: int = 1,
+              rescore_factors: List[int] = None) -> List[Dict[str, Any]]:
+    """
+    One result per (factory, search knobs, rescore factor).
+
+    `memory_mb` is the index held in RAM; with rescoring, `disk_mb` adds the float32
+    vectors, which are read through a memory map rather than loaded.
+    """
+    flat = faiss.IndexFlatIP(vectors.shape[1])
+    flat.add(vectors)
+    truth = flat.search(queries, k)[1]
+
+    exact = None
+    tmp_dir = tempfile.TemporaryDirectory()
+    if rescore_factors:
+        # Rescore from a memory-mapped copy, like a served DB directory
+        np.save(os.path.join(tmp_dir.name, "vectors.npy"), vectors)
+        exact = np.load(os.path.join(tmp_dir.name, "vectors.npy"), mmap_mode="r")
+
+    results = []
+    for factory in factories:
+        start = time.perf_counter()
+        index = create_index(vectors, factory)
+        index.add(vectors)
+        build_seconds = time.perf_counter() - start
+        memory_bytes = int(faiss.serialize_index(index).size)
+
+        base = unwrap(index)
+        if isinstance(base, faiss.IndexIVF):
+            sweep = [{'nprobe': nprobe} for nprobe in (nprobes or [1, 4, 16, 64])]
+            if isinstance(faiss.downcast_index(base.quantizer), faiss.IndexHNSW):
+                sweep = [dict(knobs, efSearch=ef) for knobs in sweep for ef in (ef_searches or [64])]
+        elif isinstance(base, faiss.IndexHNSW):
+            sweep = [{'efSearch': ef} for ef in (ef_searches or [16, 64, 256])]
+        else:
+            sweep = [{}]
+
+        for knobs in sweep:
+            params = search_parameters(index, nprobe=knobs.get('nprobe'), ef_search=knobs.get('efSearch'))
+            for factor in [None] + list(rescore_factors or []):
+                found, elapsed = timed_search(index, queries, k, params, batch_size, exact, factor)
+                result = {
+                    'factory': factory,
+                    **knobs,
+                    'rescore': factor,
+                    f'recall@{k}': round(recall_at_k(found, truth), 4),
+                    'qps': round(len(queries) / elapsed, 1),
+                    'build_seconds': round(build_seconds, 2),
+                    'memory_mb': round(memory_bytes / 2 ** 20, 2),
+                    'bytes_per_vector': round(memory_bytes / len(vectors), 1),
+                    'disk_mb': round((memory_bytes + (vectors.nbytes if factor else 0)) / 2 ** 20, 2),
+                }
+                logging.info(json.dumps(result))
+                results.append(result)
+    tmp_dir.cleanup()
+    return results
+
+
+def main(args: List[str] = None):
+    parser = argparse.ArgumentParser(description="Measure recall@k, QPS and memory of FAISS index configurations")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--db_file", help="Take vectors from an existing DB (directory or .pickle.gz)")
+    source.add_argument("--vectors", help="Take vectors from a .npy file of shape (n, dim)")
+    parser.add_argument("--synthetic", type=int, default=100000, help="Number of synthetic vectors when no source is given")
+    parser.add_argument("--dim", type=int, default=768, help="Dimension of synthetic vectors")
+    parser.add_argument("--queries", type=int, default=1000, help="Number of queries")
+    parser.add_argument("--k", type=int, default=10, help="Neighbours per query for recall@k")
+    parser.add_argument("--factories", nargs="+", default=DEFAULT_FACTORIES, help="FAISS factory strings to compare")
+    parser.add_argument("--nprobe", type=int, nargs="+", help="nprobe values to sweep for IVF indexes")
+    parser.add_argument("--ef_search", type=int, nargs="+", help="efSearch values to sweep for HNSW indexes")
+    parser.add_argument("--batch_size", type=int, default=1, help="Queries per index.search call")
+    parser.add_argument("--rescore", type=int, nargs="+",
+                        help="Also measure each configuration with factor x k candidates rescored against float32 vectors")
+    parser.add_argument("--threads", type=int, help="FAISS OpenMP threads")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    parsed = parser.parse_args(args)
+
+    if parsed.threads:
+        faiss.omp_set_num_threads(parsed.threads)
+    if parsed.db_file:
+        vectors = vectors_from_db(parsed.db_file)
+    elif parsed.vectors:
+        vectors = np.ascontiguousarray(np.load(parsed.vectors), dtype=np.float32)
+        faiss.normalize_L2(vectors)
+    else:
+        vectors = synthetic_vectors(parsed.synthetic, parsed.dim)
+    logging.info(f"Benchmarking {len(vectors)} vectors of dimension {vectors.shape[1]}")
+
+    queries = make_queries(vectors, parsed.queries)
+    results = benchmark(vectors, queries, parsed.factories, parsed.k, parsed.nprobe, parsed.ef_search, parsed.batch_size,
+                        parsed.rescore)
+    if parsed.output:
+        with open(parsed.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
@@ -0,0 +1,378 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import re
+import time
+from collections import deque
+from collections.abc import Sequence
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+
+# Typed fields of a catalogue record, in the key order of the TMDB records; anything else,
+# or a value of another type (a null popularity, say), is kept as JSON in the row's rest slot
+FIELDS = (
+    ("adult", "bool"),
+    ("backdrop_path", "text"),
+    ("genre_ids", "ints"),
+    ("id", "int"),
+    ("original_language", "text"),
+    ("original_title", "text"),
+    ("overview", "text"),
+    ("popularity", "float"),
+    ("poster_path", "text"),
+    ("release_date", "text"),
+    ("title", "text"),
+    ("video", "bool"),
+    ("vote_average", "float"),
+    ("vote_count", "int"),
+    ("annotations", "text"),
+)
+FIELD_NAMES = frozenset(name for name, _ in FIELDS)
+_FIELD_INDEX = {name: j for j, (name, _) in enumerate(FIELDS)}
+TEXT_FIELDS = [name for name, kind in FIELDS if kind == "text"]
+NUMBER_DTYPES = {"bool": np.int8, "int": np.int64, "float": np.float64}
+PYTHON_TYPES = {"text": str, "bool": bool, "int": int, "float": float}
+INT64 = (-2 ** 63, 2 ** 63 - 1)
+INT32 = (-2 ** 31, 2 ** 31 - 1)
+DEFAULT_CHUNK_BYTES = 8 * 2 ** 20
+DEFAULT_WORKERS = min(os.cpu_count() or 1, 8)
+# Below this size json.load is about twice as fast as compacting on one core (1.0s vs 2.0s for
+# 100k movies / 62 MB) and the dicts cost only ~50 MB more at peak; above it the dicts' memory
+# dominates (869 MB vs 490 MB peak for 400k movies / 248 MB)
+COMPACT_MIN_BYTES = 128 * 2 ** 20
+SEPARATOR = re.compile(r"\s*,\s*")
+_MISSING = object()
+
+
+def _fits(value: Any, kind: str) -> bool:
+    """Whether a field's value can be stored in its typed column; missing and off-type values go to the rest."""
+    if kind == "text":
+        return type(value) is str
+    if kind == "int":
+        return type(value) is int and INT64[0] <= value <= INT64[1]
+    if kind == "float":
+        return type(value) is float
+    if kind == "bool":
+        return type(value) is bool
+    return type(value) is list and all(type(v) is int and INT32[0] <= v <= INT32[1] for v in value)
+
+
+class CompactRecords(Sequence):
+    """
+    Catalogue records held as columns instead of one dict per movie.
+
+    Numeric and boolean fields are NumPy columns, `genre_ids` a flat int32 array with
+    row offsets, and every string of every row (plus a JSON "rest" holding fields outside
+    FIELDS) is a slice of one UTF-8 arena. Row i is rebuilt as a dict only when it is read,
+    so a search materializes just the movies it returns. Like `RecordStore`, it exposes
+    `ids` and `raw(i)`, so `RecordIndex` serves hits from it without a per-row copy.
+    """
+
+    def __init__(self, present: np.ndarray, numbers: Dict[str, np.ndarray], lists: Dict[str, Tuple[np.ndarray, np.ndarray]],
+                 arena: bytes, text_offsets: np.ndarray):
+        self.present = present
+        self.numbers = numbers
+        self.lists = lists
+        self.arena = arena
+        self.text_offsets = text_offsets
+        self._slots = len(TEXT_FIELDS) + 1
+        ids = numbers["id"]
+        self.ids = np.where(present[:, _FIELD_INDEX["id"]], ids, -1)
+
+    @classmethod
+    def from_records(cls, records: Iterable[Dict[str, Any]]) -> "CompactRecords":
+        records = records if isinstance(records, list) else list(records)
+        n = len(records)
+        present = np.zeros((n, len(FIELDS)), dtype=bool)
+        numbers, lists, texts = {}, {}, []
+        # Column at a time: one comprehension per field is far cheaper than a loop over fields per record
+        for j, (name, kind) in enumerate(FIELDS):
+            values = [record.get(name, _MISSING) for record in records]
+            if kind in PYTHON_TYPES:
+                python_type = PYTHON_TYPES[kind]
+                flags = [type(value) is python_type for value in values]
+                if kind == "int":
+                    flags = [fits and INT64[0] <= value <= INT64[1] for value, fits in zip(values, flags)]
+            else:
+                flags = [_fits(value, kind) for value in values]
+            present[:, j] = flags
+            if kind == "text":
+                texts.append([value if fits else "" for value, fits in zip(values, flags)])
+            elif kind == "ints":
+                kept = [value if fits else () for value, fits in zip(values, flags)]
+                lengths = np.fromiter(map(len, kept), dtype=np.int64, count=n)
+                lists[name] = (np.fromiter(chain.from_iterable(kept), dtype=np.int32, count=int(lengths.sum())),
+                               np.concatenate(([0], np.cumsum(lengths))))
+            else:
+                numbers[name] = np.array([value if fits else 0 for value, fits in zip(values, flags)],
+                                         dtype=NUMBER_DTYPES[kind])
+
+        # Every typed value is a key of its record, so a record with more keys than typed values has a rest
+        rest = [""] * n
+        sizes = np.fromiter(map(len, records), dtype=np.int64, count=n)
+        for i in np.flatnonzero(sizes > present.sum(axis=1)):
+            flags = present[i]
+            extra = {key: value for key, value in records[i].items()
+                     if key not in FIELD_NAMES or not flags[_FIELD_INDEX[key]]}
+            rest[i] = json.dumps(extra, separators=(",", ":"))
+        texts.append(rest)
+
+        # surrogatepass: JSON may carry lone surrogates, which strict UTF-8 rejects
+        encoded = [text.encode("utf-8", "surrogatepass") for row in zip(*texts) for text in row]
+        lengths = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+        return cls(present, numbers, lists, b"".join(encoded), np.concatenate(([0], np.cumsum(lengths))))
+
+    @classmethod
+    def concat(cls, parts: List["CompactRecords"]) -> "CompactRecords":
+        if len(parts) == 1:
+            return parts[0]
+        if not parts:
+            return cls.from_records([])
+        arena_starts = np.cumsum([0] + [len(part.arena) for part in parts[:-1]])
+        text_offsets = [np.zeros(1, dtype=np.int64)] + [part.text_offsets[1:] + start
+                                                         for part, start in zip(parts, arena_starts)]
+        lists = {}
+        for name in parts[0].lists:
+            list_starts = np.cumsum([0] + [len(part.lists[name][0]) for part in parts[:-1]])
+            lists[name] = (np.concatenate([part.lists[name][0] for part in parts]),
+                           np.concatenate([np.zeros(1, dtype=np.int64)] +
+                                          [part.lists[name][1][1:] + start for part, start in zip(parts, list_starts)]))
+        return cls(
+            np.concatenate([part.present for part in parts]),
+            {name: np.concatenate([part.numbers[name] for part in parts]) for name in parts[0].numbers},
+            lists,
+            b"".join(part.arena for part in parts),
+            np.concatenate(text_offsets),
+        )
+
+    def __len__(self) -> int:
+        return len(self.present)
+
+    def has(self, name: str) -> np.ndarray:
+        """Whether each row has the field `name`, from the columns and only the rows that carry a JSON rest."""
+        mask = self.present[:, _FIELD_INDEX[name]].copy() if name in FIELD_NAMES else np.zeros(len(self), dtype=bool)
+        rest_slot = len(TEXT_FIELDS)
+        starts = self.text_offsets[rest_slot:-1:self._slots]
+        ends = self.text_offsets[rest_slot + 1::self._slots]
+        for i in np.flatnonzero((ends > starts) & ~mask):
+            mask[i] = name in json.loads(self._text(i * self._slots + rest_slot))
+        return mask
+
+    def _text(self, slot: int) -> str:
+        return self.arena[self.text_offsets[slot]:self.text_offsets[slot + 1]].decode("utf-8", "surrogatepass")
+
+    def row(self, i: int) -> Dict[str, Any]:
+        present = self.present[i]
+        slot = i * self._slots
+        rest = self._text(slot + len(TEXT_FIELDS))
+        rest = json.loads(rest) if rest else {}
+        record = {}
+        for j, (name, kind) in enumerate(FIELDS):
+            if not present[j]:
+                if name in rest:
+                    # An off-type value keeps its place among the typed fields
+                    record[name] = rest.pop(name)
+            elif kind == "text":
+                record[name] = self._text(slot)
+            elif kind == "ints":
+                values, offsets = self.lists[name]
+                record[name] = values[offsets[i]:offsets[i + 1]].tolist()
+            elif kind == "bool":
+                record[name] = bool(self.numbers[name][i])
+            else:
+                record[name] = self.numbers[name][i].item()
+            slot += kind == "text"
+        record.update(rest)
+        return record
+
+    def raw(self, i: int) -> bytes:
+        return json.dumps(self.row(i), separators=(",", ":")).encode("utf-8")
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.row(i)
+
+    @property
+    def nbytes(self) -> int:
+        return (self.present.nbytes + sum(column.nbytes for column in self.numbers.values()) +
+                sum(values.nbytes + offsets.nbytes for values, offsets in self.lists.values()) +
+                len(self.arena) + self.text_offsets.nbytes + self.ids.nbytes)
+
+
+def _parse_lines(data: bytes) -> List[Dict[str, Any]]:
+    records = []
+    for line in data.decode("utf-8").splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError:
+            logging.warning(f"Skipping malformed catalogue line: {line[:80]}")
+    return records
+
+
+def parse_chunk(data: bytes, ndjson: bool) -> CompactRecords:
+    """Compact the whole records in one chunk: NDJSON lines, or array elements without the brackets."""
+    if ndjson:
+        return CompactRecords.from_records(_parse_lines(data))
+    text = data.decode("utf-8").strip().lstrip(",")
+    return CompactRecords.from_records(json.loads(f"[{text}]") if text else [])
+
+
+def _array_chunks(f, chunk_bytes: int) -> Iterator[bytes]:
+    """
+    Split a JSON array of objects into pieces holding whole elements.
+
+    The text between the first two elements gives the separator, and the array is cut
+    only where "}" + separator + "{" occurs. Quotes inside strings are escaped, so this never
+    falls inside a string; a nested list of objects written the same way could still
+    match, which the caller detects because that piece then fails to parse.
+    """
+    buffer = f.read(chunk_bytes).lstrip()
+    if not buffer.startswith(b"["):
+        raise ValueError("Catalogue is neither a JSON array nor NDJSON")
+    buffer = buffer[1:]
+    decoder = json.JSONDecoder()
+    marker = None
+    while True:
+        text = buffer.decode("utf-8", errors="ignore")
+        start = len(text) - len(text.lstrip())
+        if text[start:start + 1] == "]":
+            return
+        try:
+            _, end = decoder.raw_decode(text, start)
+        except json.JSONDecodeError:
+            block = f.read(chunk_bytes)
+            if not block:
+                raise
+            buffer += block
+            continue
+        separator = SEPARATOR.match(text, end)
+        if separator and separator.end() < len(text):
+            if text[separator.end()] == "{":
+                marker = ("}" + separator.group(0) + "{").encode("utf-8")
+            break
+        if text[end:].strip().startswith("]"):
+            break
+        block = f.read(chunk_bytes)
+        if not block:
+            break
+        buffer += block
+
+    while marker is not None:
+        cut = buffer.rfind(marker)
+        if cut >= 0 and len(buffer) >= chunk_bytes:
+            yield buffer[:cut + 1]
+            buffer = buffer[cut + 1:]
+        block = f.read(chunk_bytes)
+        if not block:
+            break
+        buffer += block
+    while True:
+        block = f.read(chunk_bytes)
+        if not block:
+            break
+        buffer += block
+    buffer = buffer.rstrip()
+    if not buffer.endswith(b"]"):
+        raise ValueError("Catalogue JSON array is not closed")
+    yield buffer[:-1]
+
+
+def _ndjson_chunks(f, chunk_bytes: int) -> Iterator[bytes]:
+    buffer = b""
+    while True:
+        block = f.read(chunk_bytes)
+        if not block:
+            break
+        buffer += block
+        cut = buffer.rfind(b"\n")
+        if cut >= 0:
+            yield buffer[:cut + 1]
+            buffer = buffer[cut + 1:]
+    if buffer.strip():
+        yield buffer
+
+
+def load_catalogue(path: str, workers: Optional[int] = None, chunk_bytes: int = DEFAULT_CHUNK_BYTES,
+                   compact: Optional[bool] = None) -> Union[CompactRecords, List[Dict[str, Any]]]:
+    """
+    Read a catalogue (JSON array, or NDJSON when the name ends in .ndjson).
+
+    A file of at least COMPACT_MIN_BYTES (or any file with `compact`) is read into
+    `CompactRecords`: in `chunk_bytes` pieces cut at record boundaries, parsed and
+    compacted on `workers` processes when there is more than one piece, at most two pieces
+    per worker in flight, so neither the text nor a dict per record is ever held whole.
+    A smaller file is parsed in one go into a list of dicts, which is faster.
+    """
+    start = time.perf_counter()
+    ndjson = path.endswith(".ndjson")
+    if compact is None:
+        compact = os.path.getsize(path) >= COMPACT_MIN_BYTES
+    if not compact:
+        records = _read_records(path, ndjson)
+        logging.info(f"Loaded {len(records)} catalogue records from {path} in {time.perf_counter() - start:.1f}s")
+        return records
+    workers = workers or DEFAULT_WORKERS
+    try:
+        records = _load_chunks(path, ndjson, workers, chunk_bytes)
+    except json.JSONDecodeError:
+        if ndjson:
+            raise
+        logging.warning(f"Could not split {path} at record boundaries; parsing it in one piece")
+        records = CompactRecords.from_records(_read_records(path, ndjson))
+    logging.info(f"Loaded {len(records)} catalogue records from {path} in {time.perf_counter() - start:.1f}s "
+                 f"({records.nbytes / 2 ** 20:.1f} MB compact)")
+    return records
+
+
+def _read_records(path: str, ndjson: bool) -> List[Dict[str, Any]]:
+    if not ndjson:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    with open(path, "rb") as f:
+        return [record for chunk in _ndjson_chunks(f, DEFAULT_CHUNK_BYTES) for record in _parse_lines(chunk)]
+
+
+def _load_chunks(path: str, ndjson: bool, workers: int, chunk_bytes: int) -> CompactRecords:
+    with open(path, "rb") as f:
+        chunks = _ndjson_chunks(f, chunk_bytes) if ndjson else _array_chunks(f, chunk_bytes)
+        if workers <= 1 or os.path.getsize(path) <= chunk_bytes:
+            return CompactRecords.concat([parse_chunk(chunk, ndjson) for chunk in chunks])
+        parts = []
+        # spawn: the caller may already run FAISS or HTTP threads, which fork would copy mid-flight
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.submit(parse_chunk, chunk, ndjson))
+                if len(pending) >= 2 * workers:
+                    parts.append(pending.popleft().result())
+            parts.extend(future.result() for future in pending)
+        return CompactRecords.concat(parts)
+
+
+def main(args: List[str] = None):
+    parser = argparse.ArgumentParser(description="Load a movie catalogue into the compact record layout and report its size")
+    parser.add_argument("path", help="Catalogue JSON array or .ndjson file")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Parsing processes")
+    parser.add_argument("--chunk_mb", type=float, default=DEFAULT_CHUNK_BYTES / 2 ** 20, help="Bytes per parsed piece, in MB")
+    parsed = parser.parse_args(args)
+    records = load_catalogue(parsed.path, parsed.workers, int(parsed.chunk_mb * 2 ** 20), compact=True)
+    print(json.dumps({"records": len(records), "compact_mb": round(records.nbytes / 2 ** 20, 1),
+                      "file_mb": round(os.path.getsize(parsed.path) / 2 ** 20, 1)}))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
@@ -0,0 +1,282 @@
+import argparse
+import gzip
+import json
+import logging
+import os
+import pickle
+import shutil
+from collections.abc import Sequence
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import faiss
+import numpy as np
+
+from util.catalogue import load_catalogue
+
+FORMAT_VERSION = 1
+INDEX_FILE = "index.faiss"
+MANIFEST_FILE = "manifest.npz"
+META_FILE = "meta.json"
+VECTORS_FILE = "vectors.npy"
+MMAP_FLAGS = faiss.IO_FLAG_MMAP | getattr(faiss, "IO_FLAG_MMAP_IFC", 0) | faiss.IO_FLAG_READ_ONLY
+# IVF inverted lists are mapped as OnDiskInvertedLists straight from the index file, which the
+# in-place code mapping (IO_FLAG_MMAP_IFC) cannot be combined with
+IVF_MMAP_FLAGS = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+
+
+class OffsetStore(Sequence):
+    """
+    Variable-length byte rows packed into `<name>.bin` with row offsets in `<name>.idx.npy`.
+
+    Both files are memory-mapped read-only, so opening a store is O(1) and processes
+    that open the same files share their pages through the OS cache.
+    """
+
+    def __init__(self, path: str):
+        self._offsets = np.load(f"{path}.idx.npy", mmap_mode="r")
+        if self._offsets[-1] > 0:
+            self._data = np.memmap(f"{path}.bin", dtype=np.uint8, mode="r")
+        else:
+            self._data = np.zeros(0, dtype=np.uint8)  # mmap refuses empty files
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def row(self, i: int) -> bytes:
+        return self._data[self._offsets[i]:self._offsets[i + 1]].tobytes()
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.row(i)
+
+    @staticmethod
+    def write(path: str, rows: Iterable[bytes]):
+        offsets = [0]
+        with open(f"{path}.bin", "wb") as f:
+            for row in rows:
+                f.write(row)
+                offsets.append(offsets[-1] + len(row))
+        np.save(f"{path}.idx.npy", np.array(offsets, dtype=np.uint64))
+
+
+class DocumentStore(OffsetStore):
+    """`documents` as stored on disk: row i is (text, ref) for FAISS id i, or None for a removed id."""
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self._refs = np.load(f"{path}.refs.npy", mmap_mode="r")
+
+    def row(self, i: int) -> Optional[Tuple[str, int]]:
+        ref = int(self._refs[i])
+        if ref < 0:
+            return None
+        return super().row(i).decode("utf-8"), ref
+
+    @staticmethod
+    def write(path: str, documents: Sequence):
+        OffsetStore.write(path, (doc[0].encode("utf-8") if doc is not None else b"" for doc in documents))
+        np.save(f"{path}.refs.npy", np.array([doc[1] if doc is not None else -1 for doc in documents], dtype=np.int64))
+
+
+class RecordStore(OffsetStore):
+    """Original movie records, one JSON object per row, decoded only when a row is read."""
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        ids_file = f"{path}.ids.npy"
+        self.ids = np.load(ids_file, mmap_mode="r") if os.path.exists(ids_file) else None
+
+    def raw(self, i: int) -> bytes:
+        return super().row(i)
+
+    def row(self, i: int) -> Dict[str, Any]:
+        return json.loads(super().row(i))
+
+    @staticmethod
+    def write(path: str, records: Iterable[Dict[str, Any]]):
+        ids = []
+
+        def rows():
+            for record in records:
+                ids.append(record.get('id', -1))
+                yield json.dumps(record, separators=(",", ":")).encode("utf-8")
+
+        OffsetStore.write(path, rows())
+        np.save(f"{path}.ids.npy", np.array(ids, dtype=np.int64))
+
+
+def is_store(db_path: str) -> bool:
+    return os.path.isdir(db_path)
+
+
+def is_ivf(index: Any) -> bool:
+    return faiss.try_extract_index_ivf(index) is not None
+
+
+def read_index(db_path: str, mmap: bool = True, ivf: Optional[bool] = None) -> Any:
+    """
+    Read the FAISS index of a DB directory, memory-mapped when `mmap`.
+
+    `ivf` (recorded in meta.json at save time) picks the mmap flags; for stores saved
+    before it was recorded (None) both flag sets are tried.
+    """
+    index_file = os.path.join(db_path, INDEX_FILE)
+    if not mmap:
+        return faiss.read_index(index_file)
+    candidates = {None: (MMAP_FLAGS, IVF_MMAP_FLAGS), False: (MMAP_FLAGS,), True: (IVF_MMAP_FLAGS,)}[ivf]
+    for flags in candidates:
+        try:
+            return faiss.read_index(index_file, flags)
+        except RuntimeError as e:
+            error = e
+    logging.warning(f"Cannot memory-map {index_file} ({str(error)}); reading it into memory instead")
+    return faiss.read_index(index_file)
+
+
+def open_records(db_path: str) -> Optional[RecordStore]:
+    """The lazily-read movie records of a DB directory, or None if it was saved without them."""
+    records_path = os.path.join(db_path, "records")
+    if not is_store(db_path) or not os.path.exists(f"{records_path}.idx.npy"):
+        return None
+    return RecordStore(records_path)
+
+
+def open_store(db_path: str, mmap: bool = True) -> Dict[str, Any]:
+    """
+    Open a DB directory; returns documents, index, records (or None), manifest (or None),
+    extras, a dict of named array bundles built alongside the index, and vectors, the
+    full-precision float32 vectors by FAISS id (memory-mapped when `mmap`), or None.
+    """
+    with open(os.path.join(db_path, META_FILE), "r") as f:
+        meta = json.load(f)
+    if meta.get('version') != FORMAT_VERSION:
+        raise ValueError(f"Unsupported DB format version {meta.get('version')} in {db_path}")
+
+    manifest = None
+    manifest_file = os.path.join(db_path, MANIFEST_FILE)
+    if os.path.exists(manifest_file):
+        with np.load(manifest_file) as data:
+            manifest = {'movie_ids': data['movie_ids'], 'hashes': data['hashes']}
+
+    extras = {}
+    for name in meta.get('extras', []):
+        with np.load(os.path.join(db_path, f"{name}.npz")) as data:
+            extras[name] = {key: data[key] for key in data.files}
+
+    vectors = None
+    if meta.get('vectors'):
+        vectors = np.load(os.path.join(db_path, VECTORS_FILE), mmap_mode="r" if mmap else None)
+
+    return {
+        'documents': DocumentStore(os.path.join(db_path, "documents")),
+        'index': read_index(db_path, mmap, meta.get('ivf')),
+        'records': open_records(db_path) if meta.get('records') else None,
+        'manifest': manifest,
+        'extras': extras,
+        'vectors': vectors,
+    }
+
+
+def save_store(db_path: str, documents: Sequence, index: Any, records: Optional[Iterable[Dict[str, Any]]] = None,
+               manifest: Optional[Dict[str, np.ndarray]] = None, extras: Optional[Dict[str, Dict[str, np.ndarray]]] = None,
+               vectors: Optional[np.ndarray] = None):
+    """
+    Write a DB directory next to `db_path` and swap it into place.
+
+    `vectors`, one float32 row per FAISS id, are kept next to a compressed index so
+    its candidates can be rescored exactly; they are read through a memory map.
+
+    Readers that still have the previous generation mapped keep working on the
+    unlinked files until they reopen the store.
+    """
+    tmp_path = f"{db_path.rstrip(os.sep)}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    faiss.write_index(index, os.path.join(tmp_path, INDEX_FILE))
+    DocumentStore.write(os.path.join(tmp_path, "documents"), documents)
+    if records is not None:
+        RecordStore.write(os.path.join(tmp_path, "records"), records)
+    if manifest is not None:
+        np.savez(os.path.join(tmp_path, MANIFEST_FILE), **manifest)
+    for name, arrays in (extras or {}).items():
+        np.savez(os.path.join(tmp_path, f"{name}.npz"), **arrays)
+    if vectors is not None:
+        np.save(os.path.join(tmp_path, VECTORS_FILE), np.asarray(vectors, dtype=np.float32))
+    with open(os.path.join(tmp_path, META_FILE), "w") as f:
+        json.dump({'version': FORMAT_VERSION, 'documents': len(documents), 'records': records is not None,
+                   'ntotal': int(index.ntotal), 'dim': int(index.d), 'ivf': is_ivf(index), 'extras': sorted(extras or {}),
+                   'vectors': vectors is not None}, f)
+
+    old_path = f"{db_path.rstrip(os.sep)}.old"
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.exists(db_path):
+        os.replace(db_path, old_path)
+    os.replace(tmp_path, db_path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+def read_db(db_path: str, mmap: bool = True) -> Dict[str, Any]:
+    """Read either a DB directory or a legacy gzip pickle into the same shape as `open_store`."""
+    if is_store(db_path):
+        return open_store(db_path, mmap)
+    with gzip.open(db_path, "rb") as f:
+        data = pickle.load(f)
+    return {
+        'documents': data['documents'],
+        'index': faiss.deserialize_index(data['index']),
+        'records': None,
+        'manifest': data.get('manifest'),
+        'extras': data.get('extras', {}),
+        'vectors': None,
+    }
+
+
+def write_db(db_path: str, documents: Sequence, index: Any, records: Optional[Iterable[Dict[str, Any]]] = None,
+             manifest: Optional[Dict[str, np.ndarray]] = None, extras: Optional[Dict[str, Dict[str, np.ndarray]]] = None,
+             vectors: Optional[np.ndarray] = None):
+    """Write `db_path` as a DB directory, or as a legacy gzip pickle when the path ends in .gz."""
+    if not db_path.endswith(".gz"):
+        save_store(db_path, documents, index, records, manifest, extras, vectors)
+        return
+    if vectors is not None:
+        logging.warning(f"Full-precision vectors can only be memory-mapped from a DB directory; not storing them in {db_path}")
+    data = {'documents': list(documents), 'index': faiss.serialize_index(index)}
+    if manifest is not None:
+        data['manifest'] = manifest
+    if extras:
+        data['extras'] = extras
+    tmp_file = f"{db_path}.tmp"
+    with gzip.open(tmp_file, "wb") as f:
+        pickle.dump(data, f)
+    os.replace(tmp_file, db_path)
+
+
+def convert(pickle_file: str, db_path: str, json_file: Optional[str] = None):
+    """One-shot conversion of a gzip-pickle DB (plus, optionally, the catalogue) into a DB directory."""
+    data = read_db(pickle_file, mmap=False)
+    records = None
+    if json_file:
+        records = load_catalogue(json_file)
+    save_store(db_path, data['documents'], data['index'], records, data['manifest'], data['extras'])
+    logging.info(f"Converted {pickle_file} to {db_path}: {len(data['documents'])} documents, "
+                 f"{data['index'].ntotal} vectors, {len(records) if records is not None else 0} records")
+
+
+def main(args: List[str] = None):
+    parser = argparse.ArgumentParser(description="Convert a gzip-pickle movie DB into the memory-mappable layout")
+    parser.add_argument("pickle_file", help="Existing .pickle.gz database")
+    parser.add_argument("db_path", help="Output DB directory")
+    parser.add_argument("--json_file", help="Catalogue JSON to store alongside the index as lazily-read records")
+    parsed = parser.parse_args(args)
+    convert(parsed.pickle_file, parsed.db_path, parsed.json_file)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
@@ -0,0 +1,432 @@
+import argparse
+import itertools
+import json
+import logging
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+import numpy as np
+import requests
+
+from util.db_store import META_FILE
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_SIZES = [10000]
+DEFAULT_CONCURRENCY = [1, 4, 16]
+GENRE_IDS = [12, 14, 16, 18, 27, 28, 35, 36, 37, 53, 80, 99, 878, 9648, 10402, 10749, 10751, 10752, 10770]
+LANGUAGES = ["en", "fr", "es", "ja", "ko", "de", "it", "hi"]
+LANGUAGE_WEIGHTS = [0.6, 0.08, 0.08, 0.07, 0.05, 0.05, 0.04, 0.03]
+ANNOTATED_SHARE = 0.25  # movies given an LLM-style annotation, so the build has facets to index
+CONSONANTS = "bcdfghjklmnprstvz"
+VOWELS = "aeiou"
+
+
+def vocabulary(size: int) -> List[str]:
+    """Pronounceable pseudo-words, the same for a given size on every machine."""
+    syllables = [c + v for c in CONSONANTS for v in VOWELS]
+    words = []
+    for length in itertools.count(2):
+        for parts in itertools.product(syllables, repeat=length):
+            words.append("".join(parts))
+            if len(words) == size:
+                return words
+
+
+def zipf_words(rng: np.random.Generator, words: List[str], n: int) -> List[str]:
+    """`n` words with a Zipf-like frequency, so BM25 and the embeddings see common and rare terms."""
+    ranks = np.minimum(rng.zipf(1.3, n), len(words)) - 1
+    return [words[rank] for rank in ranks]
+
+
+def synthetic_catalogue(n: int, seed: int = 0, vocab_size: int = 20000) -> Iterator[Dict[str, Any]]:
+    """Movie records shaped like all_movies.json, generated one at a time."""
+    rng = np.random.default_rng(seed)
+    annotation_rng = np.random.default_rng(seed + 1)  # separate, so the rest of the records don't depend on it
+    words = vocabulary(vocab_size)
+    for i in range(n):
+        title = " ".join(zipf_words(rng, words, int(rng.integers(1, 5)))).title()
+        movie = {
+            "adult": False,
+            "backdrop_path": f"/backdrop{i}.jpg",
+            "genre_ids": sorted(set(rng.choice(GENRE_IDS, int(rng.integers(1, 4))).tolist())),
+            "id": i + 1,
+            "original_language": str(rng.choice(LANGUAGES, p=LANGUAGE_WEIGHTS)),
+            "original_title": title,
+            "overview": " ".join(zipf_words(rng, words, int(rng.integers(20, 80)))).capitalize() + ".",
+            "popularity": round(float(rng.lognormal(2.0, 1.2)), 3),
+            "poster_path": f"/poster{i}.jpg",
+            "release_date": f"{int(rng.integers(1920, 2025))}-{int(rng.integers(1, 13)):02d}-{int(rng.integers(1, 29)):02d}",
+            "title": title,
+            "video": False,
+            "vote_average": round(float(rng.uniform(1, 10)), 1),
+            "vote_count": int(rng.integers(0, 20000)),
+        }
+        if annotation_rng.random() < ANNOTATED_SHARE:
+            movie["annotations"] = "\n".join(f"- {label}: {' '.join(zipf_words(annotation_rng, words, 8)).capitalize()}."
+                                             for label in ("Theme", "Setting", "Mood", "Genre"))
+        yield movie
+
+
+def write_catalogue(json_file: str, n: int, seed: int = 0) -> Dict[str, Any]:
+    """Write a synthetic catalogue as one JSON array without holding it in memory."""
+    start = time.perf_counter()
+    with open(json_file, "w") as f:
+        f.write("[")
+        for i, movie in enumerate(synthetic_catalogue(n, seed)):
+            f.write(("," if i else "") + json.dumps(movie))
+        f.write("]")
+    return {"movies": n, "json_mb": round(os.path.getsize(json_file) / 2 ** 20, 1),
+            "generate_seconds": round(time.perf_counter() - start, 2)}
+
+
+def make_queries(n: int, seed: int, vocab_size: int = 20000) -> List[str]:
+    """Distinct queries from the catalogue's vocabulary; a new `seed` gives queries the server has not cached."""
+    rng = np.random.default_rng(seed)
+    words = vocabulary(vocab_size)
+    return [" ".join(zipf_words(rng, words, int(rng.integers(2, 7)))) for _ in range(n)]
+
+
+def configure(server: Any, api_base: str, factory: Optional[str] = None, embed_workers: Optional[int] = None):
+    """Point an imported vector_db_flask at the stub and keep its query cache in memory."""
+    from util.embedding_cache import EmbeddingCache
+    from util.rerank import Reranker
+
+    server.API_URLS.update({name: f"{api_base}/api/{name}" for name in ("generate", "embeddings", "chat")})
+    if factory:
+        server.INDEX["factory"] = factory
+    if embed_workers:
+        server.EMBEDDING_CLIENT["workers"] = embed_workers
+    server.query_cache = EmbeddingCache(**{**server.QUERY_CACHE, "disk_path": None})
+    server.reranker = Reranker(server.API_URLS["generate"], server.MODELS["rerank"], **server.RERANKER)
+
+
+def directory_mb(path: str) -> float:
+    if not os.path.isdir(path):
+        return round(os.path.getsize(path) / 2 ** 20, 1)
+    return round(sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path)
+                     for name in names) / 2 ** 20, 1)
+
+
+def build(json_file: str, db_file: str, api_base: str, factory: Optional[str] = None,
+          embed_workers: Optional[int] = None) -> Dict[str, Any]:
+    """Time `create_and_save_db` against the stub; runs in its own process so its peak RSS is its own."""
+    import vector_db_flask as server
+
+    configure(server, api_base, factory, embed_workers)
+    start = time.perf_counter()
+    server.create_and_save_db(json_file, db_file)
+    seconds = time.perf_counter() - start
+    with open(os.path.join(db_file, META_FILE), "r") as f:
+        movies = json.load(f)['documents']
+    return {
+        "seconds": round(seconds, 2),
+        "movies_per_second": round(movies / seconds, 1),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "db_mb": directory_mb(db_file),
+        "factory": server.INDEX["factory"],
+    }
+
+
+def serve(db_file: str, json_file: str, port: int, api_base: str, kind: str = "flask"):
+    """Run the Flask or aiohttp server on `db_file` with its upstream calls going to the stub."""
+    import vector_db_flask as server
+
+    configure(server, api_base)
+    generations = server.open_generations(db_file, json_file)
+    if kind == "async":
+        from aiohttp import web
+        import vector_db_async
+
+        web.run_app(vector_db_async.create_app(generations), host="127.0.0.1", port=port, print=None)
+    else:
+        server.generations = generations
+        server.app.run(host="127.0.0.1", port=port, threaded=True)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def rss_mb(pid: int) -> Optional[float]:
+    """Resident set size of a process from /proc, or None where that is not available."""
+    try:
+        with open(f"/proc/{pid}/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def spawn(args: List[str], workdir: str, log_name: str) -> subprocess.Popen:
+    """Start `python -m <args>` with this repository importable, logging to a file in `workdir`."""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_DIR, os.environ.get("PYTHONPATH")])))
+    log = open(os.path.join(workdir, log_name), "ab")
+    return subprocess.Popen([sys.executable, "-m", *args], cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def wait_until_ready(process: subprocess.Popen, ready, timeout: float, what: str) -> float:
+    """Seconds until `ready()` returns True; raises if the process exits or the timeout passes first."""
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        if process.poll() is not None:
+            raise RuntimeError(f"{what} exited with status {process.returncode} before it was ready")
+        try:
+            if ready():
+                return time.perf_counter() - start
+        except (OSError, requests.RequestException):
+            pass
+        time.sleep(0.05)
+    raise TimeoutError(f"{what} was not ready after {timeout}s")
+
+
+def port_open(port: int) -> bool:
+    with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+        return True
+
+
+def percentile_ms(values: List[float], q: float) -> Optional[float]:
+    return round(float(np.percentile(values, q)) * 1000, 2) if values else None
+
+
+def drive(url: str, bodies: List[Dict], concurrency: int, stream: bool = False, timeout: float = 300) -> Dict[str, Any]:
+    """
+    Send `bodies` to `url` from `concurrency` threads, each with its own keep-alive session.
+
+    With `stream`, the response is read line by line and the time to its first non-empty
+    line is reported as time to first byte.
+    """
+    latencies, first_bytes = [], []
+    errors = 0
+    lock = threading.Lock()
+    pending = iter(bodies)
+
+    def worker():
+        nonlocal errors
+        session = requests.Session()
+        while True:
+            with lock:
+                body = next(pending, None)
+            if body is None:
+                return
+            start = time.perf_counter()
+            first = None
+            try:
+                with session.post(url, json=body, stream=stream, timeout=timeout) as response:
+                    response.raise_for_status()
+                    if stream:
+                        for line in response.iter_lines():
+                            if line and first is None:
+                                first = time.perf_counter() - start
+                    else:
+                        response.content
+            except requests.RequestException:
+                with lock:
+                    errors += 1
+                continue
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                if first is not None:
+                    first_bytes.append(first)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+
+    result = {
+        "concurrency": concurrency,
+        "requests": len(bodies),
+        "errors": errors,
+        "seconds": round(seconds, 3),
+        "qps": round(len(latencies) / seconds, 1) if seconds > 0 else None,
+        "mean_ms": round(float(np.mean(latencies)) * 1000, 2) if latencies else None,
+        "p50_ms": percentile_ms(latencies, 50),
+        "p90_ms": percentile_ms(latencies, 90),
+        "p99_ms": percentile_ms(latencies, 99),
+    }
+    if stream:
+        result.update({"ttfb_p50_ms": percentile_ms(first_bytes, 50), "ttfb_p99_ms": percentile_ms(first_bytes, 99)})
+    return result
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_size(n: int, parsed: argparse.Namespace, workdir: str, api_base: str) -> Dict[str, Any]:
+    """Catalogue, build, startup and load figures for one catalogue size."""
+    result = {"movies": n}
+    json_file = os.path.join(workdir, f"movies_{n}.json")
+    db_file = os.path.join(workdir, f"movies_{n}_db")
+    result["catalogue"] = write_catalogue(json_file, n, parsed.seed)
+    logging.info(f"Wrote {n} synthetic movies to {json_file}")
+
+    build_file = os.path.join(workdir, f"build_{n}.json")
+    build_args = ["util.e2e_bench", "build", "--json_file", json_file, "--db_file", db_file, "--api_base", api_base,
+                  "--output", build_file]
+    if parsed.factory:
+        build_args += ["--factory", parsed.factory]
+    if parsed.embed_workers:
+        build_args += ["--embed_workers", str(parsed.embed_workers)]
+    process = spawn(build_args, workdir, f"build_{n}.log")
+    if process.wait() != 0:
+        raise RuntimeError(f"Building the {n}-movie DB failed; see {os.path.join(workdir, f'build_{n}.log')}")
+    with open(build_file, "r") as f:
+        result["build"] = json.load(f)
+    logging.info(f"Built the {n}-movie DB: {json.dumps(result['build'])}")
+
+    port = free_port()
+    process = spawn(["util.e2e_bench", "serve", "--db_file", db_file, "--json_file", json_file, "--port", str(port),
+                     "--api_base", api_base, "--server", parsed.server], workdir, f"serve_{n}.log")
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        startup = wait_until_ready(process, lambda: requests.get(f"{base_url}/metrics", timeout=1).ok,
+                                   parsed.startup_timeout, f"The {parsed.server} server")
+        result["server"] = {"kind": parsed.server, "startup_seconds": round(startup, 2), "rss_mb_started": rss_mb(process.pid)}
+        logging.info(f"{parsed.server} server up in {startup:.2f}s")
+
+        search_body = {"mode": parsed.mode, "top_k": parsed.top_k, "rerank": parsed.rerank}
+        drive(f"{base_url}/search", [dict(search_body, query=q) for q in make_queries(parsed.warmup, seed=10 ** 6)], 1)
+        result["search"] = []
+        for level, concurrency in enumerate(parsed.concurrency):
+            queries = make_queries(max(parsed.requests, concurrency), seed=level + 1)
+            stats = drive(f"{base_url}/search", [dict(search_body, query=q) for q in queries], concurrency)
+            logging.info(f"/search: {json.dumps(stats)}")
+            result["search"].append(stats)
+
+        facet_body = {"mode": "facets", "top_k": parsed.top_k}
+        result["facets"] = []
+        for level, concurrency in enumerate(parsed.facet_concurrency):
+            queries = make_queries(max(parsed.facet_requests, concurrency), seed=2000 + level)
+            stats = drive(f"{base_url}/search", [dict(facet_body, query=q) for q in queries], concurrency)
+            logging.info(f"/search facets: {json.dumps(stats)}")
+            result["facets"].append(stats)
+
+        result["chat"] = []
+        for level, concurrency in enumerate(parsed.chat_concurrency):
+            queries = make_queries(max(parsed.chat_requests, concurrency), seed=1000 + level)
+            bodies = [{"messages": [{"role": "user", "content": q}], "rag": parsed.rag} for q in queries]
+            stats = drive(f"{base_url}/chat", bodies, concurrency, stream=True)
+            logging.info(f"/chat: {json.dumps(stats)}")
+            result["chat"].append(stats)
+        result["server"]["rss_mb_after"] = rss_mb(process.pid)
+    finally:
+        process.terminate()
+        process.wait()
+    return result
+
+
+def run(parsed: argparse.Namespace) -> Dict[str, Any]:
+    workdir = parsed.workdir or tempfile.mkdtemp(prefix="gptrex-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    stub_port = parsed.stub_port or free_port()
+    stub = spawn(["util.stub_ollama", "--port", str(stub_port), "--dim", str(parsed.dim),
+                  "--embed_latency", str(parsed.embed_latency), "--generate_latency", str(parsed.generate_latency),
+                  "--chat_ttfb", str(parsed.chat_ttfb), "--token_latency", str(parsed.token_latency),
+                  "--tokens", str(parsed.tokens)], workdir, "stub.log")
+    results = {"commit": git_commit(), "started_at": round(time.time(), 3), "settings": vars(parsed), "runs": []}
+    try:
+        wait_until_ready(stub, lambda: port_open(stub_port), 30, "The stub Ollama server")
+        for n in parsed.movies:
+            results["runs"].append(bench_size(n, parsed, workdir, f"http://127.0.0.1:{stub_port}"))
+    finally:
+        stub.terminate()
+        stub.wait()
+    logging.info(f"Benchmark files and logs are in {workdir}")
+    return results
+
+
+def write_json(result: Any, output: Optional[str]):
+    if output:
+        with open(output, "w") as f:
+            json.dump(result, f, indent=2)
+    else:
+        print(json.dumps(result, indent=2))
+
+
+def main(args: List[str] = None):
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of building and serving the movie DB "
+                                                 "against a stub Ollama server")
+    commands = parser.add_subparsers(dest="command")
+
+    bench = commands.add_parser("run", help="Build and load-test synthetic catalogues (the default)")
+    bench.add_argument("--movies", type=int, nargs="+", default=DEFAULT_SIZES, help="Catalogue sizes to benchmark")
+    bench.add_argument("--concurrency", type=int, nargs="+", default=DEFAULT_CONCURRENCY,
+                       help="Concurrent clients for /search")
+    bench.add_argument("--requests", type=int, default=500, help="/search requests per concurrency level")
+    bench.add_argument("--facet_concurrency", type=int, nargs="*", default=[1, 4],
+                       help="Concurrent clients for facet-mode /search (LLM facet extraction per query)")
+    bench.add_argument("--facet_requests", type=int, default=50, help="Facet-mode /search requests per concurrency level")
+    bench.add_argument("--chat_concurrency", type=int, nargs="*", default=[1, 4], help="Concurrent clients for /chat")
+    bench.add_argument("--chat_requests", type=int, default=50, help="/chat requests per concurrency level")
+    bench.add_argument("--warmup", type=int, default=20, help="Unmeasured /search requests after startup")
+    bench.add_argument("--server", choices=["flask", "async"], default="flask")
+    bench.add_argument("--mode", default="hybrid", help="Search mode sent with every /search request")
+    bench.add_argument("--top_k", type=int, default=50)
+    bench.add_argument("--rerank", action="store_true", help="Ask /search to re-rank with the (stub) LLM")
+    bench.add_argument("--no_rag", dest="rag", action="store_false", help="Send /chat without retrieval")
+    bench.add_argument("--factory", help="FAISS factory string for the build (default: INDEX['factory'])")
+    bench.add_argument("--embed_workers", type=int, help="Concurrent embedding requests during the build")
+    bench.add_argument("--dim", type=int, default=768, help="Stub embedding dimension")
+    bench.add_argument("--embed_latency", type=float, default=0.0, help="Stub seconds per embedding request")
+    bench.add_argument("--generate_latency", type=float, default=0.0, help="Stub seconds per generate request")
+    bench.add_argument("--chat_ttfb", type=float, default=0.0, help="Stub seconds before the first chat token")
+    bench.add_argument("--token_latency", type=float, default=0.0, help="Stub seconds between chat tokens")
+    bench.add_argument("--tokens", type=int, default=20, help="Stub tokens per chat reply")
+    bench.add_argument("--stub_port", type=int, help="Port of the stub (default: a free one)")
+    bench.add_argument("--seed", type=int, default=0, help="Catalogue seed")
+    bench.add_argument("--startup_timeout", type=float, default=600)
+    bench.add_argument("--workdir", help="Directory for catalogues, DBs and logs (default: a new temp directory)")
+    bench.add_argument("--output", help="Write results as JSON to this file")
+
+    build_parser = commands.add_parser("build", help="Time create_and_save_db (used by run)")
+    build_parser.add_argument("--json_file", required=True)
+    build_parser.add_argument("--db_file", required=True)
+    build_parser.add_argument("--api_base", required=True, help="Base URL of the stub, e.g. http://127.0.0.1:11434")
+    build_parser.add_argument("--factory")
+    build_parser.add_argument("--embed_workers", type=int)
+    build_parser.add_argument("--output")
+
+    serve_parser = commands.add_parser("serve", help="Serve a DB against the stub (used by run)")
+    serve_parser.add_argument("--db_file", required=True)
+    serve_parser.add_argument("--json_file", required=True)
+    serve_parser.add_argument("--port", type=int, required=True)
+    serve_parser.add_argument("--api_base", required=True)
+    serve_parser.add_argument("--server", choices=["flask", "async"], default="flask")
+
+    args = list(sys.argv[1:] if args is None else args)
+    if not args or args[0] not in ("run", "build", "serve", "-h", "--help"):
+        args = ["run"] + args
+    parsed = parser.parse_args(args)
+
+    if parsed.command == "build":
+        write_json(build(parsed.json_file, parsed.db_file, parsed.api_base, parsed.factory, parsed.embed_workers),
+                   parsed.output)
+    elif parsed.command == "serve":
+        serve(parsed.db_file, parsed.json_file, parsed.port, parsed.api_base, parsed.server)
+    else:
+        write_json(run(parsed), parsed.output)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
@@ -0,0 +1,125 @@
+import logging
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from util.embedding_client import get_client
+
+BACKENDS = ("ollama", "local")
+DEFAULT_BATCH_SIZE = 32
+
+
+class LocalEmbeddingBackend:
+    """
+    In-process SentenceTransformer embeddings on the CPU.
+
+    Same interface as `EmbeddingClient` (`embed`, `embed_many`, `embed_batch`, `stats`),
+    so the server, builders and batcher can use either. The model loads once, on first use.
+    Calls are serialized and each one is a single batched `encode` on `threads` threads, so
+    concurrent callers don't oversubscribe the cores; `EmbeddingBatcher` merges concurrent
+    queries into one call. `onnx_file` selects an ONNX export of the model inside its
+    repository (e.g. "onnx/model_qint8_avx512.onnx" for int8 weights) run with ONNX Runtime.
+    """
+
+    def __init__(self, model: str, threads: Optional[int] = None, batch_size: int = DEFAULT_BATCH_SIZE,
+                 onnx_file: Optional[str] = None, device: str = "cpu"):
+        self.model = model
+        self.threads = threads
+        self.batch_size = batch_size
+        self.onnx_file = onnx_file
+        self.device = device
+        self._model = None
+        self._load_lock = threading.Lock()
+        self._encode_lock = threading.Lock()
+        self._texts = 0
+        self._failures = 0
+        self._busy_seconds = 0.0
+
+    def _load(self) -> Any:
+        with self._load_lock:
+            if self._model is None:
+                import torch
+                from sentence_transformers import SentenceTransformer
+
+                if self.threads:
+                    torch.set_num_threads(self.threads)
+                start = time.perf_counter()
+                if self.onnx_file:
+                    self._model = SentenceTransformer(self.model, device=self.device, backend="onnx",
+                                                      model_kwargs={"file_name": self.onnx_file})
+                else:
+                    self._model = SentenceTransformer(self.model, device=self.device)
+                logging.info(f"Loaded local embedding model {self.model}"
+                             f"{f' ({self.onnx_file})' if self.onnx_file else ''} in {time.perf_counter() - start:.1f}s")
+            return self._model
+
+    def encode(self, texts: Union[str, Sequence[str]], progress: bool = False) -> np.ndarray:
+        """Raw batched encode: one float32 vector for a string, a matrix for a list. Raises on failure."""
+        model = self._load()
+        with self._encode_lock:
+            start = time.perf_counter()
+            embeddings = model.encode(texts, batch_size=self.batch_size, convert_to_numpy=True,
+                                      show_progress_bar=progress)
+            elapsed = time.perf_counter() - start
+            self._texts += 1 if isinstance(texts, str) else len(texts)
+            self._busy_seconds += elapsed
+        return np.asarray(embeddings, dtype=np.float32)
+
+    def embed(self, text: str) -> Optional[np.ndarray]:
+        return self.embed_many([text])[0]
+
+    def embed_many(self, texts: Sequence[str], progress: bool = False) -> List[Optional[np.ndarray]]:
+        """Embed `texts`; the result is aligned with the input and holds None for failures."""
+        if not texts:
+            return []
+        try:
+            return list(self.encode(list(texts), progress=progress))
+        except Exception as e:
+            logging.error(f"Local embedding of {len(texts)} texts failed: {str(e)}")
+            with self._encode_lock:
+                self._failures += len(texts)
+            return [None] * len(texts)
+
+    def embed_batch(self, texts: Sequence[str]) -> List[Optional[np.ndarray]]:
+        return self.embed_many(texts)
+
+    def stats(self) -> Dict[str, float]:
+        with self._encode_lock:
+            rate = self._texts / self._busy_seconds if self._busy_seconds > 0 else 0.0
+            return {
+                "backend": "local",
+                "texts": self._texts,
+                "failures": self._failures,
+                "busy_seconds": round(self._busy_seconds, 3),
+                "texts_per_second": round(rate, 2),
+            }
+
+
+_local_backends: Dict[Tuple, LocalEmbeddingBackend] = {}
+_local_backends_lock = threading.Lock()
+
+
+def get_local_backend(model: str, **kwargs) -> LocalEmbeddingBackend:
+    """Return the process-wide local backend for `model` and its options, creating it on first use."""
+    key = (model, kwargs.get('onnx_file'), kwargs.get('device', 'cpu'))
+    with _local_backends_lock:
+        backend = _local_backends.get(key)
+        if backend is None:
+            backend = LocalEmbeddingBackend(model, **kwargs)
+            _local_backends[key] = backend
+        return backend
+
+
+def get_backend(kind: str, model: str, api_url: Optional[str] = None, **kwargs) -> Any:
+    """
+    The embedding backend for `model`: "ollama" (HTTP, needs `api_url`) or "local" (in-process).
+
+    `kwargs` go to the backend: `EmbeddingClient` options for Ollama, `LocalEmbeddingBackend` ones for local.
+    """
+    if kind == "local":
+        return get_local_backend(model, **kwargs)
+    if kind == "ollama":
+        return get_client(api_url, model, **kwargs)
+    raise ValueError(f"Unknown embedding backend '{kind}', expected one of {', '.join(BACKENDS)}")
@@ -0,0 +1,135 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from util.embedding_cache import normalize_text
+from util.embedding_client import EmbeddingClient
+
+DEFAULT_WINDOW = 0.005  # seconds
+DEFAULT_MAX_BATCH = 32
+
+
+class _Pending:
+    __slots__ = ("key", "text", "future", "enqueued")
+
+    def __init__(self, key: str, text: str):
+        self.key = key
+        self.text = text
+        self.future = Future()
+        self.enqueued = time.perf_counter()
+
+
+class EmbeddingBatcher:
+    """
+    Micro-batching and request coalescing in front of an EmbeddingClient.
+
+    Texts submitted within `window` seconds of the first queued one (up to `max_batch`)
+    are sent as one multi-input request. A text that is already queued or in flight,
+    after normalization, shares the existing future instead of being embedded again.
+    """
+
+    def __init__(self, client: EmbeddingClient, window: float = DEFAULT_WINDOW, max_batch: int = DEFAULT_MAX_BATCH,
+                 dispatchers: int = 4):
+        self.client = client
+        self.window = window
+        self.max_batch = max_batch
+        self._queue: "queue.Queue[Optional[_Pending]]" = queue.Queue()
+        self._in_flight: Dict[str, _Pending] = {}
+        self._lock = threading.Lock()
+        self._dispatch_pool = ThreadPoolExecutor(max_workers=dispatchers, thread_name_prefix="embed-batch")
+        self._batches = 0
+        self._items = 0
+        self._coalesced = 0
+        self._queue_delay = 0.0
+        self._max_queue_delay = 0.0
+        self._thread = threading.Thread(target=self._collect, name="embed-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, text: str) -> Future:
+        key = normalize_text(text)
+        with self._lock:
+            pending = self._in_flight.get(key)
+            if pending is not None:
+                self._coalesced += 1
+                return pending.future
+            pending = _Pending(key, text)
+            self._in_flight[key] = pending
+        self._queue.put(pending)
+        return pending.future
+
+    def embed(self, text: str, timeout: Optional[float] = None) -> Optional[np.ndarray]:
+        try:
+            embedding = self.submit(text).result(timeout)
+        except Exception as e:
+            logging.error(f"Batched embedding failed: {str(e)}")
+            return None
+        # Coalesced callers share the array; hand each its own copy
+        return None if embedding is None else embedding.copy()
+
+    def _collect(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = first.enqueued + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)  # finish this batch, then stop
+                    break
+                batch.append(item)
+            self._dispatch_pool.submit(self._dispatch, batch)
+
+    def _dispatch(self, batch: List[_Pending]):
+        started = time.perf_counter()
+        with self._lock:
+            self._batches += 1
+            self._items += len(batch)
+            for pending in batch:
+                delay = started - pending.enqueued
+                self._queue_delay += delay
+                self._max_queue_delay = max(self._max_queue_delay, delay)
+        try:
+            embeddings = self.client.embed_batch([pending.text for pending in batch])
+        except Exception as e:
+            embeddings = None
+            error = e
+        with self._lock:
+            for pending in batch:
+                self._in_flight.pop(pending.key, None)
+        for i, pending in enumerate(batch):
+            if embeddings is None:
+                pending.future.set_exception(error)
+            else:
+                pending.future.set_result(embeddings[i])
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._dispatch_pool.shutdown(wait=True)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "batches": self._batches,
+                "items": self._items,
+                "coalesced": self._coalesced,
+                "window_seconds": self.window,
+                "max_batch": self.max_batch,
+                "avg_batch_size": round(self._items / self._batches, 2) if self._batches else 0.0,
+                "avg_batch_fill": round(self._items / (self._batches * self.max_batch), 4) if self._batches else 0.0,
+                "avg_queue_delay_ms": round(1000 * self._queue_delay / self._items, 3) if self._items else 0.0,
+                "max_queue_delay_ms": round(1000 * self._max_queue_delay, 3),
+            }
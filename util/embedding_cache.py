@@ -0,0 +1,172 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+
+import numpy as np
+
+DIGEST_SIZE = 20
+SLOT_DTYPE = np.dtype([('digest', f'S{DIGEST_SIZE}'), ('stamp', '<f8')])
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+
+
+def cache_key(model: str, text: str) -> bytes:
+    return hashlib.sha1(f"{model}\0{normalize_text(text)}".encode("utf-8")).digest()
+
+
+class DiskTier:
+    """
+    Direct-mapped, memory-mapped embedding store that survives restarts.
+
+    Each key hashes to one of `slots` fixed-size rows; a colliding write simply
+    replaces the previous entry, so the file never grows past slots * dim floats.
+    """
+
+    def __init__(self, path: str, slots: int = 65536):
+        self.path = path
+        self.slots = slots
+        self.dim = None
+        self._keys = None
+        self._vectors = None
+        meta_file = f"{path}.meta.json"
+        if os.path.exists(meta_file):
+            with open(meta_file, "r") as f:
+                meta = json.load(f)
+            self._open(meta['dim'], meta['slots'], mode="r+")
+
+    def _open(self, dim: int, slots: int, mode: str):
+        self.dim = dim
+        self.slots = slots
+        self._keys = np.memmap(f"{self.path}.keys", dtype=SLOT_DTYPE, mode=mode, shape=(slots,))
+        self._vectors = np.memmap(f"{self.path}.vecs", dtype=np.float32, mode=mode, shape=(slots, dim))
+
+    def _create(self, dim: int):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._open(dim, self.slots, mode="w+")
+        with open(f"{self.path}.meta.json", "w") as f:
+            json.dump({'dim': dim, 'slots': self.slots}, f)
+        logging.info(f"Created on-disk embedding cache at {self.path} ({self.slots} slots x {dim} dims)")
+
+    def _slot(self, key: bytes) -> int:
+        return int.from_bytes(key[:8], "little") % self.slots
+
+    def get(self, key: bytes, ttl: Optional[float]) -> Optional[np.ndarray]:
+        if self._keys is None:
+            return None
+        slot = self._slot(key)
+        entry = self._keys[slot]
+        if entry['digest'] != key:
+            return None
+        if ttl is not None and time.time() - entry['stamp'] > ttl:
+            return None
+        return np.array(self._vectors[slot])
+
+    def put(self, key: bytes, vector: np.ndarray, stamp: float):
+        if self._keys is None:
+            self._create(vector.shape[0])
+        if vector.shape[0] != self.dim:
+            logging.warning(f"Not caching embedding of dimension {vector.shape[0]} in a {self.dim}-dim disk cache")
+            return
+        slot = self._slot(key)
+        self._vectors[slot] = vector
+        self._keys[slot] = (key, stamp)
+
+    def flush(self):
+        if self._keys is not None:
+            self._vectors.flush()
+            self._keys.flush()
+
+
+class EmbeddingCache:
+    """
+    Content-addressed cache for query embeddings keyed on (model, normalized text).
+
+    A bounded in-memory LRU sits in front of an optional memory-mapped disk tier;
+    both honour the optional TTL (seconds).
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl: Optional[float] = None,
+                 disk_path: Optional[str] = None, disk_slots: int = 65536):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk = DiskTier(disk_path, disk_slots) if disk_path else None
+        self._entries: "OrderedDict[bytes, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, model: str, text: str) -> Optional[np.ndarray]:
+        key = cache_key(model, text)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                vector, stamp = entry
+                if self.ttl is None or now - stamp <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return vector.copy()
+                del self._entries[key]
+
+            if self.disk is not None:
+                vector = self.disk.get(key, self.ttl)
+                if vector is not None:
+                    self._remember(key, vector, now)
+                    self.disk_hits += 1
+                    return vector.copy()
+
+            self.misses += 1
+            return None
+
+    def put(self, model: str, text: str, vector: np.ndarray):
+        key = cache_key(model, text)
+        vector = np.array(vector, dtype=np.float32)  # callers may normalize theirs in place
+        now = time.time()
+        with self._lock:
+            self._remember(key, vector, now)
+            if self.disk is not None:
+                self.disk.put(key, vector, now)
+
+    def _remember(self, key: bytes, vector: np.ndarray, stamp: float):
+        self._entries[key] = (vector, stamp)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get_or_compute(self, model: str, text: str,
+                       compute: Callable[[str], Optional[np.ndarray]]) -> Optional[np.ndarray]:
+        vector = self.get(model, text)
+        if vector is None:
+            vector = compute(text)
+            if vector is not None:
+                self.put(model, text, vector)
+        return vector
+
+    def flush(self):
+        with self._lock:
+            if self.disk is not None:
+                self.disk.flush()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round((self.hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+            }
@@ -0,0 +1,151 @@
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from tqdm import tqdm
+from urllib3.util.retry import Retry
+
+from util.metrics import UPSTREAM_TTFB_SECONDS
+
+DEFAULT_WORKERS = 8
+DEFAULT_TIMEOUT = (5.0, 60.0)  # (connect, read) seconds
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+MISSING_ENDPOINT_STATUSES = (404, 405)  # the backend has no multi-input endpoint
+
+
+class EmbeddingClient:
+    """
+    Pooled, concurrent client for the Ollama embeddings API.
+
+    A single keep-alive `requests.Session` is shared by a bounded thread pool, so a
+    build over the whole catalogue reuses a handful of TCP connections instead of
+    opening one per text. Transient failures are retried with exponential backoff.
+    """
+
+    def __init__(self, api_url: str, model: str, workers: int = DEFAULT_WORKERS,
+                 timeout: Tuple[float, float] = DEFAULT_TIMEOUT, max_retries: int = DEFAULT_RETRIES,
+                 backoff_factor: float = DEFAULT_BACKOFF, batch_url: Optional[str] = None):
+        self.api_url = api_url
+        self.model = model
+        # Multi-input endpoint (Ollama's /api/embed); None once the backend turns out not to support it
+        if batch_url is None and api_url.endswith("/api/embeddings"):
+            batch_url = api_url[:-len("/api/embeddings")] + "/api/embed"
+        self.batch_url = batch_url
+        self.workers = workers
+        self.timeout = timeout
+
+        retry = Retry(total=max_retries, connect=max_retries, read=max_retries, status=max_retries,
+                      backoff_factor=backoff_factor, status_forcelist=RETRY_STATUSES,
+                      allowed_methods=None, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers, max_retries=retry)
+        self.session = requests.Session()
+        self.session.headers.update({'Content-Type': 'application/json'})
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="embed")
+        self._lock = threading.Lock()
+        self._texts = 0
+        self._failures = 0
+        self._busy_seconds = 0.0
+
+    def embed(self, text: str) -> Optional[np.ndarray]:
+        payload = json.dumps({"model": self.model, "prompt": text})
+        try:
+            response = self.session.post(self.api_url, data=payload, timeout=self.timeout)
+            UPSTREAM_TTFB_SECONDS.observe("embeddings", response.elapsed.total_seconds())
+            response.raise_for_status()
+            embedding = response.json().get('embedding')
+            if not embedding:
+                raise ValueError(f"Invalid embedding format received for text: {text[:50]}...")
+            return np.array(embedding, dtype=np.float32)
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Embedding request failed: {str(e)}")
+            if e.response is not None:
+                logging.error(f"Response content: {e.response.content}")
+        except Exception as e:
+            logging.error(f"Unexpected error while embedding: {str(e)}")
+        return None
+
+    def embed_many(self, texts: Sequence[str], progress: bool = False) -> List[Optional[np.ndarray]]:
+        """Embed `texts` concurrently; the result is aligned with the input and holds None for failures."""
+        start = time.perf_counter()
+        results = self._executor.map(self.embed, texts)
+        if progress:
+            results = tqdm(results, total=len(texts), unit="text")
+        embeddings = list(results)
+        elapsed = time.perf_counter() - start
+
+        failures = sum(1 for e in embeddings if e is None)
+        with self._lock:
+            self._texts += len(texts)
+            self._failures += failures
+            self._busy_seconds += elapsed
+        if progress:
+            rate = len(texts) / elapsed if elapsed > 0 else 0.0
+            logging.info(f"Embedded {len(texts) - failures}/{len(texts)} texts in {elapsed:.1f}s "
+                         f"({rate:.1f} texts/s, {self.workers} workers)")
+        return embeddings
+
+    def embed_batch(self, texts: Sequence[str]) -> List[Optional[np.ndarray]]:
+        """Embed `texts` in one multi-input request when the backend supports it, else concurrently one by one."""
+        if self.batch_url is not None:
+            payload = json.dumps({"model": self.model, "input": list(texts)})
+            start = time.perf_counter()
+            try:
+                response = self.session.post(self.batch_url, data=payload, timeout=self.timeout)
+                UPSTREAM_TTFB_SECONDS.observe("embeddings_batch", response.elapsed.total_seconds())
+                if response.status_code in MISSING_ENDPOINT_STATUSES:
+                    logging.warning(f"{self.batch_url} does not accept batched input ({response.status_code}); "
+                                    f"falling back to one request per text")
+                    self.batch_url = None
+                elif response.status_code == 400:
+                    # Likely one bad or oversized text; only this batch goes one by one
+                    logging.warning(f"{self.batch_url} rejected a batch of {len(texts)} texts (400); "
+                                    f"embedding them one by one")
+                else:
+                    response.raise_for_status()
+                    embeddings = response.json().get('embeddings')
+                    if not embeddings or len(embeddings) != len(texts):
+                        raise ValueError("Invalid batch embedding format received")
+                    with self._lock:
+                        self._texts += len(texts)
+                        self._busy_seconds += time.perf_counter() - start
+                    return [np.array(embedding, dtype=np.float32) for embedding in embeddings]
+            except Exception as e:
+                logging.error(f"Batch embedding request failed, retrying texts one by one: {str(e)}")
+        return self.embed_many(texts)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            rate = self._texts / self._busy_seconds if self._busy_seconds > 0 else 0.0
+            return {
+                "backend": "ollama",
+                "texts": self._texts,
+                "failures": self._failures,
+                "busy_seconds": round(self._busy_seconds, 3),
+                "texts_per_second": round(rate, 2),
+            }
+
+
+_clients: Dict[Tuple[str, str], EmbeddingClient] = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(api_url: str, model: str, **kwargs) -> EmbeddingClient:
+    """Return the process-wide client for (api_url, model), creating it on first use."""
+    key = (api_url, model)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = EmbeddingClient(api_url, model, **kwargs)
+            _clients[key] = client
+        return client
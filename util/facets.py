@@ -0,0 +1,222 @@
+import logging
+import re
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import faiss
+import numpy as np
+
+from util.filters import filtered_search_parameters
+from util.incremental import content_hash
+
+# (key, label as written by annotate.py and util/features.py)
+FACETS = (
+    ("theme", "Theme"),
+    ("setting", "Setting"),
+    ("mood", "Mood"),
+    ("genre", "Genre"),
+    ("character_dynamics", "Character Dynamics"),
+    ("stylistic_features", "Stylistic Features"),
+)
+FACET_KEYS = tuple(key for key, _ in FACETS)
+_LABELS = {label.casefold(): key for key, label in FACETS}
+_LABELS.update({"themes": "theme", "stylistic feature": "stylistic_features"})
+FACET_LINE_RE = re.compile(r"^\s*[-*]?\s*([A-Za-z ]+?)\s*:\s*(.+?)\s*$")
+ADD_ROWS = 4096  # movie rows encoded per index.add_with_ids while building
+
+
+def parse_facets(text: Optional[str]) -> Dict[str, str]:
+    """Facet texts of an annotation ("- Theme: ..." lines); lines without a known label extend the previous facet."""
+    facets: Dict[str, str] = {}
+    current = None
+    for line in (text or "").splitlines():
+        match = FACET_LINE_RE.match(line)
+        key = _LABELS.get(match.group(1).casefold()) if match else None
+        if key is not None:
+            current = key
+            facets[key] = match.group(2)
+        elif current is not None and line.strip():
+            facets[current] += " " + line.strip()
+    return facets
+
+
+class FacetIndex:
+    """
+    Annotation facet vectors in one FAISS index: a row per movie, its facets side by side.
+
+    A movie's row holds its L2-normalized facet vectors in `FACET_KEYS` order, with zeros
+    for the facets it lacks, under its FAISS id. A query row built the same way, each
+    facet scaled by its weight over the sum of the weights, has an inner product with it
+    equal to the weighted mean of the facet cosines, so one index search scores every
+    facet and returns the top-k. Rows are stored as float16 (a scalar quantizer) by default.
+    """
+
+    def __init__(self, index: Any, doc_ids: np.ndarray, hashes: np.ndarray, present: np.ndarray, n_docs: int):
+        self.index = index
+        self.doc_ids = doc_ids
+        self.hashes = hashes  # content hash of each row's facet texts, valid where `present`
+        self.present = present
+        self.n_docs = n_docs
+        self._decoded = (None, None)
+
+    @property
+    def dim(self) -> int:
+        return self.index.d // len(FACET_KEYS) if self.index is not None else 0
+
+    def facet_vector(self, row: int, facet: int) -> np.ndarray:
+        """The stored vector of one facet of row `row`."""
+        decoded_row, decoded = self._decoded
+        if decoded_row != row:
+            decoded = faiss.downcast_index(self.index.index).reconstruct(row)
+            self._decoded = (row, decoded)  # a row's facets are usually read one after another
+        return decoded[facet * self.dim:(facet + 1) * self.dim]
+
+    @classmethod
+    def build(cls, docs: Iterable[Tuple[int, Dict[str, str]]], n_docs: int,
+              embed_many: Callable[[List[str]], List[Optional[np.ndarray]]], dtype: str = "float16",
+              previous: Optional["FacetIndex"] = None) -> "FacetIndex":
+        """
+        Embed the facets of `docs` ((FAISS id, facet texts) pairs); `n_docs` bounds the ids.
+
+        Texts whose vectors are already in `previous` (same text hash) are not embedded again,
+        and identical texts are embedded once.
+        """
+        rows = []
+        for doc_id, facets in docs:
+            entries = [(FACET_KEYS.index(key), content_hash(text)) for key, text in facets.items()
+                       if key in FACET_KEYS and text]
+            if entries:
+                rows.append((doc_id, entries, facets))
+
+        known = {}
+        if previous is not None and len(previous.doc_ids):
+            for row, facet in zip(*np.nonzero(previous.present)):
+                known[int(previous.hashes[row, facet])] = (int(row), int(facet))
+        texts = {}
+        for _, entries, facets in rows:
+            for f, h in entries:
+                if h not in known:
+                    texts.setdefault(h, facets[FACET_KEYS[f]])
+        logging.info(f"Embedding {len(texts)} facet texts ({sum(len(entries) for _, entries, _ in rows)} facet rows, "
+                     f"{len(known)} vectors reused)")
+        fresh = {}
+        if texts:
+            embeddings = embed_many(list(texts.values()))
+            fresh = {h: e for h, e in zip(texts, embeddings) if e is not None}
+
+        def vectors():
+            for doc_id, entries, _ in rows:
+                found = []
+                for f, h in entries:
+                    if h in fresh:
+                        found.append((f, h, fresh[h]))
+                    elif h in known:
+                        found.append((f, h, previous.facet_vector(*known[h])))
+                    # otherwise the embedding failed; the movie just lacks this facet
+                yield doc_id, found
+
+        dim = next(iter(fresh.values())).shape[0] if fresh else previous.dim if previous is not None else 0
+        return cls.assemble(vectors(), dim, n_docs, dtype)
+
+    @classmethod
+    def assemble(cls, rows: Iterable[Tuple[int, List[Tuple[int, int, np.ndarray]]]], dim: int, n_docs: int,
+                 dtype: str = "float16") -> "FacetIndex":
+        """An index over `rows`: (FAISS id, [(facet number, text hash, vector)]) per movie."""
+        if dtype == "float16":
+            base = faiss.IndexScalarQuantizer(len(FACET_KEYS) * dim, faiss.ScalarQuantizer.QT_fp16,
+                                              faiss.METRIC_INNER_PRODUCT)
+        elif dtype == "float32":
+            base = faiss.IndexFlatIP(len(FACET_KEYS) * dim)
+        else:
+            raise ValueError(f"Unknown facet vector dtype '{dtype}', expected float16 or float32")
+        index = faiss.IndexIDMap(base)
+
+        doc_ids, hashes, present = [], [], []
+        batch, batch_ids = [], []
+        for doc_id, found in rows:
+            if not found:
+                continue
+            row = np.zeros(len(FACET_KEYS) * dim, dtype=np.float32)
+            row_hashes = np.zeros(len(FACET_KEYS), dtype=np.int64)
+            row_present = np.zeros(len(FACET_KEYS), dtype=bool)
+            for f, h, vector in found:
+                row[f * dim:(f + 1) * dim] = vector / max(np.linalg.norm(vector), 1e-12)
+                row_hashes[f] = h
+                row_present[f] = True
+            batch.append(row)
+            batch_ids.append(doc_id)
+            hashes.append(row_hashes)
+            present.append(row_present)
+            if len(batch) == ADD_ROWS:
+                index.add_with_ids(np.stack(batch), np.array(batch_ids, dtype=np.int64))
+                doc_ids.extend(batch_ids)
+                batch, batch_ids = [], []
+        if batch:
+            index.add_with_ids(np.stack(batch), np.array(batch_ids, dtype=np.int64))
+            doc_ids.extend(batch_ids)
+
+        return cls(index, np.array(doc_ids, dtype=np.int32),
+                   np.array(hashes, dtype=np.int64).reshape(-1, len(FACET_KEYS)),
+                   np.array(present, dtype=bool).reshape(-1, len(FACET_KEYS)), n_docs)
+
+    def search(self, queries: Dict[str, np.ndarray], weights: Dict[str, float], k: int,
+               mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Top-k (FAISS ids, fused scores), best first, for per-facet query vectors.
+
+        A movie's score is the weighted mean of its facet cosines over the queried facets;
+        a facet the movie lacks counts as 0. `mask` limits the FAISS ids considered.
+        """
+        facets = [(FACET_KEYS.index(key), vector) for key, vector in queries.items()
+                  if key in FACET_KEYS and weights.get(key, 0) > 0]
+        if not facets or not len(self.doc_ids):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        total = sum(weights[FACET_KEYS[f]] for f, _ in facets)
+        query = np.zeros((1, self.index.d), dtype=np.float32)
+        for f, vector in facets:
+            scale = weights[FACET_KEYS[f]] / total / max(np.linalg.norm(vector), 1e-12)
+            query[0, f * self.dim:(f + 1) * self.dim] = scale * vector
+
+        k = min(k, len(self.doc_ids))
+        scores, labels = self.index.search(query, k, params=filtered_search_parameters(self.index, mask=mask))
+        found = labels[0] >= 0
+        return labels[0][found], scores[0][found]
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        return {
+            'index': faiss.serialize_index(self.index),
+            'doc_ids': self.doc_ids,
+            'hashes': self.hashes,
+            'present': self.present,
+            'n_docs': np.array([self.n_docs], dtype=np.int64),
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> "FacetIndex":
+        n_docs = int(arrays['n_docs'][0])
+        if 'offsets' in arrays:
+            return cls.from_packed(arrays['vectors'], arrays['offsets'], arrays['doc_ids'], arrays['hashes'], n_docs)
+        return cls(faiss.deserialize_index(arrays['index']), arrays['doc_ids'], arrays['hashes'], arrays['present'],
+                   n_docs)
+
+    @classmethod
+    def from_packed(cls, vectors: np.ndarray, offsets: np.ndarray, doc_ids: np.ndarray, hashes: np.ndarray,
+                    n_docs: int) -> "FacetIndex":
+        """Convert the facet-by-facet layout of databases built before the FAISS facet index."""
+        logging.info("Converting packed facet vectors to a facet index; save the database again to skip this")
+        entries: Dict[int, List[Tuple[int, int, int]]] = {}
+        for f in range(len(offsets) - 1):
+            for row in range(int(offsets[f]), int(offsets[f + 1])):
+                entries.setdefault(int(doc_ids[row]), []).append((f, int(hashes[row]), row))
+        rows = ((doc_id, [(f, h, vectors[row].astype(np.float32)) for f, h, row in entries[doc_id]])
+                for doc_id in sorted(entries))
+        return cls.assemble(rows, vectors.shape[1], n_docs, str(vectors.dtype))
+
+
+def facet_texts(records: Sequence[Dict], rows: Iterable[Tuple[int, int]]) -> Iterable[Tuple[int, Dict[str, str]]]:
+    """(FAISS id, facets) for each (FAISS id, record row) whose record carries annotations."""
+    for doc_id, row in rows:
+        annotations = records[row].get('annotations')
+        if annotations:
+            facets = parse_facets(annotations)
+            if facets:
+                yield doc_id, facets
@@ -1,11 +1,10 @@
 import requests
-from sentence_transformers import SentenceTransformer
 
-def extract_features_from_prompt(prompt):
-    """
-    This function sends the user prompt to the LLM along with the instruction to extract features.
-    """
-    system_instruction = """
+from util.embedding_backend import get_local_backend
+
+FEATURE_MODEL = 'all-MiniLM-L6-v2'
+
+FEATURE_INSTRUCTION = """
         Analyze the user's input and extract key features that align with our movie annotation categories: themes, setting, mood, genre, character dynamics, and stylistic features.
         Summarize these features to reflect the user's interests, assisting in accurately matching them with suitable movies from our database.
         Example:
@@ -17,12 +16,16 @@ def extract_features_from_prompt(prompt):
             - Character Dynamics: The protagonist's interactions with townsfolk, revealing complex relationships and hidden pasts.
             - Stylistic Features: Emphasis on scenic landscapes, small-town imagery, and a soundtrack that enhances the mysterious and dramatic tone."
         """
-    
+
+def extract_features_from_prompt(prompt):
+    """
+    This function sends the user prompt to the LLM along with the instruction to extract features.
+    """
     data = {
         "prompt": "\n\nUser Input: '" + prompt + "'",
         "temperature": 0.20,
         "system_prompt": {
-            "prompt": system_instruction
+            "prompt": FEATURE_INSTRUCTION
         }
     }
     response = requests.post("http://localhost:8080/completion", json=data)
@@ -34,10 +37,9 @@ def extract_features_from_prompt(prompt):
 def encode_features(features):
     """
     This function takes the extracted features and encodes them using SentenceTransformer.
+    The model is loaded once per process and reused by every call.
     """
-    model = SentenceTransformer('all-MiniLM-L6-v2')
-    embeddings = model.encode(features)
-    return embeddings
+    return get_local_backend(FEATURE_MODEL).encode(features)
 
 def main():
     user_prompt = "I'm looking for a sci-fi movie with themes of space exploration and AI."
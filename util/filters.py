@@ -0,0 +1,185 @@
+import logging
+from typing import Any, Callable, Dict, Optional, Sequence
+
+import faiss
+import numpy as np
+
+from util.ann import search_parameters, unwrap
+
+FILTER_KEYS = ("genre_ids", "genre_match", "year_min", "year_max", "original_language",
+               "min_vote_average", "min_popularity")
+BATCH_SELECTOR_BELOW = 0.01  # below this selectivity an id list is smaller than a bitmap over all ids
+
+
+def _year(release_date: Any) -> int:
+    year = str(release_date or "")[:4]
+    return int(year) if year.isdigit() else 0
+
+
+def _number(key: str, value: Any, cast: Callable[[Any], Any]) -> Any:
+    """A filter value as an int or float, with a message naming the filter when it is not one."""
+    kind = "an integer" if cast is int else "a number"
+    if isinstance(value, bool) or (cast is int and isinstance(value, float) and not value.is_integer()):
+        raise ValueError(f"{key} must be {kind}, got {value!r}")
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{key} must be {kind}, got {value!r}") from None
+
+
+class MetadataColumns:
+    """
+    Filterable movie metadata as NumPy columns indexed by FAISS id.
+
+    Built with the DB and stored as an extra (or built from the records when an older DB
+    lacks it), so a request's filters become a boolean mask over the whole catalogue in a
+    few vectorized comparisons, which is handed to FAISS as an ID selector and applied
+    during the search rather than after it.
+    """
+
+    def __init__(self, live: np.ndarray, genres: np.ndarray, genre_ids: Sequence[int], years: np.ndarray,
+                 languages: np.ndarray, language_codes: Sequence[str], vote_average: np.ndarray, popularity: np.ndarray):
+        self.live = live
+        self.genres = genres
+        self.genre_columns = {int(genre_id): i for i, genre_id in enumerate(genre_ids)}
+        self.years = years
+        self.languages = languages
+        self.language_codes = {code: i for i, code in enumerate(language_codes)}
+        self.vote_average = vote_average
+        self.popularity = popularity
+
+    @classmethod
+    def build(cls, rows: Sequence[Optional[int]], records: Sequence[Dict[str, Any]]) -> "MetadataColumns":
+        """`rows[i]` is the record row of FAISS id i, or None for removed or unknown documents."""
+        n = len(rows)
+        live = np.zeros(n, dtype=bool)
+        years = np.zeros(n, dtype=np.int16)
+        languages = np.full(n, -1, dtype=np.int16)
+        vote_average = np.full(n, np.nan, dtype=np.float32)
+        popularity = np.full(n, np.nan, dtype=np.float32)
+        genre_columns: Dict[int, int] = {}
+        language_codes: Dict[str, int] = {}
+        genre_rows, genre_cols = [], []
+
+        for doc_id, row in enumerate(rows):
+            if row is None or row >= len(records):
+                continue
+            record = records[row]
+            live[doc_id] = True
+            years[doc_id] = _year(record.get('release_date'))
+            language = record.get('original_language')
+            if language:
+                languages[doc_id] = language_codes.setdefault(language, len(language_codes))
+            if isinstance(record.get('vote_average'), (int, float)):
+                vote_average[doc_id] = record['vote_average']
+            if isinstance(record.get('popularity'), (int, float)):
+                popularity[doc_id] = record['popularity']
+            for genre_id in record.get('genre_ids') or ():
+                genre_rows.append(doc_id)
+                genre_cols.append(genre_columns.setdefault(int(genre_id), len(genre_columns)))
+
+        genres = np.zeros((n, len(genre_columns)), dtype=bool)
+        genres[genre_rows, genre_cols] = True
+        logging.info(f"Built metadata columns for {int(live.sum())} documents "
+                     f"({len(genre_columns)} genres, {len(language_codes)} languages)")
+        return cls(live, genres, list(genre_columns), years, languages, list(language_codes), vote_average, popularity)
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        return {
+            'live': self.live,
+            'genres': self.genres,
+            'genre_ids': np.array(list(self.genre_columns), dtype=np.int64),
+            'years': self.years,
+            'languages': self.languages,
+            'language_codes': np.array(list(self.language_codes), dtype=np.str_),
+            'vote_average': self.vote_average,
+            'popularity': self.popularity,
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> "MetadataColumns":
+        return cls(arrays['live'], arrays['genres'], arrays['genre_ids'].tolist(), arrays['years'],
+                   arrays['languages'], arrays['language_codes'].tolist(), arrays['vote_average'], arrays['popularity'])
+
+    def __len__(self) -> int:
+        return len(self.live)
+
+    def mask(self, filters: Optional[Dict[str, Any]]) -> Optional[np.ndarray]:
+        """
+        Boolean mask of the FAISS ids matching `filters`, or None when there is nothing to filter.
+
+        `genre_ids` matches any listed genre (all of them with `"genre_match": "all"`),
+        `year_min` / `year_max` are inclusive release years, `original_language` is a code
+        or a list of codes, and `min_vote_average` / `min_popularity` are lower bounds.
+        """
+        if not filters:
+            return None
+        if not isinstance(filters, dict):
+            raise ValueError("filters must be an object")
+        unknown = set(filters) - set(FILTER_KEYS)
+        if unknown:
+            raise ValueError(f"Unknown filters: {', '.join(sorted(unknown))}")
+
+        mask = self.live.copy()
+        genre_ids = filters.get('genre_ids')
+        if genre_ids:
+            if isinstance(genre_ids, (int, str)):
+                genre_ids = [genre_ids]
+            columns = [self.genre_columns.get(_number('genre_ids', genre_id, int)) for genre_id in genre_ids]
+            if filters.get('genre_match', 'any') not in ('any', 'all'):
+                raise ValueError(f"genre_match must be 'any' or 'all', got {filters['genre_match']!r}")
+            if filters.get('genre_match', 'any') == 'all':
+                if None in columns:
+                    mask[:] = False
+                else:
+                    mask &= self.genres[:, columns].all(axis=1)
+            else:
+                columns = [column for column in columns if column is not None]
+                mask &= self.genres[:, columns].any(axis=1) if columns else False
+        if filters.get('year_min') is not None:
+            mask &= self.years >= _number('year_min', filters['year_min'], int)
+        if filters.get('year_max') is not None:
+            mask &= (self.years <= _number('year_max', filters['year_max'], int)) & (self.years > 0)
+        languages = filters.get('original_language')
+        if languages:
+            if isinstance(languages, str):
+                languages = [languages]
+            codes = [self.language_codes[language] for language in languages if language in self.language_codes]
+            mask &= np.isin(self.languages, codes)
+        if filters.get('min_vote_average') is not None:
+            mask &= self.vote_average >= _number('min_vote_average', filters['min_vote_average'], float)
+        if filters.get('min_popularity') is not None:
+            mask &= self.popularity >= _number('min_popularity', filters['min_popularity'], float)
+        return mask
+
+
+def id_selector(mask: np.ndarray) -> Any:
+    """A FAISS selector for the ids set in `mask`: an id list when few match, otherwise a bitmap."""
+    selected = int(mask.sum())
+    if selected < BATCH_SELECTOR_BELOW * len(mask):
+        return faiss.IDSelectorBatch(np.flatnonzero(mask).astype(np.int64))
+    bitmap = np.packbits(mask, bitorder="little")
+    selector = faiss.IDSelectorBitmap(len(bitmap), faiss.swig_ptr(bitmap))
+    # The selector only points at the bitmap; keep the array alive with it
+    selector.referenced_objects = [bitmap]
+    return selector
+
+
+def filtered_search_parameters(index: Any, nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                               mask: Optional[np.ndarray] = None, max_widening: float = 16) -> Optional[Any]:
+    """
+    Search parameters restricted to the ids set in `mask`.
+
+    A filter leaves fewer matches in every probed IVF cell or HNSW neighbourhood, so
+    nprobe / efSearch are widened by 1 / selectivity, at most `max_widening` times.
+    """
+    selector = None
+    if mask is not None:
+        selector = id_selector(mask)
+        widen = min(len(mask) / max(int(mask.sum()), 1), max_widening)
+        base = unwrap(index)
+        if isinstance(base, faiss.IndexIVF):
+            nprobe = min(base.nlist, int(np.ceil((nprobe or base.nprobe) * widen)))
+        elif isinstance(base, faiss.IndexHNSW):
+            ef_search = int(np.ceil((ef_search or base.hnsw.efSearch) * widen))
+    return search_parameters(index, nprobe=nprobe, ef_search=ef_search, selector=selector)
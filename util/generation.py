@@ -0,0 +1,141 @@
+import logging
+import os
+import threading
+import time
+import weakref
+from typing import Any, Callable, Dict, Optional, Sequence
+
+from util.db_store import META_FILE, is_store
+
+
+def db_signature(db_path: str) -> Optional[tuple]:
+    """Identity of the DB on disk; a build that swaps in a new directory or file changes it."""
+    path = os.path.join(db_path, META_FILE) if is_store(db_path) else db_path
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+class Generation:
+    """
+    Everything a search reads from one build of the DB, loaded and swapped as a unit.
+
+    A request takes the current generation once and uses it throughout, so a reload never
+    mixes the ids of one index with the documents of another. When the last request holding
+    an old generation finishes, its arrays and memory maps are released; `release` callbacks
+    (closing shard connections, say) run at that point. `result_cache` holds results
+    computed against this generation only, so a swap starts with an empty one.
+    """
+
+    def __init__(self, documents: Sequence, index: Any, records: Sequence, lexical: Any = None, metadata: Any = None,
+                 facets: Any = None, vectors: Any = None, signature: Optional[tuple] = None,
+                 release: Sequence[Callable[[], None]] = (), result_cache: Any = None):
+        self.documents = documents
+        self.index = index
+        self.records = records
+        self.lexical = lexical
+        self.metadata = metadata
+        self.facets = facets
+        self.vectors = vectors
+        self.result_cache = result_cache
+        self.signature = signature
+        self.number = 0
+        self.loaded_at = time.time()
+        for callback in release:
+            weakref.finalize(self, callback)
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "generation": self.number,
+            "documents": len(self.documents),
+            "vectors": int(self.index.ntotal),
+            "loaded_at": round(self.loaded_at, 3),
+        }
+
+
+class GenerationSwitch:
+    """
+    Holds the serving generation and replaces it without downtime.
+
+    `load()` builds a new generation in the caller's thread while requests keep using the
+    current one; `validate(generation)` (a smoke query) must pass before the reference is
+    swapped, which is a single atomic assignment. A failed load or validation leaves the
+    current generation in place.
+    """
+
+    def __init__(self, load: Callable[[], Generation], validate: Optional[Callable[[Generation], None]] = None,
+                 signature: Optional[Callable[[], Optional[tuple]]] = None):
+        self.load = load
+        self.validate = validate
+        self.signature = signature
+        self._current: Optional[Generation] = None
+        self._lock = threading.Lock()
+        self._alive: "weakref.WeakSet[Generation]" = weakref.WeakSet()
+        self._watcher = None
+        self._failed_signature = None
+        self.reloads = 0
+        self.failures = 0
+        self.last_error = None
+
+    @property
+    def current(self) -> Generation:
+        return self._current
+
+    def reload(self, force: bool = False, validate: bool = True) -> Dict[str, Any]:
+        """Load, check and swap in a new generation unless the DB on disk is unchanged; returns a status dict."""
+        with self._lock:
+            signature = self.signature() if self.signature is not None else None
+            if not force and self._current is not None and signature == self._current.signature:
+                return {"status": "unchanged", **self._current.summary()}
+            start = time.perf_counter()
+            try:
+                generation = self.load()
+                generation.signature = signature
+                if validate and self.validate is not None:
+                    self.validate(generation)
+            except Exception as e:
+                self.failures += 1
+                self._failed_signature = signature
+                self.last_error = str(e)
+                logging.error(f"Reload failed, still serving generation "
+                              f"{self._current.number if self._current else None}: {str(e)}", exc_info=True)
+                raise
+            generation.number = self._current.number + 1 if self._current is not None else 1
+            self._current = generation
+            self._alive.add(generation)
+            self.reloads += 1
+            self.last_error = None
+            elapsed = time.perf_counter() - start
+            logging.info(f"Serving generation {generation.number}: {len(generation.documents)} documents, "
+                         f"{generation.index.ntotal} vectors (loaded in {elapsed:.1f}s)")
+            return {"status": "reloaded", "seconds": round(elapsed, 3), **generation.summary()}
+
+    def watch(self, interval: float) -> threading.Thread:
+        """Poll the DB signature every `interval` seconds and reload when it changes."""
+
+        def run():
+            while True:
+                time.sleep(interval)
+                signature = self.signature()
+                if signature is None or signature == self._failed_signature:
+                    continue  # no DB, or a build that already failed to load; wait for the next one
+                try:
+                    self.reload()
+                except Exception:
+                    pass  # logged by reload
+
+        if self._watcher is None:
+            self._watcher = threading.Thread(target=run, name="db-watch", daemon=True)
+            self._watcher.start()
+        return self._watcher
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **(self._current.summary() if self._current is not None else {}),
+            "reloads": self.reloads,
+            "failures": self.failures,
+            "last_error": self.last_error,
+            "generations_alive": len(self._alive),
+        }
@@ -0,0 +1,222 @@
+import glob
+import hashlib
+import logging
+import os
+import shutil
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import faiss
+import numpy as np
+
+from util.ann import unwrap
+from util.db_store import read_db, write_db
+
+CHUNK_SIZE = 1024
+
+# (movie id, text to embed, document reference stored alongside the text)
+Entry = Tuple[int, str, Any]
+
+
+def content_hash(text: str) -> int:
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little", signed=True)
+
+
+class EmbeddingCheckpoint:
+    """
+    Embeddings written to disk in chunks while a build is running.
+
+    Each chunk is an .npz of (movie ids, content hashes, vectors). A crashed build
+    reloads the chunks on restart and only embeds what is still missing; the
+    checkpoint is cleared once the DB that consumed it has been saved.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def _chunk_files(self) -> List[str]:
+        return sorted(glob.glob(os.path.join(self.directory, "chunk_*.npz")))
+
+    def load(self) -> Dict[int, Tuple[int, np.ndarray]]:
+        vectors = {}
+        for chunk_file in self._chunk_files():
+            with np.load(chunk_file) as chunk:
+                for movie_id, digest, vector in zip(chunk['ids'], chunk['hashes'], chunk['vectors']):
+                    vectors[int(movie_id)] = (int(digest), vector)
+        if vectors:
+            logging.info(f"Resuming from {len(vectors)} checkpointed embeddings in {self.directory}")
+        return vectors
+
+    def write_chunk(self, ids: Sequence[int], hashes: Sequence[int], vectors: np.ndarray):
+        os.makedirs(self.directory, exist_ok=True)
+        chunk_file = os.path.join(self.directory, f"chunk_{len(self._chunk_files()):06d}.npz")
+        tmp_file = chunk_file + ".tmp.npz"
+        np.savez(tmp_file, ids=np.asarray(ids, dtype=np.int64), hashes=np.asarray(hashes, dtype=np.int64),
+                 vectors=np.asarray(vectors, dtype=np.float32))
+        os.replace(tmp_file, chunk_file)
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def load_manifest(db_file: str) -> Optional[Dict[str, Any]]:
+    """Return the previous build (documents, IDMap index, per-doc movie ids and hashes) if it supports updates."""
+    if not os.path.exists(db_file):
+        return None
+    data = read_db(db_file, mmap=False)
+    if data['manifest'] is None:
+        logging.info(f"{db_file} was not built incrementally; rebuilding it from scratch")
+        return None
+    return {
+        'documents': data['documents'],
+        'index': data['index'],
+        'movie_ids': data['manifest']['movie_ids'],
+        'hashes': data['manifest']['hashes'],
+        'vectors': data['vectors'],
+    }
+
+
+def rebuild_without(index: Any, removed: Sequence[int], vectors: Optional[np.ndarray] = None) -> Any:
+    """
+    A new IndexIDMap2 holding every vector of `index` except the `removed` ids, under the same ids.
+
+    Used where IndexIDMap2.remove_ids is unusable: HNSW does not implement it, and IVF removes
+    the codes without renumbering the internal ids the id map is compacted against, so later
+    searches return the wrong FAISS ids. The base index is cloned and emptied, so its training
+    is kept; the vectors come from the stored full-precision `vectors` when there are any,
+    otherwise they are reconstructed from the index.
+    """
+    ids = faiss.vector_to_array(index.id_map)
+    keep = ~np.isin(ids, np.asarray(removed, dtype=np.int64))
+    if vectors is not None:
+        kept = np.asarray(vectors[ids[keep]], dtype=np.float32)
+    else:
+        kept = index.index.reconstruct_n(0, index.ntotal)[keep]
+    logging.info(f"Rebuilding the index over {len(kept)} vectors to remove {len(removed)} ids")
+    base = faiss.clone_index(faiss.downcast_index(index.index))
+    base.reset()
+    rebuilt = faiss.IndexIDMap2(base)
+    rebuilt.add_with_ids(kept, ids[keep])
+    return rebuilt
+
+
+def build_incremental(entries: Sequence[Entry], db_file: str,
+                      embed_many: Callable[[List[str]], List[Optional[np.ndarray]]],
+                      new_index: Callable[[np.ndarray], Any], normalize: bool = False,
+                      records: Optional[Sequence[Dict[str, Any]]] = None,
+                      build_extras: Optional[Callable[[List[Any]], Dict[str, Dict[str, np.ndarray]]]] = None,
+                      checkpoint_dir: Optional[str] = None, chunk_size: int = CHUNK_SIZE, keep_vectors: bool = False):
+    """
+    Bring `db_file` up to date with `entries`, embedding only new or changed movies.
+
+    FAISS ids are positions in `documents`. A changed movie has its old id removed and
+    gets a fresh one appended, movies gone from the catalogue are removed, and the
+    documents of removed ids are left as None. `new_index(vectors)` builds (and trains,
+    if needed) the base index the first time; it is wrapped in an IndexIDMap2. `records`,
+    when given, is stored with the DB (see util.db_store); `build_extras(documents)` rebuilds
+    the array bundles stored next to the index, such as the lexical index. `keep_vectors` also
+    stores the full-precision vectors by FAISS id, for exact rescoring of a compressed index.
+    """
+    entries = list({movie_id: (movie_id, text, ref) for movie_id, text, ref in entries}.values())  # last duplicate wins
+    checkpoint = EmbeddingCheckpoint(checkpoint_dir or f"{db_file}.ckpt")
+    previous = load_manifest(db_file)
+
+    live = {}
+    if previous is not None:
+        for doc_id, (movie_id, digest) in enumerate(zip(previous['movie_ids'], previous['hashes'])):
+            if movie_id >= 0:
+                live[int(movie_id)] = (doc_id, int(digest))
+
+    hashes = {movie_id: content_hash(text) for movie_id, text, _ in entries}
+    vectors = {movie_id: vector for movie_id, (digest, vector) in checkpoint.load().items()
+               if hashes.get(movie_id) == digest}
+    pending = [(movie_id, text) for movie_id, text, _ in entries
+               if movie_id not in vectors and live.get(movie_id, (None, None))[1] != hashes[movie_id]]
+    logging.info(f"{len(entries)} movies: {len(live)} indexed, {len(vectors)} checkpointed, {len(pending)} to embed")
+
+    for start in range(0, len(pending), chunk_size):
+        chunk = pending[start:start + chunk_size]
+        embeddings = embed_many([text for _, text in chunk])
+        done = [(movie_id, embedding) for (movie_id, _), embedding in zip(chunk, embeddings) if embedding is not None]
+        if len(done) < len(chunk):
+            logging.warning(f"Skipping {len(chunk) - len(done)} movies whose embeddings failed; they will be retried next run")
+        if done:
+            ids = [movie_id for movie_id, _ in done]
+            chunk_vectors = np.vstack([embedding for _, embedding in done]).astype(np.float32)
+            checkpoint.write_chunk(ids, [hashes[movie_id] for movie_id in ids], chunk_vectors)
+            vectors.update(zip(ids, chunk_vectors))
+        logging.info(f"Embedded {min(start + chunk_size, len(pending))}/{len(pending)} pending movies")
+
+    if previous is not None:
+        documents = list(previous['documents'])
+        index = previous['index']
+        movie_ids = list(previous['movie_ids'])
+        doc_hashes = list(previous['hashes'])
+    else:
+        if not vectors:
+            raise ValueError("No valid embeddings were generated")
+        documents, index, movie_ids, doc_hashes = [], None, [], []
+
+    removed = []
+    added_ids, added_vectors = [], []
+    seen = set()
+    for movie_id, text, ref in entries:
+        seen.add(movie_id)
+        doc_id, digest = live.get(movie_id, (None, None))
+        if digest == hashes[movie_id]:
+            documents[doc_id] = (text, ref)  # unchanged vector, but the reference may have moved
+            continue
+        if movie_id not in vectors:
+            continue  # failed to embed; keep whatever was indexed before
+        if doc_id is not None:
+            removed.append(doc_id)
+            documents[doc_id] = None
+            movie_ids[doc_id] = -1
+        added_ids.append(len(documents))
+        added_vectors.append(vectors[movie_id])
+        documents.append((text, ref))
+        movie_ids.append(movie_id)
+        doc_hashes.append(hashes[movie_id])
+
+    for movie_id, (doc_id, _) in live.items():
+        if movie_id not in seen:
+            removed.append(doc_id)
+            documents[doc_id] = None
+            movie_ids[doc_id] = -1
+
+    if index is None:
+        base_vectors = np.vstack(added_vectors).astype(np.float32)
+        if normalize:
+            faiss.normalize_L2(base_vectors)
+        index = faiss.IndexIDMap2(new_index(base_vectors))
+    if removed and not isinstance(unwrap(index), faiss.IndexFlatCodes):
+        # Only flat code arrays (Flat, SQ, PQ) keep id order on removal; rebuild the others
+        index = rebuild_without(index, removed, previous['vectors'])
+    elif removed:
+        index.remove_ids(np.array(removed, dtype=np.int64))
+    new_vectors = None
+    if added_vectors:
+        new_vectors = np.vstack(added_vectors).astype(np.float32)
+        if normalize:
+            faiss.normalize_L2(new_vectors)
+        index.add_with_ids(new_vectors, np.array(added_ids, dtype=np.int64))
+
+    full_vectors = None
+    if keep_vectors and previous is not None and previous['vectors'] is None:
+        logging.warning(f"{db_file} has no full-precision vectors to update; rebuild it to enable exact rescoring")
+    elif keep_vectors:
+        # Removed ids keep a zero row so that row i stays FAISS id i
+        full_vectors = np.zeros((len(documents), index.d), dtype=np.float32)
+        if previous is not None:
+            full_vectors[:len(previous['vectors'])] = previous['vectors']
+        if removed:
+            full_vectors[removed] = 0
+        if new_vectors is not None:
+            full_vectors[added_ids] = new_vectors
+
+    logging.info(f"Index update: {len(added_ids)} added, {len(removed)} removed, {index.ntotal} vectors total")
+
+    manifest = {'movie_ids': np.array(movie_ids, dtype=np.int64), 'hashes': np.array(doc_hashes, dtype=np.int64)}
+    extras = build_extras(documents) if build_extras is not None else None
+    write_db(db_file, documents, index, records, manifest, extras, full_vectors)
+    checkpoint.clear()
+    logging.info(f"Saved database to {db_file}")
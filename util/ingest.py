@@ -0,0 +1,220 @@
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+AUTH_STATUSES = (401, 403)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: `rate` requests per second on average, at most `burst` back to back.
+
+    Every worker calls `acquire` before a request, so the whole pool stays within the API's
+    quota however many threads are fetching.
+    """
+
+    def __init__(self, rate: float, burst: Optional[int] = None):
+        self.rate = rate
+        self.capacity = float(burst if burst is not None else max(1, int(rate)))
+        self._tokens = self.capacity
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._stamp) * self.rate)
+                self._stamp = now
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                wait_seconds = (1.0 - self._tokens) / self.rate
+            time.sleep(wait_seconds)
+
+
+def pooled_session(pool_size: int, headers: Optional[Dict[str, str]] = None, max_retries: int = 5,
+                   backoff_factor: float = 1.0) -> requests.Session:
+    """A keep-alive session sized for `pool_size` threads that retries 429s (honouring Retry-After) and 5xx."""
+    retry = Retry(total=max_retries, backoff_factor=backoff_factor, status_forcelist=RETRY_STATUSES,
+                  allowed_methods=None, raise_on_status=False, respect_retry_after_header=True)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    if headers:
+        session.headers.update(headers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class Checkpoint:
+    """Append-only journal of finished work keys (pages, app ids); a restarted run skips them."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.done = set()
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.done.update(line.strip() for line in f if line.strip())
+        self._file = None
+
+    def __contains__(self, key: Any) -> bool:
+        return str(key) in self.done
+
+    def mark(self, key: Any):
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._file = open(self.path, "a")
+        self._file.write(f"{key}\n")
+        self._file.flush()
+        self.done.add(str(key))
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class NDJSONWriter:
+    """Appends records as one JSON object per line, flushed as they arrive."""
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        torn = False
+        if os.path.exists(path) and os.path.getsize(path):
+            with open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                torn = f.read(1) != b"\n"
+        self._file = open(path, "a", encoding="utf-8")
+        if torn:
+            # A crash cut the last line short; end it so the next record starts on its own line
+            self._file.write("\n")
+
+    def write(self, records: Iterable[Dict[str, Any]]) -> int:
+        count = 0
+        for record in records:
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            count += 1
+        self._file.flush()
+        return count
+
+    def close(self):
+        self._file.close()
+
+
+def read_ndjson(path: str) -> Iterator[Dict[str, Any]]:
+    """Yield the records of an NDJSON file, skipping a torn last line left by a crash."""
+    if not os.path.exists(path):
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                logging.warning(f"Skipping malformed line {line_number} of {path}")
+
+
+def compact(ndjson_path: str, json_path: str, key: str) -> int:
+    """Write the NDJSON records as a JSON array, keeping the last record per `key`; returns the record count."""
+    records = {}
+    for record in read_ndjson(ndjson_path):
+        records[record.get(key)] = record
+    tmp_path = f"{json_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(list(records.values()), f, indent=4)
+    os.replace(tmp_path, json_path)
+    return len(records)
+
+
+def clear_run(*paths: str):
+    """Remove a finished run's journals so the next run fetches everything again."""
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def is_auth_error(error: Exception) -> bool:
+    response = getattr(error, "response", None)
+    return isinstance(error, requests.HTTPError) and response is not None and response.status_code in AUTH_STATUSES
+
+
+def ingest(keys: Iterable[Any], fetch: Callable[[Any], Optional[List[Dict[str, Any]]]], output: NDJSONWriter,
+           checkpoint: Optional[Checkpoint] = None, limiter: Optional[TokenBucket] = None, workers: int = 8,
+           log_every: int = 100, total: Optional[int] = None) -> Dict[str, int]:
+    """
+    Fetch every key not yet in `checkpoint` on `workers` threads, rate limited by `limiter`.
+
+    `fetch(key)` returns the key's records (possibly none), or raises to leave the key for
+    the next run. A 401 or 403 aborts the whole run instead, since every other key would be
+    refused the same way. Records are appended to `output` and the key checkpointed as each fetch
+    completes, so a crash loses at most the requests in flight. Without a checkpoint the
+    caller is expected to pass only unfinished keys. `total` (the number of keys to fetch)
+    adds an ETA to the progress log.
+    """
+    pending_keys = (key for key in keys if checkpoint is None or key not in checkpoint)
+    stats = {"fetched": 0, "records": 0, "failed": 0}
+    start = time.perf_counter()
+
+    def task(key):
+        if limiter is not None:
+            limiter.acquire()
+        return fetch(key)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ingest") as executor:
+        in_flight = {}
+        exhausted = False
+        while True:
+            # Keep a bounded window of submitted keys rather than queueing the whole key space
+            while not exhausted and len(in_flight) < workers * 4:
+                key = next(pending_keys, None)
+                if key is None:
+                    exhausted = True
+                    break
+                in_flight[executor.submit(task, key)] = key
+            if not in_flight:
+                break
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                key = in_flight.pop(future)
+                try:
+                    records = future.result()
+                except Exception as e:
+                    if is_auth_error(e):
+                        for pending in in_flight:
+                            pending.cancel()
+                        if checkpoint is not None:
+                            checkpoint.close()
+                        raise
+                    stats["failed"] += 1
+                    logging.error(f"Fetching {key} failed, will retry on the next run: {str(e)}")
+                    continue
+                stats["records"] += output.write(records or [])
+                if checkpoint is not None:
+                    checkpoint.mark(key)
+                stats["fetched"] += 1
+                if stats["fetched"] % log_every == 0:
+                    elapsed = time.perf_counter() - start
+                    rate = stats['fetched'] / elapsed
+                    eta = f", ETA {(total - stats['fetched']) / rate:.0f}s" if total else ""
+                    logging.info(f"Fetched {stats['fetched']}{f'/{total}' if total else ''} keys, "
+                                 f"{stats['records']} records ({rate:.2f} keys/s{eta})")
+
+    if checkpoint is not None:
+        checkpoint.close()
+    logging.info(f"Ingestion finished: {stats['fetched']} keys fetched, {stats['records']} records, "
+                 f"{stats['failed']} failed in {time.perf_counter() - start:.1f}s")
+    return stats
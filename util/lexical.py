@@ -0,0 +1,138 @@
+import hashlib
+import math
+import re
+import unicodedata
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+TOKEN_RE = re.compile(r"\w+")
+TITLE_WEIGHT = 3  # a title token counts as this many overview tokens
+K1 = 1.2
+B = 0.75
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_RE.findall(unicodedata.normalize("NFKC", text).casefold())
+
+
+def title_key(text: str) -> int:
+    """64-bit key of a normalized title, so exact-title lookups need no string table."""
+    normalized = " ".join(tokenize(text)).encode("utf-8")
+    return int.from_bytes(hashlib.blake2b(normalized, digest_size=8).digest(), "little", signed=True)
+
+
+class LexicalIndex:
+    """
+    BM25 inverted index over movie titles and overviews.
+
+    Posting lists are stored CSR-style: for term t, `doc_ids[offsets[t]:offsets[t + 1]]`
+    and the matching `tfs` (title tokens weighted by TITLE_WEIGHT). Exact titles are
+    kept as sorted 64-bit keys for the no-embedding fast path. Doc ids are FAISS ids.
+    """
+
+    def __init__(self, terms: List[str], offsets: np.ndarray, doc_ids: np.ndarray, tfs: np.ndarray,
+                 doc_lengths: np.ndarray, title_keys: np.ndarray, title_docs: np.ndarray):
+        self.vocabulary = {term: i for i, term in enumerate(terms)}
+        self.terms = terms
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.doc_lengths = doc_lengths
+        self.title_keys = title_keys
+        self.title_docs = title_docs
+        live = doc_lengths > 0
+        self.n_docs = int(live.sum())
+        self.avg_length = float(doc_lengths[live].mean()) if self.n_docs else 0.0
+
+    @classmethod
+    def build(cls, docs: Iterable[Tuple[int, str, str]], n_docs: int) -> "LexicalIndex":
+        """`docs` yields (doc id, title, overview); `n_docs` bounds the doc ids (len(documents))."""
+        vocabulary: Dict[str, int] = {}
+        term_ids, doc_ids, tfs = [], [], []
+        doc_lengths = np.zeros(n_docs, dtype=np.float32)
+        title_keys, title_docs = [], []
+        for doc_id, title, overview in docs:
+            counts: Dict[int, int] = {}
+            title_tokens = tokenize(title or "")
+            for token in title_tokens:
+                term = vocabulary.setdefault(token, len(vocabulary))
+                counts[term] = counts.get(term, 0) + TITLE_WEIGHT
+            for token in tokenize(overview or ""):
+                term = vocabulary.setdefault(token, len(vocabulary))
+                counts[term] = counts.get(term, 0) + 1
+            term_ids.extend(counts.keys())
+            doc_ids.extend([doc_id] * len(counts))
+            tfs.extend(counts.values())
+            doc_lengths[doc_id] = sum(counts.values())
+            if title_tokens:
+                title_keys.append(title_key(title))
+                title_docs.append(doc_id)
+
+        term_ids = np.array(term_ids, dtype=np.int64)
+        order = np.argsort(term_ids, kind="stable")
+        offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(term_ids, minlength=len(vocabulary)), out=offsets[1:])
+        keys = np.array(title_keys, dtype=np.int64)
+        key_order = np.argsort(keys, kind="stable")
+        return cls(list(vocabulary), offsets, np.array(doc_ids, dtype=np.int32)[order],
+                   np.minimum(np.array(tfs, dtype=np.int64)[order], np.iinfo(np.uint16).max).astype(np.uint16),
+                   doc_lengths, keys[key_order], np.array(title_docs, dtype=np.int32)[key_order])
+
+    def exact_title(self, query: str) -> np.ndarray:
+        """Doc ids whose normalized title equals the normalized query."""
+        key = title_key(query)
+        lo = np.searchsorted(self.title_keys, key, side="left")
+        hi = np.searchsorted(self.title_keys, key, side="right")
+        return self.title_docs[lo:hi]
+
+    def search(self, query: str, k: int, mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Top-k (doc ids, BM25 scores), best first, among the docs set in `mask` if given."""
+        scores = None
+        for token in set(tokenize(query)):
+            term = self.vocabulary.get(token)
+            if term is None:
+                continue
+            start, end = self.offsets[term], self.offsets[term + 1]
+            docs = self.doc_ids[start:end]
+            tf = self.tfs[start:end].astype(np.float32)
+            idf = math.log(1.0 + (self.n_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+            norm = K1 * (1.0 - B + B * self.doc_lengths[docs] / self.avg_length)
+            if scores is None:
+                scores = np.zeros(len(self.doc_lengths), dtype=np.float32)
+            scores[docs] += idf * tf * (K1 + 1.0) / (tf + norm)
+        if scores is None:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        if mask is not None:
+            scores[~mask] = 0.0
+        candidates = np.flatnonzero(scores)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return candidates, scores[candidates]
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        return {
+            'terms': np.frombuffer("\n".join(self.terms).encode("utf-8"), dtype=np.uint8),
+            'offsets': self.offsets,
+            'doc_ids': self.doc_ids,
+            'tfs': self.tfs,
+            'doc_lengths': self.doc_lengths,
+            'title_keys': self.title_keys,
+            'title_docs': self.title_docs,
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> "LexicalIndex":
+        terms = bytes(arrays['terms']).decode("utf-8")
+        return cls(terms.split("\n") if terms else [], arrays['offsets'], arrays['doc_ids'], arrays['tfs'],
+                   arrays['doc_lengths'], arrays['title_keys'], arrays['title_docs'])
+
+
+def reciprocal_rank_fusion(rankings: Iterable[Iterable[int]], k: int = 60) -> List[Tuple[int, float]]:
+    """Fuse several best-first rankings of doc ids; returns (doc id, fused score) best first."""
+    fused: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            fused[int(doc_id)] = fused.get(int(doc_id), 0.0) + 1.0 / (k + rank + 1)
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)
@@ -0,0 +1,147 @@
+import bisect
+import logging
+import random
+import threading
+import time
+from typing import Dict, List, Sequence
+
+# Seconds; wide enough for a sub-millisecond normalize and a multi-second LLM call
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0)
+
+
+class Histogram:
+    """
+    Latency histogram with one series per label value, rendered in the Prometheus text format.
+
+    Each series keeps non-cumulative bucket counts plus the sum and count, so an observation
+    is a bisect and three additions under a lock; buckets are accumulated only when rendered.
+    """
+
+    def __init__(self, name: str, help: str, label: str, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[str, List] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: str, seconds: float):
+        slot = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(value)
+            if series is None:
+                series = self._series[value] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][slot] += 1
+            series[1] += seconds
+            series[2] += 1
+
+    def time(self, value: str) -> "Span":
+        return Span(self, value)
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        """Count, mean and sum per label value, for JSON stats."""
+        with self._lock:
+            return {value: {"count": count, "sum": round(total, 6), "mean": round(total / count, 6) if count else 0.0}
+                    for value, (_, total, count) in self._series.items()}
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {value: (list(counts), total, count) for value, (counts, total, count) in self._series.items()}
+        for value in sorted(series):
+            counts, total, count = series[value]
+            label = f'{self.label}="{value}"'
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {count}')
+            lines.append(f"{self.name}_sum{{{label}}} {total}")
+            lines.append(f"{self.name}_count{{{label}}} {count}")
+        return lines
+
+
+class Counter:
+    """Monotonic counter with one series per label value."""
+
+    def __init__(self, name: str, help: str, label: str):
+        self.name = name
+        self.help = help
+        self.label = label
+        self._values: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value: str, amount: float = 1):
+        with self._lock:
+            self._values[value] = self._values.get(value, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = dict(self._values)
+        for value in sorted(values):
+            lines.append(f'{self.name}{{{self.label}="{value}"}} {values[value]}')
+        return lines
+
+
+class Span:
+    """Context manager observing the time spent in its block into a histogram series."""
+
+    __slots__ = ("histogram", "value", "start")
+
+    def __init__(self, histogram: Histogram, value: str):
+        self.histogram = histogram
+        self.value = value
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(self.value, time.perf_counter() - self.start)
+        return False
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def histogram(self, name: str, help: str, label: str, buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, help, label, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, label: str) -> Counter:
+        metric = Counter(name, help, label)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Every metric in the Prometheus text exposition format (version 0.0.4)."""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+REGISTRY = Registry()
+STAGE_SECONDS = REGISTRY.histogram("gptrex_stage_seconds", "Time spent in each stage of serving a request", "stage")
+REQUEST_SECONDS = REGISTRY.histogram("gptrex_request_seconds", "End-to-end time of each endpoint", "endpoint")
+UPSTREAM_TTFB_SECONDS = REGISTRY.histogram("gptrex_upstream_ttfb_seconds",
+                                           "Time to the first byte of each upstream model call", "call")
+EVENTS = REGISTRY.counter("gptrex_events_total", "Per-hit and per-line events counted instead of logged", "event")
+
+
+def span(stage: str) -> Span:
+    """`with span("index_search"): ...` times a stage into STAGE_SECONDS."""
+    return Span(STAGE_SECONDS, stage)
+
+
+def sampled(level: int, rate: float) -> bool:
+    """
+    Whether to emit a hot-path log line: only when `level` is enabled, and then for about
+    `rate` of the calls. Check it before building the message so a skipped line costs nothing.
+    """
+    return logging.getLogger().isEnabledFor(level) and (rate >= 1.0 or random.random() < rate)
@@ -0,0 +1,66 @@
+import json
+from collections.abc import Sequence
+from typing import Any, Dict, Iterable, Optional
+
+from util.catalogue import CompactRecords
+from util.db_store import RecordStore
+
+
+def _fragment(raw: bytes) -> bytes:
+    # Drop the closing brace so fields can be appended without re-serializing the record
+    return raw[:raw.rindex(b"}")]
+
+
+class RecordIndex(Sequence):
+    """
+    Movie records prepared once at load time for the search hot path.
+
+    Holds an id -> row dict and, per row, the record serialized as a JSON object
+    without its closing brace, so a search hit is emitted by appending its score
+    fields to bytes instead of copying and re-encoding the dict.
+    """
+
+    def __init__(self, records: Sequence):
+        self.records = records
+        if isinstance(records, (RecordStore, CompactRecords)):
+            # Fragments are built lazily from the memory-mapped or compact rows
+            self._fragments = None
+            ids = records.ids if records.ids is not None else [records[i].get('id') for i in range(len(records))]
+        else:
+            self._fragments = [_fragment(json.dumps(record, separators=(",", ":")).encode("utf-8")) for record in records]
+            ids = [record.get('id') for record in records]
+        self._rows = {int(movie_id): row for row, movie_id in enumerate(ids) if movie_id is not None}
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __getitem__(self, row):
+        record = self.records[row]
+        return dict(record) if isinstance(record, dict) else record
+
+    def row_of(self, movie_id: int) -> Optional[int]:
+        return self._rows.get(int(movie_id))
+
+    def get_by_id(self, movie_id: int) -> Optional[Dict[str, Any]]:
+        row = self.row_of(movie_id)
+        return None if row is None else self[row]
+
+    def fragment(self, row: int) -> bytes:
+        if self._fragments is not None:
+            return self._fragments[row]
+        return _fragment(self.records.raw(row))
+
+    def hit_payload(self, row: int, searched_overview: str, similarity_score: float) -> bytes:
+        """The JSON object of a search hit: the stored record plus its overview and score."""
+        fragment = self.fragment(row)
+        separator = b"," if len(fragment) > 1 else b""
+        return b"".join((fragment, separator, b'"searched_overview":', json.dumps(searched_overview).encode("utf-8"),
+                         b',"similarity_score":', repr(float(similarity_score)).encode("ascii"), b"}"))
+
+
+def as_record_index(records: Sequence) -> RecordIndex:
+    return records if isinstance(records, RecordIndex) else RecordIndex(records)
+
+
+def json_array(payloads: Iterable[bytes]) -> bytes:
+    return b"[" + b",".join(payloads) + b"]"
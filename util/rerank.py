@@ -0,0 +1,168 @@
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from util.embedding_cache import normalize_text
+
+DEFAULT_PROMPT = (
+    "Rate how well each movie matches the search query on a scale from 0 (unrelated) to 10 (exactly what was asked for).\n"
+    "Query: {query}\n\nMovies:\n{movies}\n\n"
+    'Answer with JSON only: {{"scores": [one number per movie, in the order listed]}}'
+)
+
+Candidate = Tuple[int, str, str]  # (movie id, title, overview)
+
+
+class ScoreCache:
+    """Bounded LRU of relevance scores keyed on (model, normalized query, movie id), with an optional TTL."""
+
+    def __init__(self, max_entries: int = 50000, ttl: Optional[float] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: tuple) -> Optional[float]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                score, stamp = entry
+                if self.ttl is None or time.time() - stamp <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return score
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: tuple, score: float):
+        with self._lock:
+            self._entries[key] = (score, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+class Reranker:
+    """
+    LLM relevance scoring of retrieved candidates within a latency budget.
+
+    Uncached candidates are split into a few prompts of `batch_size` movies each and
+    scored concurrently on a bounded pool. If every batch is back within `budget`
+    seconds the candidates are reordered by score; otherwise the caller keeps the
+    retrieval order, and late batches still land in the cache for the next request.
+    """
+
+    def __init__(self, api_url: str, model: str, batch_size: int = 5, workers: int = 4, budget: float = 2.0,
+                 timeout: Tuple[float, float] = (5.0, 30.0), overview_chars: int = 300,
+                 cache_entries: int = 50000, cache_ttl: Optional[float] = None, prompt: str = DEFAULT_PROMPT):
+        self.api_url = api_url
+        self.model = model
+        self.batch_size = batch_size
+        self.workers = workers
+        self.budget = budget
+        self.timeout = timeout
+        self.overview_chars = overview_chars
+        self.prompt = prompt
+        self.cache = ScoreCache(cache_entries, cache_ttl)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rerank")
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self.reranked = 0
+        self.fallbacks = 0
+        self.shed = 0
+
+    def _cache_key(self, query: str, movie_id: int) -> tuple:
+        return self.model, normalize_text(query), int(movie_id)
+
+    def score_batch(self, query: str, candidates: Sequence[Candidate]) -> List[float]:
+        """Score one batch with a single generate call; caches and returns the scores in candidate order."""
+        movies = "\n".join(f"{i + 1}. {title}: {overview[:self.overview_chars]}"
+                           for i, (_, title, overview) in enumerate(candidates))
+        payload = {
+            "model": self.model,
+            "prompt": self.prompt.format(query=query, movies=movies),
+            "format": "json",
+            "stream": False,
+            "options": {"temperature": 0}
+        }
+        try:
+            response = self.session.post(self.api_url, json=payload, timeout=self.timeout)
+            response.raise_for_status()
+            scores = json.loads(response.json().get('response', '{}')).get('scores')
+            if not isinstance(scores, list) or len(scores) != len(candidates):
+                raise ValueError(f"Expected {len(candidates)} scores, got {scores!r}")
+            scores = [min(max(float(score), 0.0), 10.0) for score in scores]
+            for (movie_id, _, _), score in zip(candidates, scores):
+                self.cache.put(self._cache_key(query, movie_id), score)
+            return scores
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def scores(self, query: str, candidates: Sequence[Candidate]) -> Optional[List[float]]:
+        """Relevance scores aligned with `candidates`, or None when they could not all be had within the budget."""
+        deadline = time.perf_counter() + self.budget
+        scores = [self.cache.get(self._cache_key(query, movie_id)) for movie_id, _, _ in candidates]
+        missing = [i for i, score in enumerate(scores) if score is None]
+        batches = [missing[i:i + self.batch_size] for i in range(0, len(missing), self.batch_size)]
+
+        with self._lock:
+            # Shed instead of queueing behind a saturated pool; the answer would miss its budget anyway
+            if self._in_flight + len(batches) > 2 * self.workers:
+                self.shed += 1
+                return None
+            self._in_flight += len(batches)
+
+        futures = {self._executor.submit(self.score_batch, query, [candidates[i] for i in batch]): batch
+                   for batch in batches}
+        done, pending = wait(futures, timeout=max(deadline - time.perf_counter(), 0), return_when=FIRST_EXCEPTION)
+        failed = [future for future in done if future.exception() is not None]
+        if pending or failed:
+            for future in failed:
+                logging.error(f"Re-rank batch failed: {future.exception()}")
+            logging.warning(f"Re-ranking '{query}' fell back to retrieval order "
+                            f"({len(pending)} batches over the {self.budget}s budget, {len(failed)} failed)")
+            with self._lock:
+                self.fallbacks += 1
+            return None
+
+        for future, batch in futures.items():
+            for i, score in zip(batch, future.result()):
+                scores[i] = score
+        with self._lock:
+            self.reranked += 1
+        return scores
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            counters = {"reranked": self.reranked, "fallbacks": self.fallbacks, "shed": self.shed,
+                        "in_flight": self._in_flight}
+        return {**counters, "cache": self.cache.stats()}
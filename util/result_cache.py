@@ -0,0 +1,122 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+import faiss
+import numpy as np
+
+DEFAULT_THRESHOLD = 0.95
+DEFAULT_MAX_ENTRIES = 2048
+DEFAULT_TTL = 600.0
+DEFAULT_PROBE = 8
+
+
+def mask_digest(mask: Optional[np.ndarray]) -> Optional[bytes]:
+    """A short key for a filter mask, so results are only shared between requests with the same filters."""
+    if mask is None:
+        return None
+    return hashlib.blake2b(np.packbits(mask).tobytes(), digest_size=16).digest()
+
+
+class SemanticCache:
+    """
+    Recently answered queries, found again by embedding rather than by text.
+
+    Query vectors live in a small flat inner-product FAISS index next to their result
+    lists. A new query whose normalized vector is within `threshold` cosine of a cached one
+    with the same `signature` (the search parameters) gets the cached results. Entries
+    expire after `ttl` seconds and the oldest are evicted beyond `max_entries`. The cache
+    belongs to one DB generation and is dropped along with it.
+    """
+
+    def __init__(self, threshold: float = DEFAULT_THRESHOLD, max_entries: int = DEFAULT_MAX_ENTRIES,
+                 ttl: Optional[float] = DEFAULT_TTL, probe: int = DEFAULT_PROBE):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.probe = probe
+        self._index = None
+        self._entries: "OrderedDict[int, tuple]" = OrderedDict()  # id -> (signature, results, stored at), oldest first
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _normalize(vector: np.ndarray) -> np.ndarray:
+        query = np.array(vector, dtype=np.float32).reshape(1, -1)
+        faiss.normalize_L2(query)
+        return query
+
+    def get(self, vector: np.ndarray, signature: Hashable) -> Optional[Any]:
+        """The results of the closest cached query with this signature within the threshold, or None."""
+        query = self._normalize(vector)
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            if self._index is None or not self._entries or query.shape[1] != self._index.d:
+                self.misses += 1
+                return None
+            similarities, ids = self._index.search(query, min(self.probe, len(self._entries)))
+            for similarity, entry_id in zip(similarities[0], ids[0]):
+                if entry_id < 0 or similarity < self.threshold:
+                    break
+                entry = self._entries.get(int(entry_id))
+                if entry is not None and entry[0] == signature:
+                    self.hits += 1
+                    return list(entry[1])
+            self.misses += 1
+            return None
+
+    def put(self, vector: np.ndarray, signature: Hashable, results: Any):
+        query = self._normalize(vector)
+        with self._lock:
+            if self._index is None:
+                self._index = faiss.IndexIDMap2(faiss.IndexFlatIP(query.shape[1]))
+            elif query.shape[1] != self._index.d:
+                return
+            entry_id = self._next_id
+            self._next_id += 1
+            self._index.add_with_ids(query, np.array([entry_id], dtype=np.int64))
+            self._entries[entry_id] = (signature, results, time.time())
+            self._expire(time.time())
+            if len(self._entries) > self.max_entries:
+                self._remove([next(iter(self._entries))])
+                self.evictions += 1
+
+    def _expire(self, now: float):
+        if self.ttl is None:
+            return
+        expired = []
+        for entry_id, (_, _, stored_at) in self._entries.items():
+            if now - stored_at <= self.ttl:
+                break  # entries are in insertion order, so the rest are younger
+            expired.append(entry_id)
+        if expired:
+            self._remove(expired)
+            self.evictions += len(expired)
+
+    def _remove(self, entry_ids):
+        for entry_id in entry_ids:
+            del self._entries[entry_id]
+        self._index.remove_ids(np.array(entry_ids, dtype=np.int64))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._index = None
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "threshold": self.threshold,
+            }
@@ -0,0 +1,393 @@
+import argparse
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from multiprocessing.connection import Connection, Listener, answer_challenge, deliver_challenge
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import faiss
+import numpy as np
+
+from util.ann import restricted_search, unwrap
+from util.db_store import read_db
+from util.filters import filtered_search_parameters
+
+SHARD_FILE = "shard_{:03d}.faiss"
+META_FILE = "meta.json"
+AUTHKEY_ENV = "SHARD_AUTHKEY"
+CONNECT_TIMEOUT = 1.0  # seconds to reach a shard server, bounded by the request deadline
+REPLY_GRACE = 0.5  # seconds past the deadline to finish receiving a reply that arrived in time
+SPLIT_CHUNK = 65536
+
+Address = Tuple[str, int]
+
+
+def parse_address(address: str) -> Address:
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+def shard_authkey(authkey: Optional[bytes] = None) -> bytes:
+    """
+    The key shard connections authenticate with: `authkey`, else $SHARD_AUTHKEY.
+
+    Shard messages are pickles, so whoever passes the handshake can run code in the shard
+    server. There is no default key, on loopback or any other interface.
+    """
+    authkey = authkey or os.getenv(AUTHKEY_ENV, "").encode("utf-8")
+    if not authkey:
+        raise ValueError(f"Set {AUTHKEY_ENV} to a secret shared by the shard servers and the search server")
+    return authkey
+
+
+def shard_files(shard_dir: str) -> List[str]:
+    return sorted(glob.glob(os.path.join(shard_dir, "shard_*.faiss")))
+
+
+def split_index(index: Any, n_shards: int, shard_dir: str, vectors: Optional[np.ndarray] = None):
+    """
+    Partition `index` into `n_shards` IDMap2 indexes by FAISS id (id % n_shards) and write them to `shard_dir`.
+
+    Each shard is an empty clone of the trained index refilled with its own ids, so shards
+    keep the global ids and their results merge without translation. Vectors come from
+    `vectors` (the DB's full-precision copy) when given, otherwise they are reconstructed
+    from the index, which is lossy for compressed codes.
+    """
+    is_idmap = isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2))
+    inner = faiss.downcast_index(index.index) if is_idmap else index
+    ids = faiss.vector_to_array(index.id_map).astype(np.int64) if is_idmap else np.arange(index.ntotal, dtype=np.int64)
+    if vectors is None:
+        base = unwrap(inner)
+        if isinstance(base, faiss.IndexIVF):
+            base.make_direct_map()
+
+    empty = faiss.clone_index(inner)
+    empty.reset()
+    shards = [faiss.IndexIDMap2(faiss.clone_index(empty)) for _ in range(n_shards)]
+    for start in range(0, len(ids), SPLIT_CHUNK):
+        chunk_ids = ids[start:start + SPLIT_CHUNK]
+        if vectors is not None:
+            chunk = np.ascontiguousarray(vectors[chunk_ids], dtype=np.float32)
+        else:
+            chunk = inner.reconstruct_n(start, len(chunk_ids))
+        owners = chunk_ids % n_shards
+        for shard_id, shard in enumerate(shards):
+            selected = owners == shard_id
+            if selected.any():
+                shard.add_with_ids(chunk[selected], chunk_ids[selected])
+        logging.info(f"Split {min(start + SPLIT_CHUNK, len(ids))}/{len(ids)} vectors")
+
+    os.makedirs(shard_dir, exist_ok=True)
+    for stale in shard_files(shard_dir):
+        os.remove(stale)
+    for shard_id, shard in enumerate(shards):
+        faiss.write_index(shard, os.path.join(shard_dir, SHARD_FILE.format(shard_id)))
+    with open(os.path.join(shard_dir, META_FILE), "w") as f:
+        json.dump({'shards': n_shards, 'ntotal': int(index.ntotal), 'dim': int(index.d),
+                   'sizes': [int(shard.ntotal) for shard in shards]}, f)
+    logging.info(f"Wrote {n_shards} shards of {[shard.ntotal for shard in shards]} vectors to {shard_dir}")
+
+
+def split_db(db_path: str, n_shards: int, shard_dir: Optional[str] = None) -> str:
+    data = read_db(db_path, mmap=False)  # a memory-mapped index cannot be cloned and emptied
+    shard_dir = shard_dir or f"{db_path.rstrip(os.sep)}.shards"
+    split_index(data['index'], n_shards, shard_dir, data['vectors'])
+    return shard_dir
+
+
+class ShardServer:
+    """
+    Serves searches over one shard index to `ShardedIndex` clients on a local or TCP socket.
+
+    Every client connection gets its own thread; FAISS releases the GIL while searching,
+    so concurrent queries run in parallel up to the shard's OpenMP threads.
+    """
+
+    def __init__(self, index: Any, address: Address = ("127.0.0.1", 0), authkey: Optional[bytes] = None):
+        self.index = index
+        self.listener = Listener(address, authkey=shard_authkey(authkey))
+
+    @property
+    def address(self) -> Address:
+        return self.listener.address
+
+    def search(self, queries: np.ndarray, k: int, options: Dict[str, Any]) -> Tuple[np.ndarray, np.ndarray]:
+        mask = None
+        if options.get('mask') is not None:
+            mask = np.unpackbits(options['mask'], count=options['mask_size'], bitorder="little").astype(bool)
+        params = filtered_search_parameters(self.index, options.get('nprobe'), options.get('ef_search'), mask,
+                                            options.get('max_widening', 16))
+        return self.index.search(queries, k, params=params)
+
+    def handle(self, request: Tuple) -> Tuple:
+        kind = request[0]
+        if kind == "search":
+            return self.search(*request[1:])
+        if kind == "score":
+            return (restricted_search(self.index, *request[1:]),)
+        if kind == "info":
+            return int(self.index.d), int(self.index.ntotal)
+        raise ValueError(f"Unknown shard request '{kind}'")
+
+    def serve_connection(self, conn):
+        with conn:
+            while True:
+                try:
+                    request = conn.recv()
+                except (EOFError, ConnectionResetError):
+                    return
+                try:
+                    reply = ("ok",) + tuple(self.handle(request))
+                except Exception as e:
+                    logging.error(f"Shard request failed: {str(e)}", exc_info=True)
+                    reply = ("error", str(e))
+                conn.send(reply)
+
+    def serve_forever(self):
+        logging.info(f"Serving {self.index.ntotal} vectors on {self.address}")
+        while True:
+            try:
+                conn = self.listener.accept()
+            except Exception as e:
+                logging.warning(f"Rejected shard connection: {str(e)}")
+                continue
+            threading.Thread(target=self.serve_connection, args=(conn,), daemon=True).start()
+
+
+def serve(shard_file: str, address: Address = ("127.0.0.1", 0), authkey: Optional[bytes] = None,
+          threads: Optional[int] = None, ready: Any = None):
+    """Load a shard (memory-mapped where possible) and serve it; `ready` is a pipe end that receives the bound address."""
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    authkey = shard_authkey(authkey)  # fail before loading the shard
+    if threads:
+        faiss.omp_set_num_threads(threads)
+    try:
+        index = faiss.read_index(shard_file, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    except RuntimeError:
+        index = faiss.read_index(shard_file)
+    server = ShardServer(index, address, authkey)
+    if ready is not None:
+        ready.send(server.address)
+        ready.close()
+    server.serve_forever()
+
+
+def spawn_local(shard_dir: str, authkey: Optional[bytes] = None,
+                threads: Optional[int] = None) -> Tuple[List[Address], List[multiprocessing.Process], bytes]:
+    """
+    Start one local server process per shard in `shard_dir`; they exit with the parent.
+
+    Returns their addresses, the processes and the key to connect with: a random one unless
+    `authkey` is given, handed to the children with their arguments rather than the environment.
+    """
+    files = shard_files(shard_dir)
+    if not files:
+        raise ValueError(f"No shards in {shard_dir}; create them with python -m util.shards split")
+    authkey = authkey or os.urandom(32)
+    context = multiprocessing.get_context("spawn")
+    addresses, processes = [], []
+    for shard_file in files:
+        parent, child = context.Pipe(duplex=False)
+        process = context.Process(target=serve, args=(shard_file, ("127.0.0.1", 0), authkey, threads, child),
+                                  name=f"shard-{os.path.basename(shard_file)}", daemon=True)
+        process.start()
+        child.close()
+        addresses.append(parent.recv())
+        processes.append(process)
+    logging.info(f"Started {len(processes)} local shard processes on {addresses}")
+    return addresses, processes, authkey
+
+
+class ShardClient:
+    """Pooled connections to one shard server; a connection is only reused after a complete reply."""
+
+    def __init__(self, address: Address, authkey: Optional[bytes] = None, connect_timeout: float = CONNECT_TIMEOUT):
+        self.address = address
+        self.authkey = shard_authkey(authkey)
+        self.connect_timeout = connect_timeout
+        self._pool: "queue.LifoQueue" = queue.LifoQueue()
+
+    def connect(self, deadline: Optional[float] = None) -> Connection:
+        """
+        A new authenticated connection, like `multiprocessing.connection.Client` but giving up
+        after `connect_timeout` (or at `deadline`) when the shard is down or unreachable.
+        """
+        timeout = self.connect_timeout
+        if deadline is not None:
+            timeout = max(min(timeout, deadline - time.perf_counter()), 0.001)
+        try:
+            with socket.create_connection(self.address, timeout=timeout) as sock:
+                sock.setblocking(True)
+                conn = Connection(sock.detach())
+        except socket.timeout:
+            raise TimeoutError(f"Shard {self.address} did not accept a connection in time") from None
+        try:
+            if not conn.poll(timeout):
+                raise TimeoutError(f"Shard {self.address} did not start the handshake in time")
+            answer_challenge(conn, self.authkey)
+            deliver_challenge(conn, self.authkey)
+        except BaseException:
+            conn.close()
+            raise
+        return conn
+
+    def call(self, request: Tuple, deadline: Optional[float] = None) -> Tuple:
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self.connect(deadline)
+        try:
+            conn.send(request)
+            timeout = None if deadline is None else max(deadline - time.perf_counter(), 0)
+            if not conn.poll(timeout):
+                raise TimeoutError(f"Shard {self.address} did not answer in time")
+            reply = conn.recv()
+        except EOFError:
+            conn.close()
+            raise ConnectionError(f"Shard {self.address} closed the connection")
+        except BaseException:
+            # The reply may still arrive later; never hand this connection to another request
+            conn.close()
+            raise
+        self._pool.put(conn)
+        if reply[0] == "error":
+            raise RuntimeError(f"Shard {self.address}: {reply[1]}")
+        return reply[1:]
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+def merge_top_k(results: Sequence[Tuple[np.ndarray, np.ndarray]], k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Merge per-shard (distances, labels) of inner-product searches into the global top-k."""
+    distances = np.hstack([d for d, _ in results])
+    labels = np.hstack([l for _, l in results])
+    order = np.argsort(-distances, axis=1, kind="stable")[:, :k]
+    return np.take_along_axis(distances, order, axis=1), np.take_along_axis(labels, order, axis=1)
+
+
+class ShardedIndex:
+    """
+    A FAISS-like index whose vectors live in shard server processes (`processes`, if it started them).
+
+    `search` fans the queries out to every shard in parallel and merges their top-k
+    lists. A shard that errors or misses `timeout` is left out of that answer (and
+    counted), so one slow process degrades recall instead of stalling the request.
+    """
+
+    def __init__(self, addresses: Sequence[Address], authkey: Optional[bytes] = None, timeout: float = 1.0,
+                 workers: Optional[int] = None, processes: Sequence[multiprocessing.Process] = ()):
+        self.clients = [ShardClient(address, authkey, min(CONNECT_TIMEOUT, timeout)) for address in addresses]
+        self.processes = list(processes)  # local shard servers to stop on close
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers or 8 * len(self.clients), thread_name_prefix="shard")
+        self._lock = threading.Lock()
+        self.searches = 0
+        self.partial = 0
+        self.shard_failures = 0
+
+        info = [client.call(("info",)) for client in self.clients]
+        dims = {d for d, _ in info}
+        if len(dims) != 1:
+            raise ValueError(f"Shards disagree on the vector dimension: {sorted(dims)}")
+        self.d = dims.pop()
+        self.ntotal = sum(ntotal for _, ntotal in info)
+
+    @staticmethod
+    def parameters(nprobe: Optional[int] = None, ef_search: Optional[int] = None, mask: Optional[np.ndarray] = None,
+                   max_widening: float = 16) -> Dict[str, Any]:
+        """Search options for `search`; each shard turns them into its own FAISS parameters."""
+        options = {'nprobe': nprobe, 'ef_search': ef_search, 'max_widening': max_widening}
+        if mask is not None:
+            options['mask'] = np.packbits(mask, bitorder="little")
+            options['mask_size'] = len(mask)
+        return options
+
+    def _fan_out(self, requests: Dict[int, Tuple]) -> Dict[int, Tuple]:
+        deadline = time.perf_counter() + self.timeout
+        futures = {shard_id: self._executor.submit(self.clients[shard_id].call, request, deadline)
+                   for shard_id, request in requests.items()}
+        replies = {}
+        for shard_id, future in futures.items():
+            try:
+                # A worker stuck connecting or sending is given up on shortly after the deadline
+                replies[shard_id] = future.result(timeout=max(deadline - time.perf_counter(), 0) + REPLY_GRACE)
+            except FutureTimeout:
+                logging.warning(f"Shard {shard_id} left out of the results: no answer in time")
+                with self._lock:
+                    self.shard_failures += 1
+            except Exception as e:
+                logging.warning(f"Shard {shard_id} left out of the results: {str(e)}")
+                with self._lock:
+                    self.shard_failures += 1
+        with self._lock:
+            self.searches += 1
+            if len(replies) < len(requests):
+                self.partial += 1
+        if requests and not replies:
+            raise RuntimeError("No shard answered the search")
+        return replies
+
+    def search(self, queries: np.ndarray, k: int, params: Optional[Dict[str, Any]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        request = ("search", queries, int(k), params or {})
+        replies = self._fan_out({shard_id: request for shard_id in range(len(self.clients))})
+        return merge_top_k(list(replies.values()), k)
+
+    def score_ids(self, query: np.ndarray, ids: np.ndarray, ef_search: Optional[int] = None) -> Dict[int, float]:
+        """Scores for the given ids, each asked of the shard that owns it."""
+        ids = np.asarray(ids, dtype=np.int64)
+        owners = ids % len(self.clients)
+        requests = {int(shard_id): ("score", query, ids[owners == shard_id], ef_search) for shard_id in np.unique(owners)}
+        scores = {}
+        for (shard_scores,) in self._fan_out(requests).values():
+            scores.update(shard_scores)
+        return scores
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"shards": len(self.clients), "searches": self.searches, "partial": self.partial,
+                    "shard_failures": self.shard_failures}
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        for client in self.clients:
+            client.close()
+        for process in self.processes:
+            process.terminate()
+
+
+def main(args: List[str] = None):
+    parser = argparse.ArgumentParser(description="Split a movie DB's index into shards and serve them")
+    commands = parser.add_subparsers(dest="command", required=True)
+    split = commands.add_parser("split", help="Partition the DB's index by FAISS id")
+    split.add_argument("--db_file", required=True, help="DB directory (or legacy .pickle.gz)")
+    split.add_argument("--shards", type=int, required=True, help="Number of shards")
+    split.add_argument("--output", help="Shard directory (default: <db_file>.shards)")
+    run = commands.add_parser("serve", help="Serve one shard over TCP")
+    run.add_argument("--shard_file", required=True, help="A shard_NNN.faiss written by split")
+    run.add_argument("--host", default="127.0.0.1")
+    run.add_argument("--port", type=int, required=True)
+    run.add_argument("--threads", type=int, help="FAISS OpenMP threads for this shard")
+    parsed = parser.parse_args(args)
+
+    if parsed.command == "split":
+        split_db(parsed.db_file, parsed.shards, parsed.output)
+    else:
+        serve(parsed.shard_file, (parsed.host, parsed.port), threads=parsed.threads)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
@@ -0,0 +1,161 @@
+import argparse
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+import numpy as np
+
+DEFAULT_DIM = 768
+DEFAULT_PORT = 11434
+MAX_WORDS = 500000  # word vectors kept; beyond that they are recomputed on every use
+TOKEN = re.compile(r"\w+")
+RERANK_MOVIE = re.compile(r"^\d+\. ", re.M)
+
+
+class StubModels:
+    """
+    Deterministic stand-ins for the Ollama models, with a configurable latency per call.
+
+    An embedding is the normalized mean of per-word vectors seeded from the word's hash, so
+    texts sharing words are close and a query drawn from a catalogue's vocabulary finds the
+    movies using it. Generate answers re-rank prompts with one score per listed movie and
+    facet extraction with facet lines; chat streams `tokens` words.
+    """
+
+    def __init__(self, dim: int = DEFAULT_DIM, embed_latency: float = 0.0, generate_latency: float = 0.0,
+                 chat_ttfb: float = 0.0, token_latency: float = 0.0, tokens: int = 20):
+        self.dim = dim
+        self.embed_latency = embed_latency
+        self.generate_latency = generate_latency
+        self.chat_ttfb = chat_ttfb
+        self.token_latency = token_latency
+        self.tokens = tokens
+        self._words: Dict[str, np.ndarray] = {}
+        self._lock = threading.Lock()
+
+    def word_vector(self, word: str) -> np.ndarray:
+        vector = self._words.get(word)
+        if vector is None:
+            seed = int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(), "little")
+            vector = np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32)
+            if len(self._words) < MAX_WORDS:
+                with self._lock:
+                    self._words[word] = vector
+        return vector
+
+    def embed(self, text: str) -> List[float]:
+        words = TOKEN.findall(text.lower()) or [""]
+        vector = np.mean([self.word_vector(word) for word in words], axis=0)
+        return (vector / (np.linalg.norm(vector) or 1.0)).tolist()
+
+    def generate(self, body: Dict) -> str:
+        prompt = body.get('prompt', '')
+        if body.get('format') == 'json':
+            # A re-rank prompt: one score per numbered movie
+            count = len(RERANK_MOVIE.findall(prompt))
+            return json.dumps({"scores": [(i * 7) % 11 for i in range(count)]})
+        if 'annotation' in body.get('system', '').lower():
+            words = TOKEN.findall(prompt)[-6:]
+            return f"- Theme: {' '.join(words)}\n- Mood: tense\n- Genre: drama"
+        return "Stub completion for: " + prompt[:40]
+
+    def chat_lines(self, body: Dict):
+        for i in range(self.tokens):
+            yield {"model": body.get('model'), "message": {"role": "assistant", "content": f"token{i} "}, "done": False}
+        yield {"model": body.get('model'), "message": {"role": "assistant", "content": ""}, "done": True}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True  # headers and body go out in separate writes; don't stall on delayed ACKs
+    models: StubModels = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload: Dict, status: int = 200):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        models = self.models
+        if self.path == "/api/embeddings":
+            time.sleep(models.embed_latency)
+            self.send_json({"embedding": models.embed(body.get('prompt', ''))})
+        elif self.path == "/api/embed":
+            texts = body.get('input', [])
+            texts = [texts] if isinstance(texts, str) else texts
+            time.sleep(models.embed_latency)
+            self.send_json({"embeddings": [models.embed(text) for text in texts]})
+        elif self.path == "/api/generate":
+            time.sleep(models.generate_latency)
+            self.send_json({"model": body.get('model'), "response": models.generate(body), "done": True})
+        elif self.path == "/api/chat":
+            self.stream_chat(body)
+        else:
+            self.send_json({"error": f"unknown endpoint {self.path}"}, 404)
+
+    def stream_chat(self, body: Dict):
+        models = self.models
+        time.sleep(models.chat_ttfb)
+        if not body.get('stream', True):
+            content = "".join(line["message"]["content"] for line in models.chat_lines(body))
+            self.send_json({"model": body.get('model'), "message": {"role": "assistant", "content": content},
+                            "done": True})
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for i, line in enumerate(models.chat_lines(body)):
+            if i:
+                time.sleep(models.token_latency)
+            data = json.dumps(line).encode("utf-8") + b"\n"
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+
+def make_server(port: int = DEFAULT_PORT, host: str = "127.0.0.1", models: Optional[StubModels] = None) -> ThreadingHTTPServer:
+    handler = type("BoundStubHandler", (StubHandler,), {"models": models or StubModels()})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main(args: List[str] = None):
+    parser = argparse.ArgumentParser(description="Serve deterministic stand-ins for the Ollama embedding, generate and chat APIs")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--dim", type=int, default=DEFAULT_DIM, help="Embedding dimension")
+    parser.add_argument("--embed_latency", type=float, default=0.0, help="Seconds added to every embedding request")
+    parser.add_argument("--generate_latency", type=float, default=0.0, help="Seconds added to every generate request")
+    parser.add_argument("--chat_ttfb", type=float, default=0.0, help="Seconds before the first chat token")
+    parser.add_argument("--token_latency", type=float, default=0.0, help="Seconds between chat tokens")
+    parser.add_argument("--tokens", type=int, default=20, help="Tokens per chat reply")
+    parsed = parser.parse_args(args)
+
+    models = StubModels(parsed.dim, parsed.embed_latency, parsed.generate_latency, parsed.chat_ttfb,
+                        parsed.token_latency, parsed.tokens)
+    server = make_server(parsed.port, parsed.host, models)
+    logging.info(f"Stub Ollama listening on {parsed.host}:{server.server_address[1]} ({parsed.dim}-d embeddings)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
@@ -1,56 +1,44 @@
-import json
 import numpy as np
-import gzip
-import pickle
 import faiss
-import requests
-from tqdm import tqdm
 import logging
 import os
-from typing import List, Tuple, Dict, Any
+from typing import List, Sequence, Tuple, Dict, Any
 import argparse
+from util.embedding_backend import get_backend
+from util.incremental import build_incremental
+from util.catalogue import load_catalogue
+from util.db_store import open_records, read_db, write_db
+from util.records import RecordIndex
+from util.ann import create_index, search_parameters
+from util.lexical import LexicalIndex
 
 # Configuration
 API_URL = os.getenv("API_URL", "http://localhost:11434/api/embeddings")
 MODEL = os.getenv("MODEL", "albertogg/multi-qa-minilm-l6-cos-v1:latest")
-DB_FILE = os.getenv("DB_FILE", "assets/movies_faiss.pickle.gz")
+DB_FILE = os.getenv("DB_FILE", "assets/movies_db")
 JSON_FILE = os.getenv("JSON_FILE", "assets/all_movies.json")
+INDEX_FACTORY = os.getenv("INDEX_FACTORY")  # defaults to IVF<centroids>,Flat
+NPROBE = int(os.getenv("NPROBE", "8"))
+EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", "8"))
+EMBED_TIMEOUT = float(os.getenv("EMBED_TIMEOUT", "60"))
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "ollama")  # or "local" to run MODEL as an in-process SentenceTransformer
+EMBED_THREADS = int(os.getenv("EMBED_THREADS", "4"))
+EMBED_ONNX_FILE = os.getenv("EMBED_ONNX_FILE")  # e.g. onnx/model_qint8_avx512.onnx
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def generate_embeddings_batch(texts: List[str], model: str = MODEL, batch_size: int = 32) -> np.ndarray:
-    all_embeddings = []
-    failed_texts = []
-    for i in tqdm(range(0, len(texts), batch_size)):
-        batch = texts[i:i+batch_size]
-        batch_embeddings = []
-        for text in batch:
-            payload = json.dumps({
-                "model": model,
-                "prompt": text
-            })
-            headers = {'Content-Type': 'application/json'}
-            try:
-                response = requests.post(API_URL, data=payload, headers=headers)
-                response.raise_for_status()
-                result = response.json()
-                embedding = result.get('embedding')
-                if not embedding:
-                    raise ValueError(f"Invalid embedding format received for text: {text[:50]}...")
-                batch_embeddings.append(embedding)
-            except requests.exceptions.RequestException as e:
-                logging.error(f"Error in generate_embeddings_batch: {str(e)}")
-                if e.response is not None:
-                    logging.error(f"Response content: {e.response.content}")
-                failed_texts.append(text)
-            except Exception as e:
-                logging.error(f"Unexpected error in generate_embeddings_batch: {str(e)}")
-                failed_texts.append(text)
-        all_embeddings.extend(batch_embeddings)
+def embedding_client(model: str = MODEL):
+    if EMBED_BACKEND == "local":
+        return get_backend("local", model, threads=EMBED_THREADS, onnx_file=EMBED_ONNX_FILE)
+    return get_backend("ollama", model, API_URL, workers=EMBED_WORKERS, timeout=(5.0, EMBED_TIMEOUT))
+
+def generate_embeddings_batch(texts: List[str], model: str = MODEL, progress: bool = True) -> np.ndarray:
+    embeddings = embedding_client(model).embed_many(texts, progress=progress)
+    all_embeddings = [embedding for embedding in embeddings if embedding is not None]
 
     logging.info(f"Successfully generated {len(all_embeddings)} embeddings")
-    logging.info(f"Failed to generate embeddings for {len(failed_texts)} texts")
+    logging.info(f"Failed to generate embeddings for {len(texts) - len(all_embeddings)} texts")
 
     if len(all_embeddings) == 0:
         raise ValueError("No valid embeddings were generated.")
@@ -68,17 +56,10 @@ def create_movie_text(movie: Dict[str, Any]) -> str:
         return ""
     return f"Title: {title}. Genre IDs: {genres}. Overview: {overview}"
 
-def create_and_save_db(json_file: str, db_file: str, batch_size: int = 32):
-    with open(json_file, "r") as f:
-        documents = json.load(f)
-
-    movie_texts = []
+def calculate_centroids(documents: List[Dict[str, Any]]) -> int:
     all_genres = set()
     release_years = set()
     for movie in documents:
-        movie_text = create_movie_text(movie)
-        if movie_text:
-            movie_texts.append((movie_text, movie['id']))
         all_genres.update(movie.get('genre_ids', []))
         if 'release_date' in movie and movie['release_date']:
             try:
@@ -88,9 +69,6 @@ def create_and_save_db(json_file: str, db_file: str, batch_size: int = 32):
             except IndexError:
                 logging.warning(f"Invalid release date format for movie id {movie.get('id', 'unknown')}: {movie.get('release_date', 'N/A')}")
 
-    logging.info(f"Prepared {len(movie_texts)} movie texts for embedding generation")
-
-    # Calculate number of centroids
     unique_genres = len(all_genres)
     year_range = len(release_years)
     base_centroids = max(unique_genres * 2, 10)  # Ensure at least 10 base centroids
@@ -99,10 +77,39 @@ def create_and_save_db(json_file: str, db_file: str, batch_size: int = 32):
     n_centroids = max(50, min(n_centroids, 100))  # Ensure between 50 and 100 centroids
 
     logging.info(f"Calculated {n_centroids} centroids based on {unique_genres} unique genres and {year_range} years of releases")
+    return n_centroids
+
+def index_factory(n_centroids: int) -> str:
+    return INDEX_FACTORY or f"IVF{n_centroids},Flat"
+
+def build_lexical_index(documents: Sequence[Tuple[str, int]], original_documents: RecordIndex) -> LexicalIndex:
+    """BM25 over each indexed movie's title and overview, keyed by FAISS id."""
+    def docs():
+        for doc_id, doc in enumerate(documents):
+            movie = original_documents.get_by_id(doc[1]) if doc is not None else None
+            if movie:
+                yield doc_id, movie.get('title', ''), movie.get('overview', '')
+    return LexicalIndex.build(docs(), len(documents))
+
+def create_and_save_db(json_file: str, db_file: str):
+    documents = load_catalogue(json_file)
+
+    movie_texts = []
+    for movie in documents:
+        movie_text = create_movie_text(movie)
+        if movie_text:
+            movie_texts.append((movie_text, movie['id']))
+
+    logging.info(f"Prepared {len(movie_texts)} movie texts for embedding generation")
+
+    # Calculate number of centroids
+    n_centroids = calculate_centroids(documents)
 
     logging.info("Generating embeddings...")
-    texts_only = [text for text, _ in movie_texts]
-    movie_embeddings = generate_embeddings_batch(texts_only, batch_size=batch_size)
+    embeddings = embedding_client().embed_many([text for text, _ in movie_texts], progress=True)
+    # Keep documents aligned with the vectors that were actually embedded
+    movie_texts = [entry for entry, embedding in zip(movie_texts, embeddings) if embedding is not None]
+    movie_embeddings = np.array([embedding for embedding in embeddings if embedding is not None], dtype=np.float32)
 
     if movie_embeddings.size == 0:
         raise ValueError("No valid embeddings were generated.")
@@ -110,33 +117,58 @@ def create_and_save_db(json_file: str, db_file: str, batch_size: int = 32):
     logging.info(f"Generated {len(movie_embeddings)} embeddings of shape {movie_embeddings.shape}")
     dim = movie_embeddings.shape[1]
 
-    # Using IndexIVFFlat with calculated number of centroids
-    quantizer = faiss.IndexFlatIP(dim)
-    index = faiss.IndexIVFFlat(quantizer, dim, n_centroids, faiss.METRIC_INNER_PRODUCT)
-    index.train(movie_embeddings)
+    # Normalized vectors make the inner-product index rank by cosine similarity
+    faiss.normalize_L2(movie_embeddings)
+    factory = index_factory(n_centroids)
+    index = create_index(movie_embeddings, factory)
     index.add(movie_embeddings)
 
-    logging.info(f"Created FAISS index with {index.ntotal} vectors of dimension {dim} and {n_centroids} centroids")
+    logging.info(f"Created {factory} FAISS index with {index.ntotal} vectors of dimension {dim}")
 
-    with gzip.open(db_file, "wb") as f:
-        pickle.dump({'documents': movie_texts, 'index': faiss.serialize_index(index)}, f)
+    lexical = build_lexical_index(movie_texts, RecordIndex(documents))
+    write_db(db_file, movie_texts, index, records=documents, extras={'lexical': lexical.to_arrays()})
     logging.info(f"Saved database to {db_file}")
 
-def load_db(db_file: str) -> Tuple[List[Tuple[str, int]], Any]:
-    with gzip.open(db_file, "rb") as f:
-        data = pickle.load(f)
-    index = faiss.deserialize_index(data['index'])
-    return data['documents'], index
+def update_db(json_file: str, db_file: str):
+    documents = load_catalogue(json_file)
 
-def search_movies(query: str, index: Any, documents: List[Tuple[str, int]], original_documents: List[Dict[str, Any]], k: int = 5) -> List[Dict[str, Any]]:
-    query_embedding = generate_embeddings_batch([query])
-    distances, indices = index.search(query_embedding.reshape(1, -1), k)
+    entries = []
+    for movie in documents:
+        movie_text = create_movie_text(movie)
+        if movie_text:
+            entries.append((movie['id'], movie_text, movie['id']))
+
+    n_centroids = calculate_centroids(documents)
+    build_incremental(entries, db_file,
+                      embed_many=lambda texts: embedding_client().embed_many(texts, progress=True),
+                      new_index=lambda vectors: create_index(vectors, index_factory(n_centroids)),
+                      normalize=True,
+                      records=documents,
+                      build_extras=lambda docs: {'lexical': build_lexical_index(docs, RecordIndex(documents)).to_arrays()})
+
+def load_db(db_file: str) -> Tuple[Sequence[Tuple[str, int]], Any]:
+    data = read_db(db_file)
+    return data['documents'], data['index']
+
+def load_original_documents(db_file: str, json_file: str) -> Sequence[Dict[str, Any]]:
+    records = open_records(db_file)
+    if records is None:
+        records = load_catalogue(json_file)
+    return records
+
+def search_movies(query: str, index: Any, documents: Sequence[Tuple[str, int]], original_documents: RecordIndex, k: int = 5,
+                  nprobe: int = NPROBE) -> List[Dict[str, Any]]:
+    query_embedding = generate_embeddings_batch([query], progress=False)
+    faiss.normalize_L2(query_embedding)
+    distances, indices = index.search(query_embedding, k, params=search_parameters(index, nprobe=nprobe))
 
     results = []
     for i in range(k):
         idx = indices[0][i]
+        if idx < 0:
+            continue  # fewer than k vectors were probed
         _, movie_id = documents[idx]
-        movie = next((m for m in original_documents if m['id'] == movie_id), None)
+        movie = original_documents.get_by_id(movie_id)
         if movie:
             similarity = float(distances[0][i])
             results.append({
@@ -151,18 +183,19 @@ def search_movies(query: str, index: Any, documents: List[Tuple[str, int]], orig
 def main(args):
     if args.create_new_db:
         create_and_save_db(args.json_file, args.db_file)
+    elif args.update_db:
+        update_db(args.json_file, args.db_file)
 
     documents, index = load_db(args.db_file)
 
-    with open(args.json_file, "r") as f:
-        original_documents = json.load(f)
+    original_documents = RecordIndex(load_original_documents(args.db_file, args.json_file))
 
     while True:
         query = input("Enter your movie query (or 'quit' to exit): ")
         if query.lower() == 'quit':
             break
 
-        results = search_movies(query, index, documents, original_documents, args.num_results)
+        results = search_movies(query, index, documents, original_documents, args.num_results, args.nprobe)
 
         for result in results:
             print(f"Title: {result['title']}")
@@ -173,9 +206,11 @@ def main(args):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Movie Recommendation Engine")
     parser.add_argument("--create_new_db", action="store_true", help="Create a new database")
+    parser.add_argument("--update_db", action="store_true", help="Embed only new or changed movies into the existing database")
     parser.add_argument("--db_file", default=DB_FILE, help="Path to the database file")
     parser.add_argument("--json_file", default=JSON_FILE, help="Path to the JSON file containing movie data")
     parser.add_argument("--num_results", type=int, default=5, help="Number of results to retrieve")
+    parser.add_argument("--nprobe", type=int, default=NPROBE, help="IVF cells probed per query (ignored by non-IVF indexes)")
     args = parser.parse_args()
 
     main(args)
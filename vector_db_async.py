@@ -0,0 +1,572 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+import numpy as np
+from aiohttp import web
+
+from vector_db_flask import (API_URLS, MODELS, DB_FILE, JSON_FILE, SEARCH_MODES, RELOAD, EMBEDDING_BACKEND,
+                             EMBEDDING_BATCHER, query_cache, rank_hits, title_fast_path, lexical_search_hits,
+                             embedding_batcher, open_generations, rerank_hits, facet_extraction_payload, facet_weights,
+                             rank_facet_hits, search_options, rag_prefix, rag_messages, sse_event, result_events, reorder_event,
+                             done_event, result_signature, RERANK, RAG)
+from util.embedding_cache import normalize_text
+from util.embedding_client import MISSING_ENDPOINT_STATUSES
+from util.facets import parse_facets
+from util.metrics import CONTENT_TYPE, EVENTS, REGISTRY, REQUEST_SECONDS, STAGE_SECONDS, UPSTREAM_TTFB_SECONDS, span
+from util.records import json_array
+
+# Upstream calls allowed in flight per model, and how many more may wait before we shed load with a 503.
+# A chat holds its slot until the reply has finished streaming, because that is how long it occupies one of
+# the model's parallel slots; set the chat concurrency to the chat model's OLLAMA_NUM_PARALLEL. Long chats then
+# queue behind each other (or get a 503 past max_waiting) but never hold up search, which has its own limits.
+UPSTREAM_LIMITS = {
+    "embedding": {"concurrency": 32, "max_waiting": 512},
+    "query_generation": {"concurrency": 4, "max_waiting": 64},
+    "rerank": {"concurrency": 4, "max_waiting": 64},
+    "chat": {"concurrency": 4, "max_waiting": 512}
+}
+HTTP_POOL_SIZE = 64
+SEARCH_THREADS = 4
+EMBEDDING_TIMEOUT = aiohttp.ClientTimeout(total=60, sock_connect=5)
+COMPLETION_TIMEOUT = aiohttp.ClientTimeout(total=300, sock_connect=5)
+CHAT_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=5, sock_read=300)
+CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Methods": "POST, OPTIONS",
+    "Access-Control-Allow-Headers": "Content-Type"
+}
+
+
+class UpstreamBusy(Exception):
+    pass
+
+
+class UpstreamLimiter:
+    """Bounded concurrency for one upstream model, rejecting new work once too many callers are queued."""
+
+    def __init__(self, name, concurrency, max_waiting):
+        self.name = name
+        self.max_waiting = max_waiting
+        self.waiting = 0
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    async def __aenter__(self):
+        if self.waiting >= self.max_waiting:
+            raise UpstreamBusy(f"Too many pending {self.name} requests")
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        return self
+
+    async def __aexit__(self, *exc):
+        self._semaphore.release()
+
+
+class AsyncEmbeddingBatcher:
+    """
+    Micro-batching and coalescing of query embeddings on the event loop.
+
+    The async counterpart of `EmbeddingBatcher`: queries arriving within `window` seconds of
+    the first pending one (up to `max_batch`) go to Ollama's multi-input /api/embed as one
+    request on the shared aiohttp session, holding one embedding limiter slot per batch. A
+    query already pending, after normalization, shares its future. If the backend has no
+    /api/embed (404/405), texts are sent to /api/embeddings one request each from then on; a
+    batch it rejects with a 400 is retried that way on its own.
+    """
+
+    def __init__(self, session, limiter, model=MODELS["embedding"], window=EMBEDDING_BATCHER["window"],
+                 max_batch=EMBEDDING_BATCHER["max_batch"]):
+        self.session = session
+        self.limiter = limiter
+        self.model = model
+        self.window = window
+        self.max_batch = max_batch
+        api_url = API_URLS["embeddings"]
+        self.batch_url = api_url[:-len("/api/embeddings")] + "/api/embed" if api_url.endswith("/api/embeddings") else None
+        self._pending = {}  # normalized text -> future
+        self._queue = []
+        self._timer = None
+        self._dispatches = set()
+
+    async def embed(self, text):
+        key = normalize_text(text)
+        future = self._pending.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._pending[key] = future
+            self._queue.append((key, text, future))
+            if len(self._queue) >= self.max_batch:
+                self._flush()
+            elif self._timer is None:
+                self._timer = asyncio.get_running_loop().call_later(self.window, self._flush)
+        # Shielded: a caller that goes away must not cancel the future other callers share
+        embedding = await asyncio.shield(future)
+        return embedding.copy()
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._queue = self._queue, []
+        if batch:
+            task = asyncio.ensure_future(self._dispatch(batch))
+            self._dispatches.add(task)  # the loop only keeps weak references to tasks
+            task.add_done_callback(self._dispatches.discard)
+
+    async def _dispatch(self, batch):
+        try:
+            async with self.limiter:
+                embeddings = await self._request([text for _, text, _ in batch])
+        except Exception as e:
+            for key, _, future in batch:
+                self._pending.pop(key, None)
+                if not future.done():
+                    future.set_exception(e)
+                    future.exception()  # marked retrieved: every waiter may have gone away
+            return
+        for (key, _, future), embedding in zip(batch, embeddings):
+            self._pending.pop(key, None)
+            if future.done():
+                continue
+            if isinstance(embedding, Exception):
+                future.set_exception(embedding)
+                future.exception()
+            else:
+                future.set_result(embedding)
+
+    async def _request(self, texts):
+        if self.batch_url is not None:
+            start = time.perf_counter()
+            async with self.session.post(self.batch_url, json={"model": self.model, "input": texts},
+                                         timeout=EMBEDDING_TIMEOUT) as response:
+                UPSTREAM_TTFB_SECONDS.observe("embeddings_batch", time.perf_counter() - start)
+                if response.status not in (400,) + MISSING_ENDPOINT_STATUSES:
+                    response.raise_for_status()
+                    embeddings = (await response.json()).get('embeddings')
+                    if not embeddings or len(embeddings) != len(texts):
+                        raise ValueError("Invalid batch embedding format received")
+                    return [np.array(embedding, dtype=np.float32) for embedding in embeddings]
+            if response.status in MISSING_ENDPOINT_STATUSES:
+                logging.warning(f"{self.batch_url} does not accept batched input ({response.status}); "
+                                f"falling back to one request per text")
+                self.batch_url = None
+            else:
+                # Likely one bad or oversized text; only this batch goes one by one
+                logging.warning(f"{self.batch_url} rejected a batch of {len(texts)} texts (400); "
+                                f"embedding them one by one")
+        # One text failing fails only its own queries
+        return await asyncio.gather(*(self._request_one(text) for text in texts), return_exceptions=True)
+
+    async def _request_one(self, text):
+        start = time.perf_counter()
+        async with self.session.post(API_URLS["embeddings"], json={"model": self.model, "prompt": text},
+                                     timeout=EMBEDDING_TIMEOUT) as response:
+            UPSTREAM_TTFB_SECONDS.observe("embeddings", time.perf_counter() - start)
+            response.raise_for_status()
+            embedding = (await response.json()).get('embedding')
+        if not embedding:
+            raise ValueError("Invalid embedding format received")
+        return np.array(embedding, dtype=np.float32)
+
+
+async def generate_embeddings(app, text, model=MODELS["embedding"]):
+    embedding = query_cache.get(model, text)
+    if embedding is not None:
+        return embedding
+    if model == MODELS["embedding"] and EMBEDDING_BACKEND == "local":
+        # In-process model: nothing upstream to pool, so batch on the batcher's threads
+        embedding = await asyncio.wrap_future(embedding_batcher().submit(text))
+        if embedding is None:
+            raise ValueError("Failed to generate query embedding")
+        query_cache.put(model, text, embedding)
+        return embedding.copy()
+    if model == MODELS["embedding"]:
+        embedding = await app['embedder'].embed(text)
+        query_cache.put(model, text, embedding)
+        return embedding
+    async with app['limiters']['embedding']:
+        start = time.perf_counter()
+        async with app['http'].post(API_URLS["embeddings"], json={"model": model, "prompt": text},
+                                    timeout=EMBEDDING_TIMEOUT) as response:
+            UPSTREAM_TTFB_SECONDS.observe("embeddings", time.perf_counter() - start)
+            response.raise_for_status()
+            result = await response.json()
+    embedding = result.get('embedding')
+    if not embedding:
+        raise ValueError("Invalid embedding format received")
+    embedding = np.array(embedding, dtype=np.float32)
+    query_cache.put(model, text, embedding)
+    return embedding
+
+
+def search_index(index, documents, records, lexical, query, query_embedding, top_k, min_similarity, nprobe, ef_search,
+                 mode, mask, vectors):
+    """The CPU-bound part of a search; runs on the search executor, never on the event loop."""
+    return rank_hits(query, query_embedding, documents, index, records, top_k, min_similarity, nprobe, ef_search,
+                     lexical, mode, mask, vectors)
+
+
+async def rerank(app, query, hits, records):
+    """LLM re-rank under the re-rank limiter; a full queue serves the hits unreranked rather than a 503."""
+    try:
+        async with app['limiters']['rerank']:
+            # Waits on the re-rank pool for up to its budget, so keep it off the search threads
+            return await asyncio.get_running_loop().run_in_executor(None, rerank_hits, query, hits, records)
+    except UpstreamBusy:
+        EVENTS.inc("rerank_shed")
+        return hits
+
+
+async def embedded_search(app, generation, query, top_k, min_similarity, nprobe, ef_search, mode, mask, rerank_results):
+    """Embed the query, then answer it from the generation's result cache or by searching (and re-ranking)."""
+    with span("embed"):
+        query_embedding = await generate_embeddings(app, query)
+    cache, signature = generation.result_cache, None
+    if cache is not None:
+        signature = result_signature(mode, top_k, min_similarity, nprobe, ef_search, mask, rerank_results)
+        hits = cache.get(query_embedding, signature)
+        if hits is not None:
+            return hits
+    hits = await asyncio.get_running_loop().run_in_executor(
+        app['search_executor'], search_index, generation.index, generation.documents, generation.records,
+        generation.lexical, query, query_embedding, top_k, min_similarity, nprobe, ef_search, mode, mask,
+        generation.vectors)
+    ranked = await rerank(app, query, hits, generation.records) if rerank_results else hits
+    if cache is not None and (ranked is not hits or not rerank_results):
+        cache.put(query_embedding, signature, ranked)  # a re-rank that fell back is not cached
+    return ranked
+
+
+async def extract_query_facets(app, query):
+    """Ask the LLM for the annotation facets a free-text query is after, on the shared session and limiter."""
+    async with app['limiters']['query_generation']:
+        with span("facet_extract"):
+            start = time.perf_counter()
+            async with app['http'].post(API_URLS["generate"], json=facet_extraction_payload(query),
+                                        timeout=COMPLETION_TIMEOUT) as response:
+                UPSTREAM_TTFB_SECONDS.observe("facet_extract", time.perf_counter() - start)
+                response.raise_for_status()
+                result = await response.json()
+    return parse_facets(result.get('response', ''))
+
+
+async def facet_search(app, generation, query, top_k, min_similarity, ef_search, mask):
+    """Facet search with its upstream calls on the event loop and only the ranking on the search executor."""
+    query_facets = parse_facets(query) or await extract_query_facets(app, query)
+    weights = facet_weights(query_facets)
+    with span("embed"):
+        embeddings = await asyncio.gather(*(generate_embeddings(app, text)
+                                            for text in [query_facets[key] for key in query_facets] + [query]))
+    return await asyncio.get_running_loop().run_in_executor(
+        app['search_executor'], rank_facet_hits, query_facets, weights, embeddings, generation.documents,
+        generation.index, generation.records, generation.facets, top_k, min_similarity, ef_search, mask,
+        generation.vectors)
+
+
+async def find_hits(app, generation, query, top_k, min_similarity, nprobe, ef_search, mode, mask, rerank_results):
+    """
+    The async counterpart of `search_hits`: embedding, facet extraction and re-ranking go
+    through the shared session and the upstream limiters, CPU work to the search executor.
+    """
+    if mode == "facets":
+        if generation.facets is None:
+            raise ValueError("Facet search is not available: the database has no annotation facets")
+        hits = await facet_search(app, generation, query, top_k, min_similarity, ef_search, mask)
+    else:
+        if mode != "dense":
+            hits = title_fast_path(query, generation.documents, generation.records, generation.lexical, mask)
+            if hits:
+                return hits[:top_k]
+        if mode != "lexical" or generation.lexical is None:
+            return await embedded_search(app, generation, query, top_k, min_similarity, nprobe, ef_search, mode,
+                                         mask, rerank_results)
+        hits = lexical_search_hits(query, generation.documents, generation.records, generation.lexical, top_k, mask)
+    return await rerank(app, query, hits, generation.records) if rerank_results else hits
+
+
+def error_response(message, status):
+    return web.json_response({'error': message}, status=status)
+
+
+async def search(request):
+    start = time.perf_counter()
+    try:
+        data = await request.json()
+        if not data or 'query' not in data:
+            return error_response('No query provided', 400)
+
+        query = data['query']
+        logging.info(f"Received search query: {query}")
+
+        mode = data.get('mode', 'hybrid')
+        if mode not in SEARCH_MODES:
+            return error_response(f"Unknown search mode '{mode}'", 400)
+
+        app = request.app
+        generation = app['generations'].current  # held for the whole request, even if a reload swaps it meanwhile
+        try:
+            top_k, min_similarity, nprobe, ef_search = search_options(data)
+            mask = generation.metadata.mask(data.get('filters'))
+        except ValueError as e:
+            return error_response(str(e), 400)
+
+        if mode == "facets" and generation.facets is None:
+            return error_response("Facet search is not available: the database has no annotation facets", 400)
+
+        hits = await find_hits(app, generation, query, top_k, min_similarity, nprobe, ef_search, mode, mask,
+                               data.get('rerank', RERANK["default"]))
+        with span("serialize"):
+            body, count = json_array(generation.records.hit_payload(*hit) for hit in hits), len(hits)
+
+        logging.info(f"Search completed. Found {count} results.")
+        return web.Response(body=body, content_type='application/json')
+    except UpstreamBusy as e:
+        return error_response(str(e), 503)
+    except Exception as e:
+        logging.error(f"Error in search endpoint: {str(e)}", exc_info=True)
+        return error_response(str(e), 500)
+    finally:
+        REQUEST_SECONDS.observe("search", time.perf_counter() - start)
+
+
+async def search_stream(request):
+    try:
+        data = await request.json()
+        if not data or 'query' not in data:
+            return error_response('No query provided', 400)
+        mode = data.get('mode', 'hybrid')
+        if mode not in SEARCH_MODES:
+            return error_response(f"Unknown search mode '{mode}'", 400)
+
+        generation = request.app['generations'].current
+        try:
+            top_k, min_similarity, nprobe, ef_search = search_options(data)
+            mask = generation.metadata.mask(data.get('filters'))
+        except ValueError as e:
+            return error_response(str(e), 400)
+
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache',
+                                               **CORS_HEADERS})
+        await response.prepare(request)
+        query, rerank_results = data['query'], data.get('rerank', RERANK["default"])
+        start = time.perf_counter()
+        try:
+            # Re-ranked separately below, so the first results go out before the LLM re-rank is back
+            hits = await find_hits(request.app, generation, query, top_k, min_similarity, nprobe, ef_search, mode,
+                                   mask, False)
+        except Exception as e:
+            logging.error(f"Error in streamed search: {str(e)}", exc_info=True)
+            await response.write(sse_event("error", {'error': str(e)}))
+            await response.write_eof()
+            return response
+        ranked = time.perf_counter()
+        STAGE_SECONDS.observe("stream_first_results", ranked - start)
+        for frame in result_events(hits, generation.records):
+            await response.write(frame)
+        if rerank_results and hits:
+            reorder = reorder_event(hits, await rerank(request.app, query, hits, generation.records))
+            if reorder is not None:
+                await response.write(reorder)
+        await response.write(done_event(len(hits), start, ranked))
+        await response.write_eof()
+        return response
+    except ConnectionResetError:
+        logging.info("Search stream client disconnected")
+        raise
+    except Exception as e:
+        logging.error(f"Error in search stream endpoint: {str(e)}", exc_info=True)
+        return error_response(str(e), 500)
+
+
+async def warm_chat_prefix(app, messages):
+    """Have the chat model load and prefill `messages` while retrieval runs; the real request then reuses that prefix."""
+    payload = {"model": MODELS["chat"], "messages": messages, "stream": False, "options": {"num_predict": 1}}
+    try:
+        async with app['http'].post(API_URLS["chat"], json=payload, timeout=COMPLETION_TIMEOUT) as response:
+            await response.read()
+    except Exception as e:
+        logging.warning(f"Chat prefix warm-up failed: {str(e)}")
+
+
+async def completion(request):
+    start = time.perf_counter()
+    try:
+        data = await request.json()
+        prompt = data.get('prompt')
+        temperature = data.get('temperature', 0.7)
+        system_prompt = data.get('system_prompt', {}).get('prompt', '')
+
+        if not prompt:
+            return error_response('No prompt provided', 400)
+
+        payload = {
+            "model": MODELS["query_generation"],
+            "prompt": prompt,
+            "system": system_prompt,
+            "temperature": temperature,
+            "stream": False
+        }
+
+        async with request.app['limiters']['query_generation']:
+            upstream_start = time.perf_counter()
+            async with request.app['http'].post(API_URLS["generate"], json=payload, timeout=COMPLETION_TIMEOUT) as response:
+                UPSTREAM_TTFB_SECONDS.observe("generate", time.perf_counter() - upstream_start)
+                response.raise_for_status()
+                result = await response.json()
+
+        return web.json_response({
+            "content": result.get('response', ''),
+            "finish_reason": "stop"
+        })
+    except UpstreamBusy as e:
+        return error_response(str(e), 503)
+    except Exception as e:
+        logging.error(f"Error in completion endpoint: {str(e)}", exc_info=True)
+        return error_response(str(e), 500)
+    finally:
+        REQUEST_SECONDS.observe("completion", time.perf_counter() - start)
+
+
+async def chat(request):
+    start = time.perf_counter()
+    try:
+        data = await request.json()
+        messages = data.get('messages', [])
+
+        if not messages:
+            return error_response('No messages provided', 400)
+
+        context = None
+        if data.get('rag'):
+            # Answer from retrieved movies; the chat model prefills the conversation while we search
+            generation = request.app['generations'].current
+            mode = data.get('mode', 'hybrid')
+            if mode not in SEARCH_MODES:
+                return error_response(f"Unknown search mode '{mode}'", 400)
+            if mode == "facets" and generation.facets is None:
+                return error_response("Facet search is not available: the database has no annotation facets", 400)
+            try:
+                top_k, min_similarity, nprobe, ef_search = search_options(data, RAG["top_k"], RAG["min_similarity"])
+                mask = generation.metadata.mask(data.get('filters'))
+            except ValueError as e:
+                return error_response(str(e), 400)
+            # Only warm the chat model once the request is known to be valid
+            if RAG["warm_prefix"]:
+                task = asyncio.ensure_future(warm_chat_prefix(request.app, rag_prefix(messages)))
+                request.app['background'].add(task)  # the loop only keeps weak references to tasks
+                task.add_done_callback(request.app['background'].discard)
+            query = data.get('query') or messages[-1].get('content', '')
+            retrieve_start = time.perf_counter()
+            hits = await find_hits(request.app, generation, query, top_k, min_similarity, nprobe, ef_search, mode, mask,
+                                   False)
+            STAGE_SECONDS.observe("rag_retrieve", time.perf_counter() - retrieve_start)
+            context = json_array(generation.records.hit_payload(*hit) for hit in hits)
+            messages = rag_messages(messages, hits, generation.records)
+
+        payload = {
+            "model": MODELS["chat"],
+            "messages": messages,
+            "stream": True
+        }
+
+        # The slot is held until the reply has finished streaming; see UPSTREAM_LIMITS
+        async with request.app['limiters']['chat']:
+            upstream_start = time.perf_counter()
+            async with request.app['http'].post(API_URLS["chat"], json=payload, timeout=CHAT_TIMEOUT) as upstream:
+                UPSTREAM_TTFB_SECONDS.observe("chat", time.perf_counter() - upstream_start)
+                upstream.raise_for_status()
+                response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', **CORS_HEADERS})
+                await response.prepare(request)
+                if context is not None:
+                    await response.write(sse_event("movies", context))
+                first = True
+                async for line in upstream.content:
+                    line = line.strip()
+                    if line:
+                        if first:
+                            STAGE_SECONDS.observe("chat_first_token", time.perf_counter() - start)
+                            first = False
+                        await response.write(b"data: " + line + b"\n\n")
+                await response.write_eof()
+                return response
+    except UpstreamBusy as e:
+        return error_response(str(e), 503)
+    except ConnectionResetError:
+        logging.info("Chat client disconnected")
+        raise
+    except Exception as e:
+        logging.error(f"Error in chat endpoint: {str(e)}", exc_info=True)
+        return error_response(str(e), 500)
+    finally:
+        REQUEST_SECONDS.observe("chat", time.perf_counter() - start)
+
+
+async def admin_reload(request):
+    try:
+        if RELOAD["token"] and request.headers.get('X-Admin-Token') != RELOAD["token"]:
+            return error_response('Invalid admin token', 403)
+        data = await request.json() if request.can_read_body else {}
+        generations = request.app['generations']
+        # Loading and the smoke query block; the event loop keeps serving the current generation meanwhile
+        status = await asyncio.get_running_loop().run_in_executor(None, generations.reload, data.get('force', False))
+        return web.json_response(status)
+    except Exception as e:
+        logging.error(f"Error in admin reload endpoint: {str(e)}", exc_info=True)
+        return web.json_response({'error': str(e), **request.app['generations'].stats()}, status=500)
+
+
+async def metrics(request):
+    return web.Response(body=REGISTRY.render().encode('utf-8'), headers={'Content-Type': CONTENT_TYPE})
+
+
+@web.middleware
+async def cors(request, handler):
+    if request.method == 'OPTIONS':
+        return web.Response(headers=CORS_HEADERS)
+    response = await handler(request)
+    if not response.prepared:
+        response.headers.update(CORS_HEADERS)
+    return response
+
+
+async def open_pools(app):
+    app['http'] = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=HTTP_POOL_SIZE, keepalive_timeout=60))
+    app['limiters'] = {name: UpstreamLimiter(name, **limits) for name, limits in UPSTREAM_LIMITS.items()}
+    app['search_executor'] = ThreadPoolExecutor(max_workers=SEARCH_THREADS, thread_name_prefix="search")
+    app['embedder'] = AsyncEmbeddingBatcher(app['http'], app['limiters']['embedding'])
+
+
+async def close_pools(app):
+    await app['http'].close()
+    app['search_executor'].shutdown(wait=False)
+    query_cache.flush()
+
+
+def create_app(generations):
+    app = web.Application(middlewares=[cors])
+    app['generations'] = generations
+    app['background'] = set()
+    app.on_startup.append(open_pools)
+    app.on_cleanup.append(close_pools)
+    for path, handler in (('/search', search), ('/search/stream', search_stream), ('/completion', completion),
+                          ('/chat', chat)):
+        app.router.add_post(path, handler)
+        app.router.add_route('OPTIONS', path, handler)
+    app.router.add_get('/metrics', metrics)
+    app.router.add_post('/admin/reload', admin_reload)
+    return app
+
+
+if __name__ == "__main__":
+    try:
+        generations = open_generations(DB_FILE, JSON_FILE)
+    except Exception as e:
+        logging.error(f"Error loading database: {str(e)}", exc_info=True)
+        raise
+
+    web.run_app(create_app(generations), port=8081)
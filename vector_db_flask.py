@@ -1,14 +1,32 @@
 from flask import Flask, request, jsonify, Response, stream_with_context
 import json
 import numpy as np
-import gzip
-import pickle
 import faiss
 from flask_cors import CORS
 import requests
 from math import sqrt
 import logging
-from tqdm import tqdm
+import threading
+import time
+import os
+from util.embedding_backend import get_backend
+from util.embedding_cache import EmbeddingCache
+from util.embedding_batcher import EmbeddingBatcher
+from util.incremental import build_incremental
+from util.catalogue import load_catalogue
+from util.db_store import open_records, read_db, write_db
+from util.records import RecordIndex, json_array
+from util.ann import create_index, exact_scores, rescore, restricted_search
+from util.lexical import LexicalIndex, reciprocal_rank_fusion
+from util.filters import MetadataColumns, filtered_search_parameters
+from util.shards import ShardedIndex, parse_address, spawn_local
+from util.generation import Generation, GenerationSwitch, db_signature
+from util.result_cache import SemanticCache, mask_digest
+from util.rerank import Reranker
+from util.facets import FACET_KEYS, FacetIndex, facet_texts, parse_facets
+from util.features import FEATURE_INSTRUCTION
+from util.metrics import (CONTENT_TYPE, EVENTS, REGISTRY, REQUEST_SECONDS, STAGE_SECONDS, UPSTREAM_TTFB_SECONDS,
+                          sampled, span)
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -24,32 +42,164 @@ MODELS = {
     "llm_response": "gemma2:9b-instruct-q5_K_S",
     "chat": "qwen2:7b",
     "query_generation": "qwen2:1.5b",
+    "rerank": "qwen2:1.5b",
     "tts": "tts-1"
 }
-DB_FILE = "assets/movies_faiss.pickle.gz"
+# "ollama" embeds over HTTP with the Ollama model in MODELS["embedding"]; "local" runs that name as an
+# in-process SentenceTransformer (e.g. "sentence-transformers/all-MiniLM-L6-v2") with LOCAL_EMBEDDING options
+EMBEDDING_BACKEND = "ollama"
+LOCAL_EMBEDDING = {
+    "threads": 4,  # torch intra-op threads
+    "batch_size": 32,
+    "onnx_file": None  # e.g. "onnx/model_qint8_avx512.onnx" for int8 ONNX Runtime inference
+}
+EMBEDDING_CLIENT = {
+    "workers": 8,
+    "timeout": (5.0, 60.0),
+    "max_retries": 3
+}
+EMBEDDING_BATCHER = {
+    "window": 0.005,  # seconds to wait for more queries before dispatching a batch
+    "max_batch": 32
+}
+QUERY_CACHE = {
+    "max_entries": 10000,
+    "ttl": 24 * 3600,  # seconds, None to keep entries until evicted
+    "disk_path": "assets/query_cache/embeddings",  # None to keep the cache in memory only
+    "disk_slots": 65536
+}
+INDEX = {
+    "factory": "Flat",  # any FAISS factory string, e.g. "IVF1024,Flat", "IVF1024,PQ32", "HNSW32", "OPQ32,IVF1024,PQ32"
+    "nprobe": None,  # default IVF cells probed per query, overridable per request
+    "efSearch": None,  # default HNSW search depth, overridable per request
+    # With compressed codes ("SQ8", "SQfp16", "PQ32", "IVF1024,SQ8", ...): fetch rescore x top_k candidates
+    # and rank them exactly against float32 vectors memory-mapped from the DB directory. None to disable.
+    "rescore": None
+}
+HYBRID = {
+    "title_fast_path": True,  # answer exact title matches from the lexical index without embedding the query
+    "lexical_candidates": 100,  # BM25 and dense candidates fused per query
+    "rrf_k": 60  # reciprocal rank fusion constant
+}
+SEARCH_MODES = ("hybrid", "dense", "lexical", "facets")
+FACET_SEARCH = {
+    "weights": {"theme": 1.0, "setting": 1.0, "mood": 1.0, "genre": 1.0, "character_dynamics": 0.5,
+                "stylistic_features": 0.5},
+    "overview_weight": 1.0,  # weight of the plain query against the overview index in the fused score
+    "candidates": 200,  # best facet matches that also get an overview score
+    "dtype": "float16"  # facet index storage: float16 (FAISS fp16 scalar quantizer) or float32 (flat)
+}
+RERANK = {
+    "default": False,  # re-rank /search results with the LLM unless the request says otherwise
+    "candidates": 20  # leading hits sent to the LLM; the rest keep their retrieval order
+}
+RERANKER = {
+    "batch_size": 5,  # movies per prompt
+    "workers": 4,  # concurrent prompts
+    "budget": 2.0,  # seconds before falling back to retrieval order
+    "cache_entries": 50000,
+    "cache_ttl": 24 * 3600
+}
+FILTERS = {
+    "max_widening": 16  # most a filter may multiply nprobe / efSearch by
+}
+SHARDS = {
+    "local": False,  # search shard processes started here (split the DB first: python -m util.shards split)
+    "dir": None,  # shard directory, defaults to <DB_FILE>.shards
+    "addresses": [],  # or "host:port" of shard servers started with python -m util.shards serve
+    "threads": 1,  # FAISS threads per local shard process
+    "timeout": 1.0  # seconds before answering without a slow shard
+}
+STREAM = {
+    "first_batch": 10,  # results in the first /search/stream event, sent as soon as they are ranked
+    "batch_size": 20  # results per following event
+}
+RAG = {
+    "top_k": 5,  # retrieved movies passed to the chat model
+    "min_similarity": 0.3,
+    "overview_chars": 600,
+    "warm_prefix": True,  # prefill the chat model on the conversation so far while retrieval runs
+    "system_prompt": ("You are a friendly movie expert. Recommend from the retrieved movies when they fit the "
+                      "request, mention their titles and years, and say so when none of them fit.")
+}
+RELOAD = {
+    "watch": False,  # poll DB_FILE and swap in new builds as they appear
+    "interval": 10,  # seconds between polls
+    "smoke_query": "a space adventure",  # a new generation must answer it before it is swapped in
+    "token": os.getenv("ADMIN_TOKEN")  # required as X-Admin-Token by /admin/reload when set
+}
+RESULT_CACHE = {
+    "enabled": True,  # answer near-duplicate queries with the results of a recent one
+    "threshold": 0.95,  # cosine between query embeddings above which results are shared
+    "max_entries": 2048,
+    "ttl": 600  # seconds
+}
+METRICS = {
+    "log_sample_rate": 0.01  # share of per-hit / per-token debug lines logged when DEBUG is enabled
+}
+DB_FILE = "assets/movies_db"  # a DB directory, or a legacy .pickle.gz
 JSON_FILE = "assets/all_movies.json"
 
 app = Flask(__name__)
-CORS(app, resources={r"/search": {"origins": "*"}, r"/completion": {"origins": "*"}, r"/chat": {"origins": "*"}})
+CORS(app, resources={r"/search": {"origins": "*"}, r"/search/batch": {"origins": "*"}, r"/search/stream": {"origins": "*"}, r"/completion": {"origins": "*"}, r"/chat": {"origins": "*"}, r"/metrics": {"origins": "*"}})
+
+query_cache = EmbeddingCache(**QUERY_CACHE)
+reranker = Reranker(API_URLS["generate"], MODELS["rerank"], **RERANKER)
+query_batcher = None
+generations = None
+query_batcher_lock = threading.Lock()
+
+def embedding_client(model=MODELS["embedding"]):
+    if EMBEDDING_BACKEND == "local":
+        return get_backend("local", model, **LOCAL_EMBEDDING)
+    return get_backend("ollama", model, API_URLS["embeddings"], **EMBEDDING_CLIENT)
 
 def generate_embeddings(text, model=MODELS["embedding"]):
-    payload = json.dumps({"model": model, "prompt": text})
-    headers = {'Content-Type': 'application/json'}
-    try:
-        response = requests.post(API_URLS["embeddings"], data=payload, headers=headers)
-        response.raise_for_status()
-        result = response.json()
-        embeddings = result.get('embedding')
-        if not embeddings:
-            raise ValueError("Invalid embedding format received")
-        return np.array(embeddings, dtype=np.float32)
-    except Exception as e:
-        logging.error(f"Error in generate_embeddings: {str(e)}")
-        return None
+    embedding = embedding_client(model).embed(text)
+    if embedding is None:
+        logging.error("Error in generate_embeddings: no embedding returned")
+    return embedding
+
+def embedding_batcher():
+    global query_batcher
+    with query_batcher_lock:
+        if query_batcher is None:
+            query_batcher = EmbeddingBatcher(embedding_client(), **EMBEDDING_BATCHER)
+        return query_batcher
+
+def embed_query(query, model=MODELS["embedding"]):
+    with span("embed"):
+        return _embed_query(query, model)
+
+def _embed_query(query, model):
+    if model != MODELS["embedding"]:
+        return query_cache.get_or_compute(model, query, lambda text: generate_embeddings(text, model))
+    return query_cache.get_or_compute(model, query, embedding_batcher().embed)
+
+def build_lexical_index(documents, original_documents):
+    """BM25 over each indexed movie's title and overview, keyed by FAISS id."""
+    docs = ((doc_id, original_documents[doc[1]].get('title', ''), doc[0])
+            for doc_id, doc in enumerate(documents) if doc is not None)
+    return LexicalIndex.build(docs, len(documents))
+
+def build_facet_index(documents, original_documents, previous=None):
+    """Annotation facet vectors keyed by FAISS id, reusing `previous` vectors for unchanged facet texts."""
+    rows = ((doc_id, doc[1]) for doc_id, doc in enumerate(documents) if doc is not None)
+    return FacetIndex.build(facet_texts(original_documents, rows), len(documents),
+                            embed_many=lambda texts: embedding_client().embed_many(texts, progress=True),
+                            dtype=FACET_SEARCH["dtype"], previous=previous)
+
+def build_extras(documents, original_documents, previous_facets=None):
+    """The search structures stored next to the FAISS index."""
+    extras = {'lexical': build_lexical_index(documents, original_documents).to_arrays(),
+              'metadata': build_metadata(documents, original_documents).to_arrays()}
+    facets = build_facet_index(documents, original_documents, previous_facets)
+    if len(facets.doc_ids):
+        extras['facets'] = facets.to_arrays()
+    return extras
 
 def create_and_save_db(json_file, db_file):
-    with open(json_file, "r") as f:
-        documents = json.load(f)
+    documents = load_catalogue(json_file)
 
     overviews = []
     for idx, doc in enumerate(documents):
@@ -57,10 +207,10 @@ def create_and_save_db(json_file, db_file):
             overviews.append((doc['overview'], idx))
 
     print("Generating embeddings...")
+    embeddings = embedding_client().embed_many([overview for overview, _ in overviews], progress=True)
     overview_embeddings = []
     valid_overviews = []
-    for overview, idx in tqdm(overviews):
-        embedding = generate_embeddings(overview)
+    for (overview, idx), embedding in zip(overviews, embeddings):
         if embedding is not None:
             overview_embeddings.append(embedding)
             valid_overviews.append((overview, idx))
@@ -78,62 +228,608 @@ def create_and_save_db(json_file, db_file):
     # Normalize embeddings for cosine similarity
     faiss.normalize_L2(overview_embeddings)
 
-    # Use IndexFlatIP for cosine similarity
-    index = faiss.IndexFlatIP(dim)
+    # Inner product over normalized vectors is cosine similarity
+    index = create_index(overview_embeddings, INDEX["factory"])
     index.add(overview_embeddings)
 
     print(f"Created FAISS index with {index.ntotal} vectors of dimension {dim}")
 
-    with gzip.open(db_file, "wb") as f:
-        pickle.dump({'documents': valid_overviews, 'index': faiss.serialize_index(index)}, f)
+    write_db(db_file, valid_overviews, index, records=documents, extras=build_extras(valid_overviews, documents),
+             vectors=overview_embeddings if INDEX["rescore"] else None)
     print(f"Saved database to {db_file}")
 
+def update_db(json_file, db_file):
+    documents = load_catalogue(json_file)
+
+    entries = [(doc['id'], doc['overview'], idx) for idx, doc in enumerate(documents)
+               if 'overview' in doc and isinstance(doc['overview'], str)]
+    previous_facets = load_facet_index(db_file) if os.path.exists(db_file) else None
+    build_incremental(entries, db_file,
+                      embed_many=lambda texts: embedding_client().embed_many(texts, progress=True),
+                      new_index=lambda vectors: create_index(vectors, INDEX["factory"]),
+                      normalize=True, records=documents,
+                      build_extras=lambda docs: build_extras(docs, documents, previous_facets),
+                      keep_vectors=bool(INDEX["rescore"]))
+
 def load_db(db_file):
-    with gzip.open(db_file, "rb") as f:
-        data = pickle.load(f)
-    index = faiss.deserialize_index(data['index'])
-    return data['documents'], index
+    data = read_db(db_file)
+    return data['documents'], data['index']
 
-def search_movies(query, documents, index, original_documents, top_k=50, min_similarity=0.5):
-    try:
-        query_embedding = generate_embeddings(query)
-        logging.info(f"Generated query embedding with shape: {query_embedding.shape}")
+def load_exact_vectors(db_file, data=None):
+    """The memory-mapped float32 vectors used to rescore a compressed index, or None when rescoring is off."""
+    if not INDEX["rescore"]:
+        return None
+    data = data or read_db(db_file)
+    if data['vectors'] is None:
+        logging.warning(f"{db_file} holds no full-precision vectors; serving without exact rescoring")
+        return None
+    index_mb = faiss.serialize_index(data['index']).size / 2 ** 20
+    logging.info(f"Rescoring {INDEX['rescore']}x candidates: index codes {index_mb:.1f} MB in memory, "
+                 f"exact vectors {data['vectors'].nbytes / 2 ** 20:.1f} MB memory-mapped")
+    return data['vectors']
 
-        if query_embedding.shape[0] != index.d:
-            raise ValueError(f"Query embedding dimension ({query_embedding.shape[0]}) does not match index dimension ({index.d})")
+def connect_shards(db_file, index):
+    """The index to search: the shard servers when SHARDS configures any, otherwise `index` itself."""
+    addresses = [parse_address(address) for address in SHARDS["addresses"]]
+    processes, authkey = [], None  # remote shards authenticate with $SHARD_AUTHKEY, which is required
+    if SHARDS["local"]:
+        addresses, processes, authkey = spawn_local(SHARDS["dir"] or f"{db_file.rstrip(os.sep)}.shards",
+                                                    threads=SHARDS["threads"])
+    if not addresses:
+        return index
+    sharded = ShardedIndex(addresses, authkey, timeout=SHARDS["timeout"], processes=processes)
+    if sharded.ntotal != index.ntotal:
+        # Their FAISS ids would point at the wrong documents; fail the load so the live generation stays
+        sharded.close()
+        raise ValueError(f"Shards hold {sharded.ntotal} vectors but {db_file} has {index.ntotal}; split it again")
+    logging.info(f"Searching {sharded.ntotal} vectors across {len(sharded.clients)} shards")
+    return sharded
 
-        # Normalize query embedding for cosine similarity
-        faiss.normalize_L2(query_embedding.reshape(1, -1))
+def load_lexical_index(db_file, data=None):
+    arrays = (data or read_db(db_file))['extras'].get('lexical')
+    return LexicalIndex.from_arrays(arrays) if arrays is not None else None
 
-        distances, indices = index.search(query_embedding.reshape(1, -1), top_k)
+def build_metadata(documents, original_documents):
+    """Filter columns aligned with the FAISS ids of `documents`."""
+    return MetadataColumns.build([doc[1] if doc is not None else None for doc in documents], original_documents)
 
-        response = []
-        for i, idx in enumerate(indices[0]):
-            if idx < len(documents) and distances[0][i] >= min_similarity:
-                overview_text, original_idx = documents[idx]
-                if original_idx < len(original_documents):
-                    movie = original_documents[original_idx].copy()
-                    movie['searched_overview'] = overview_text
-                    movie['similarity_score'] = float(distances[0][i])
-                    movie = {str(key): (float(value) if isinstance(value, (np.float32, np.float64)) else value) for key, value in movie.items()}
-                    response.append(movie)
-                else:
-                    logging.warning(f"Invalid original_idx: {original_idx}")
-            elif distances[0][i] < min_similarity:
-                logging.info(f"Skipping result due to low similarity: {distances[0][i]}")
+def load_metadata(data, original_documents):
+    """The stored filter columns, or columns built from the records for a DB saved without them."""
+    arrays = data['extras'].get('metadata')
+    if arrays is not None and len(arrays['live']) == len(data['documents']):
+        return MetadataColumns.from_arrays(arrays)
+    logging.info("No metadata columns in the database; building them from the records")
+    return build_metadata(data['documents'], original_documents)
+
+def load_facet_index(db_file, data=None):
+    arrays = (data or read_db(db_file))['extras'].get('facets')
+    return FacetIndex.from_arrays(arrays) if arrays is not None else None
+
+def load_generation(db_file=DB_FILE, json_file=JSON_FILE):
+    """Load everything a search reads from `db_file` as one generation."""
+    data = read_db(db_file)  # the index, stores and extras all come from this one read
+    documents, index = data['documents'], data['index']
+    logging.info(f"Loaded {len(documents)} documents and FAISS index with dimension {index.d}")
+    index = connect_shards(db_file, index)
+
+    original_documents = RecordIndex(load_original_documents(db_file, json_file))
+    logging.info(f"Loaded {len(original_documents)} original documents")
+
+    lexical = load_lexical_index(db_file, data)
+    if lexical is None:
+        logging.info("No lexical index in the database; serving dense search only")
+
+    facets = load_facet_index(db_file, data)
+    if facets is not None:
+        logging.info(f"Loaded annotation facets of {len(facets.doc_ids)} movies ({int(facets.present.sum())} vectors)")
+
+    result_cache = None
+    if RESULT_CACHE["enabled"]:
+        result_cache = SemanticCache(RESULT_CACHE["threshold"], RESULT_CACHE["max_entries"], RESULT_CACHE["ttl"])
+
+    return Generation(documents, index, original_documents, lexical=lexical,
+                      metadata=load_metadata(data, original_documents), facets=facets,
+                      vectors=load_exact_vectors(db_file, data),
+                      release=[index.close] if isinstance(index, ShardedIndex) else [], result_cache=result_cache)
+
+def validate_generation(generation):
+    """Smoke test for a freshly loaded generation: the query must embed, search and return hits."""
+    hits = search_hits(RELOAD["smoke_query"], generation.documents, generation.index, generation.records, top_k=5,
+                       min_similarity=-1.0, lexical=generation.lexical, mode="dense", vectors=generation.vectors)
+    if not hits:
+        raise ValueError(f"Smoke query '{RELOAD['smoke_query']}' returned no hits")
+
+def open_generations(db_file=DB_FILE, json_file=JSON_FILE):
+    """Load the first generation and return the switch that later reloads replace it through."""
+    switch = GenerationSwitch(lambda: load_generation(db_file, json_file), validate_generation,
+                              lambda: db_signature(db_file))
+    switch.reload(force=True, validate=False)
+    if RELOAD["watch"]:
+        switch.watch(RELOAD["interval"])
+    return switch
+
+def load_original_documents(db_file, json_file):
+    records = open_records(db_file)
+    if records is None:
+        records = load_catalogue(json_file)
+    return records
+
+def collect_hits(distances, indices, documents, original_documents, min_similarity):
+    """Turn one row of FAISS results into (record row, searched overview, similarity) hits, best first."""
+    hits = []
+    skipped = missing = 0
+    for i, idx in enumerate(indices):
+        if 0 <= idx < len(documents) and distances[i] >= min_similarity:
+            overview_text, original_idx = documents[idx]
+            if original_idx < len(original_documents):
+                hits.append((original_idx, overview_text, float(distances[i])))
             else:
-                logging.warning(f"Invalid index: {idx}")
+                logging.warning(f"Invalid original_idx: {original_idx}")
+        elif idx < 0:
+            missing += 1  # FAISS pads with -1 when fewer than k ids match (e.g. a narrow filter)
+        elif distances[i] < min_similarity:
+            skipped += 1
+        else:
+            logging.warning(f"Invalid index: {idx}")
+    if skipped:
+        # Counted rather than logged one line per hit; a sample is logged at DEBUG
+        EVENTS.inc("low_similarity_hit", skipped)
+        if sampled(logging.DEBUG, METRICS["log_sample_rate"]):
+            logging.debug(f"Skipped {skipped} results below similarity {min_similarity}")
+    if missing:
+        EVENTS.inc("missing_hit", missing)
+
+    # Sort results by similarity score in descending order
+    hits.sort(key=lambda hit: hit[2], reverse=True)
+    return hits
+
+def query_parameters(index, nprobe=None, ef_search=None, mask=None):
+    """Search parameters for a request; `mask` restricts the search to the FAISS ids it sets."""
+    nprobe = nprobe if nprobe is not None else INDEX["nprobe"]
+    ef_search = ef_search if ef_search is not None else INDEX["efSearch"]
+    if isinstance(index, ShardedIndex):
+        return index.parameters(nprobe, ef_search, mask, FILTERS["max_widening"])
+    return filtered_search_parameters(index, nprobe, ef_search, mask, FILTERS["max_widening"])
+
+def filter_mask(filters, metadata):
+    """Boolean mask over FAISS ids for a request's `filters`, or None when it has none."""
+    if not filters:
+        return None
+    if metadata is None:
+        raise ValueError("Filtering is not available: metadata columns were not loaded")
+    return metadata.mask(filters)
+
+def positive_int(value, name):
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        raise ValueError(f"{name} must be a positive integer, got {value!r}")
+    return value
+
+def search_options(data, top_k=50, min_similarity=0.5):
+    """
+    A request's `top_k`, `min_similarity`, `nprobe` and `efSearch`, defaulted and checked; raises
+    ValueError for a bad value. `nprobe` and `efSearch` are None unless the request sets them.
+    """
+    top_k = positive_int(data.get('top_k', top_k), 'top_k')
+    min_similarity = data.get('min_similarity', min_similarity)
+    if isinstance(min_similarity, bool) or not isinstance(min_similarity, (int, float)):
+        raise ValueError(f"min_similarity must be a number, got {min_similarity!r}")
+    nprobe, ef_search = (positive_int(data[key], key) if data.get(key) is not None else None
+                         for key in ('nprobe', 'efSearch'))
+    return top_k, float(min_similarity), nprobe, ef_search
+
+def lexical_hits(doc_ids, scores, documents, original_documents):
+    hits = []
+    for doc_id, score in zip(doc_ids, scores):
+        doc = documents[doc_id]
+        if doc is not None and doc[1] < len(original_documents):
+            hits.append((doc[1], doc[0], float(score)))
+    return hits
+
+def title_fast_path(query, documents, original_documents, lexical, mask=None):
+    """Hits for a query that is exactly a movie title, or None; needs no embedding round-trip."""
+    if lexical is None or not HYBRID["title_fast_path"]:
+        return None
+    doc_ids = lexical.exact_title(query)
+    if mask is not None:
+        doc_ids = doc_ids[mask[doc_ids]]
+    if len(doc_ids) == 0:
+        return None
+    logging.info(f"Answered '{query}' from {len(doc_ids)} exact title matches")
+    return lexical_hits(doc_ids, np.ones(len(doc_ids)), documents, original_documents)
+
+def lexical_search_hits(query, documents, original_documents, lexical, top_k, mask=None):
+    """BM25-only hits; similarity_score is the BM25 score relative to the best match."""
+    doc_ids, scores = lexical.search(query, top_k, mask)
+    if len(scores):
+        scores = scores / scores[0]
+    return lexical_hits(doc_ids, scores, documents, original_documents)
+
+def dense_search(index, query_vectors, k, params=None, vectors=None):
+    """`index.search`; with exact `vectors`, over-fetch from the compressed codes and rescore the candidates."""
+    if vectors is None or not INDEX["rescore"]:
+        return index.search(query_vectors, k, params=params)
+    _, indices = index.search(query_vectors, k * INDEX["rescore"], params=params)
+    return rescore(vectors, query_vectors, indices, k)
+
+def score_ids(index, query_vector, ids, ef_search=None, vectors=None):
+    """Cosine of a normalized query against the given FAISS ids, from a search restricted to them."""
+    if not len(ids):
+        return {}
+    ids = np.asarray(ids, dtype=np.int64)
+    if vectors is not None:
+        return dict(zip(ids.tolist(), exact_scores(vectors, query_vector, ids).tolist()))
+    if isinstance(index, ShardedIndex):
+        return index.score_ids(query_vector, ids, ef_search)
+    return restricted_search(index, query_vector, ids, ef_search)
+
+def facet_extraction_payload(query):
+    """The generate request asking the LLM for the annotation facets a free-text query is after."""
+    return {
+        "model": MODELS["query_generation"],
+        "prompt": "\n\nUser Input: '" + query + "'",
+        "system": FEATURE_INSTRUCTION,
+        "options": {"temperature": 0.2},
+        "stream": False
+    }
+
+def extract_query_facets(query):
+    """Ask the LLM for the annotation facets a free-text query is after."""
+    with span("facet_extract"):
+        response = requests.post(API_URLS["generate"], json=facet_extraction_payload(query), timeout=(5, 60))
+    UPSTREAM_TTFB_SECONDS.observe("facet_extract", response.elapsed.total_seconds())
+    response.raise_for_status()
+    return parse_facets(response.json().get('response', ''))
+
+def facet_weights(query_facets):
+    weights = {key: FACET_SEARCH["weights"].get(key, 0.0) for key in query_facets}
+    if not any(weights.values()):
+        raise ValueError("No annotation facets could be derived from the query")
+    logging.info(f"Searching facets {', '.join(key for key in FACET_KEYS if key in query_facets)}")
+    return weights
+
+def facet_search_hits(query, documents, index, original_documents, facets, top_k=50, min_similarity=0.5,
+                      ef_search=None, mask=None, vectors=None):
+    """
+    Rank movies by annotation facets: one query per facet, weighted, plus the query against the overview.
+
+    A query written as facet lines ("- Mood: ...") is used as is; otherwise the LLM extracts them.
+    """
+    query_facets = parse_facets(query) or extract_query_facets(query)
+    weights = facet_weights(query_facets)
+    embeddings = embed_queries([query_facets[key] for key in query_facets] + [query])
+    if any(embedding is None for embedding in embeddings):
+        raise ValueError("Failed to generate query embedding")
+    return rank_facet_hits(query_facets, weights, embeddings, documents, index, original_documents, facets, top_k,
+                           min_similarity, ef_search, mask, vectors)
+
+def rank_facet_hits(query_facets, weights, embeddings, documents, index, original_documents, facets, top_k=50,
+                    min_similarity=0.5, ef_search=None, mask=None, vectors=None):
+    """The CPU part of a facet search: `embeddings` are the facet texts' in `query_facets` order, then the query's."""
+    facet_vectors = dict(zip(query_facets, embeddings))
+    with span("facet_search"):
+        doc_ids, facet_scores = facets.search(facet_vectors, weights, max(top_k, FACET_SEARCH["candidates"]), mask)
+
+    query_vector = embeddings[-1].reshape(1, -1).astype(np.float32)
+    faiss.normalize_L2(query_vector)
+    overview_scores = score_ids(index, query_vector, doc_ids, ef_search, vectors)
+    facet_weight = sum(weights.values())
+    overview_weight = FACET_SEARCH["overview_weight"]
+
+    hits = []
+    for doc_id, facet_score in zip(doc_ids, facet_scores):
+        score = (facet_weight * float(facet_score) + overview_weight * overview_scores.get(int(doc_id), 0.0)) \
+            / (facet_weight + overview_weight)
+        doc = documents[doc_id]
+        if score >= min_similarity and doc is not None and doc[1] < len(original_documents):
+            hits.append((doc[1], doc[0], score))
+    hits.sort(key=lambda hit: hit[2], reverse=True)
+    return hits[:top_k]
 
-        # Sort results by similarity score in descending order
-        response.sort(key=lambda x: x['similarity_score'], reverse=True)
+def rank_hits(query, query_embedding, documents, index, original_documents, top_k=50, min_similarity=0.5,
+              nprobe=None, ef_search=None, lexical=None, mode="hybrid", mask=None, vectors=None):
+    """
+    Rank hits for an already embedded query, among the FAISS ids set in `mask` if given.
 
+    In hybrid mode, dense and BM25 candidates are fused with reciprocal rank fusion.
+    Lexical-only candidates get their cosine from a search restricted to their ids, and
+    BM25 matches are kept even below `min_similarity`.
+    """
+    if query_embedding.shape[0] != index.d:
+        raise ValueError(f"Query embedding dimension ({query_embedding.shape[0]}) does not match index dimension ({index.d})")
+
+    # Normalize query embedding for cosine similarity
+    with span("normalize"):
+        query_vector = query_embedding.reshape(1, -1)
+        faiss.normalize_L2(query_vector)
+
+    if lexical is None or mode == "dense":
+        with span("index_search"):
+            distances, indices = dense_search(index, query_vector, top_k,
+                                              query_parameters(index, nprobe, ef_search, mask), vectors)
+        with span("collect_hits"):
+            return collect_hits(distances[0], indices[0], documents, original_documents, min_similarity)
+
+    n_candidates = max(top_k, HYBRID["lexical_candidates"])
+    with span("index_search"):
+        distances, indices = dense_search(index, query_vector, n_candidates,
+                                          query_parameters(index, nprobe, ef_search, mask), vectors)
+    dense = {int(idx): float(distance) for idx, distance in zip(indices[0], distances[0]) if idx >= 0}
+    with span("lexical_search"):
+        lexical_ids, _ = lexical.search(query, HYBRID["lexical_candidates"], mask)
+
+    with span("score_ids"):
+        dense.update(score_ids(index, query_vector, [doc_id for doc_id in lexical_ids if doc_id not in dense],
+                               ef_search, vectors))
+
+    lexical_set = set(int(doc_id) for doc_id in lexical_ids)
+    dense_ranking = [idx for idx, _ in sorted(dense.items(), key=lambda item: item[1], reverse=True)]
+    hits = []
+    with span("fuse"):
+        for doc_id, _ in reciprocal_rank_fusion([dense_ranking, lexical_ids], HYBRID["rrf_k"]):
+            if doc_id not in dense or (dense[doc_id] < min_similarity and doc_id not in lexical_set):
+                continue
+            doc = documents[doc_id] if doc_id < len(documents) else None
+            if doc is None or doc[1] >= len(original_documents):
+                continue
+            hits.append((doc[1], doc[0], dense[doc_id]))
+            if len(hits) == top_k:
+                break
+    return hits
+
+def rerank_hits(query, hits, original_documents):
+    """Reorder the leading hits by LLM relevance, keeping retrieval order on ties, failures and timeouts."""
+    head, tail = hits[:RERANK["candidates"]], hits[RERANK["candidates"]:]
+    if len(head) < 2:
+        return hits
+    movies = [original_documents[row] for row, _, _ in head]
+    candidates = [(movie.get('id', row), movie.get('title', ''), overview)
+                  for movie, (row, overview, _) in zip(movies, head)]
+    with span("rerank"):
+        scores = reranker.scores(query, candidates)
+    if scores is None:
+        return hits
+    order = sorted(range(len(head)), key=lambda i: -scores[i])
+    return [head[i] for i in order] + tail
+
+def result_signature(mode, top_k, min_similarity, nprobe, ef_search, mask, rerank):
+    """The search parameters two queries must share to share cached results."""
+    return mode, top_k, min_similarity, nprobe, ef_search, mask_digest(mask), bool(rerank)
+
+def search_hits(query, documents, index, original_documents, top_k=50, min_similarity=0.5, nprobe=None, ef_search=None,
+                lexical=None, mode="hybrid", mask=None, rerank=False, facets=None, vectors=None, result_cache=None):
+    """
+    Return (record row, searched overview, similarity) for each hit of `query`, best first.
+
+    With a `result_cache`, a query embedding close enough to a recently answered one gets
+    that query's hits instead of a new retrieval and re-rank.
+    """
+    if mode not in SEARCH_MODES:
+        raise ValueError(f"Unknown search mode '{mode}', expected one of {', '.join(SEARCH_MODES)}")
+    if mode == "facets":
+        if facets is None:
+            raise ValueError("Facet search is not available: the database has no annotation facets")
+        hits = facet_search_hits(query, documents, index, original_documents, facets, top_k, min_similarity,
+                                 ef_search, mask, vectors)
+        return rerank_hits(query, hits, original_documents) if rerank else hits
+    if mode != "dense":
+        hits = title_fast_path(query, documents, original_documents, lexical, mask)
+        if hits:
+            return hits[:top_k]
+        if mode == "lexical" and lexical is not None:
+            hits = lexical_search_hits(query, documents, original_documents, lexical, top_k, mask)
+            return rerank_hits(query, hits, original_documents) if rerank else hits
+
+    query_embedding = embed_query(query)
+    if query_embedding is None:
+        raise ValueError("Failed to generate query embedding")
+    logging.debug(f"Generated query embedding with shape: {query_embedding.shape}")
+
+    signature = None
+    if result_cache is not None:
+        signature = result_signature(mode, top_k, min_similarity, nprobe, ef_search, mask, rerank)
+        with span("result_cache"):
+            hits = result_cache.get(query_embedding, signature)
+        if hits is not None:
+            return hits
+
+    hits = rank_hits(query, query_embedding, documents, index, original_documents, top_k, min_similarity,
+                     nprobe, ef_search, lexical, mode, mask, vectors)
+    ranked = rerank_hits(query, hits, original_documents) if rerank else hits
+    if result_cache is not None and (ranked is not hits or not rerank):
+        result_cache.put(query_embedding, signature, ranked)  # a re-rank that fell back is not cached
+    return ranked
+
+def search_movies(query, documents, index, original_documents, top_k=50, min_similarity=0.5, nprobe=None, ef_search=None,
+                  lexical=None, mode="hybrid", mask=None, rerank=False, facets=None, vectors=None, result_cache=None):
+    try:
+        hits = search_hits(query, documents, index, original_documents, top_k, min_similarity, nprobe, ef_search,
+                           lexical, mode, mask, rerank, facets, vectors, result_cache)
+        with span("serialize"):
+            response = []
+            for original_idx, overview_text, score in hits:
+                movie = dict(original_documents[original_idx])
+                movie['searched_overview'] = overview_text
+                movie['similarity_score'] = score
+                response.append(movie)
         return response
     except Exception as e:
         logging.error(f"Error in search_movies: {str(e)}", exc_info=True)
         raise
 
+def search_movies_json(query, documents, index, records, top_k=50, min_similarity=0.5, nprobe=None, ef_search=None,
+                       lexical=None, mode="hybrid", mask=None, rerank=False, facets=None, vectors=None,
+                       result_cache=None):
+    """Like `search_movies`, but returns the response body as JSON bytes built from pre-serialized records."""
+    try:
+        hits = search_hits(query, documents, index, records, top_k, min_similarity, nprobe, ef_search, lexical, mode,
+                           mask, rerank, facets, vectors, result_cache)
+        with span("serialize"):
+            return json_array(records.hit_payload(*hit) for hit in hits), len(hits)
+    except Exception as e:
+        logging.error(f"Error in search_movies_json: {str(e)}", exc_info=True)
+        raise
+
+def sse_event(event, data):
+    """One server-sent event; `data` is JSON bytes or anything json.dumps accepts."""
+    if not isinstance(data, bytes):
+        data = json.dumps(data).encode('utf-8')
+    return b"event: " + event.encode('ascii') + b"\ndata: " + data + b"\n\n"
+
+def stream_search_events(query, generation, top_k=50, min_similarity=0.5, nprobe=None, ef_search=None, mode="hybrid",
+                         mask=None, rerank=False):
+    """
+    SSE frames of a search: `results` events as soon as the hits are ranked, the first one
+    small, then `reorder` once the LLM re-rank is back, and `done` with the timings.
+    """
+    start = time.perf_counter()
+    try:
+        hits = search_hits(query, generation.documents, generation.index, generation.records, top_k, min_similarity,
+                           nprobe, ef_search, generation.lexical, mode, mask, facets=generation.facets,
+                           vectors=generation.vectors, result_cache=generation.result_cache)
+    except Exception as e:
+        logging.error(f"Error in streamed search: {str(e)}", exc_info=True)
+        yield sse_event("error", {'error': str(e)})
+        return
+    ranked = time.perf_counter()
+    STAGE_SECONDS.observe("stream_first_results", ranked - start)
+    yield from result_events(hits, generation.records)
+    if rerank and hits:
+        reorder = reorder_event(hits, rerank_hits(query, hits, generation.records))
+        if reorder is not None:
+            yield reorder
+    yield done_event(len(hits), start, ranked)
+
+def result_events(hits, records):
+    """`results` frames for ranked hits: a small first batch, so the client can render it early, then full ones."""
+    offset = 0
+    while offset < len(hits):
+        batch = hits[offset:offset + (STREAM["first_batch"] if offset == 0 else STREAM["batch_size"])]
+        results = json_array(records.hit_payload(*hit) for hit in batch)
+        yield sse_event("results", b'{"offset":' + str(offset).encode('ascii') + b',"results":' + results + b'}')
+        offset += len(batch)
+
+def reorder_event(hits, reranked):
+    """The `reorder` frame moving streamed `hits` into re-ranked order, or None if the re-rank changed nothing."""
+    if reranked is hits:
+        return None
+    positions = {hit[0]: i for i, hit in enumerate(hits)}
+    return sse_event("reorder", {'order': [positions[hit[0]] for hit in reranked]})
+
+def done_event(count, start, ranked):
+    total = time.perf_counter() - start
+    REQUEST_SECONDS.observe("search_stream", total)
+    return sse_event("done", {'count': count, 'ranked_ms': round((ranked - start) * 1000, 1),
+                              'total_ms': round(total * 1000, 1)})
+
+def rag_prefix(messages):
+    """Instructions and the conversation before the latest message: the part of a RAG prompt that repeats."""
+    return [{"role": "system", "content": RAG["system_prompt"]}] + list(messages[:-1])
+
+def rag_messages(messages, hits, records):
+    """
+    Chat messages for a RAG turn. The retrieved movies go after the history, right before
+    the latest message, so the prefix the model has already prefilled stays unchanged.
+    """
+    lines = []
+    for i, (row, overview, _) in enumerate(hits, start=1):
+        movie = records[row]
+        year = str(movie.get('release_date') or '')[:4] or "unknown year"
+        lines.append(f"{i}. {movie.get('title', '')} ({year}): {overview[:RAG['overview_chars']]}")
+    context = "Movies retrieved for the latest message:\n" + ("\n".join(lines) if lines else "(none)")
+    return rag_prefix(messages) + [{"role": "system", "content": context}, messages[-1]]
+
+def warm_chat_prefix(messages):
+    """Have the chat model load and prefill `messages` while retrieval runs; the real request then reuses that prefix."""
+    payload = {"model": MODELS["chat"], "messages": messages, "stream": False, "options": {"num_predict": 1}}
+    try:
+        requests.post(API_URLS["chat"], json=payload, timeout=(5, 120))
+    except requests.RequestException as e:
+        logging.warning(f"Chat prefix warm-up failed: {str(e)}")
+
+def embed_queries(queries, model=MODELS["embedding"]):
+    """Embed several queries, serving repeats from the cache and fetching the rest concurrently."""
+    with span("embed"):
+        return _embed_queries(queries, model)
+
+def _embed_queries(queries, model):
+    embeddings = [query_cache.get(model, query) for query in queries]
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if missing and model == MODELS["embedding"]:
+        futures = [(i, embedding_batcher().submit(queries[i])) for i in missing]
+        for i, future in futures:
+            try:
+                embedding = future.result()
+                if embedding is not None:
+                    embeddings[i] = embedding.copy()
+                    query_cache.put(model, queries[i], embedding)
+            except Exception as e:
+                logging.error(f"Error embedding batch query {i}: {str(e)}")
+    elif missing:
+        fetched = embedding_client(model).embed_many([queries[i] for i in missing])
+        for i, embedding in zip(missing, fetched):
+            if embedding is not None:
+                query_cache.put(model, queries[i], embedding)
+            embeddings[i] = embedding
+    return embeddings
+
+def search_batch_hits(queries, documents, index, original_documents, nprobe=None, ef_search=None, mask=None,
+                      vectors=None):
+    """
+    Run several searches with a single `index.search` over the stacked N x d query matrix.
+
+    `queries` holds dicts with a 'query' and optional 'top_k' / 'min_similarity'. Yields
+    (position, hits or None, error or None) in input order; the embedding and search run
+    before the first item is produced. `mask` filters every query of the batch alike.
+    """
+    embeddings = embed_queries([q['query'] for q in queries])
+    valid = [i for i, embedding in enumerate(embeddings) if embedding is not None and embedding.shape[0] == index.d]
+    distances = indices = None
+    if valid:
+        with span("normalize"):
+            matrix = np.vstack([embeddings[i] for i in valid]).astype(np.float32)
+            faiss.normalize_L2(matrix)
+        k = max(queries[i].get('top_k', 50) for i in valid)
+        with span("index_search"):
+            distances, indices = dense_search(index, matrix, k, query_parameters(index, nprobe, ef_search, mask),
+                                              vectors)
+
+    rows = {i: row for row, i in enumerate(valid)}
+
+    def results():
+        for i, q in enumerate(queries):
+            if i not in rows:
+                error = "Failed to generate query embedding" if embeddings[i] is None else \
+                    f"Query embedding dimension ({embeddings[i].shape[0]}) does not match index dimension ({index.d})"
+                yield i, None, error
+                continue
+            top_k = q.get('top_k', 50)
+            row = rows[i]
+            hits = collect_hits(distances[row][:top_k], indices[row][:top_k], documents, original_documents,
+                                q.get('min_similarity', 0.5))
+            yield i, hits, None
+
+    return results()
+
+def search_movies_batch(queries, documents, index, original_documents, nprobe=None, ef_search=None, vectors=None):
+    """Batched counterpart of `search_movies`; returns one result list (or error dict) per query."""
+    results = []
+    for _, hits, error in search_batch_hits(queries, documents, index, original_documents, nprobe, ef_search,
+                                            vectors=vectors):
+        if error is not None:
+            results.append({'error': error})
+            continue
+        response = []
+        for original_idx, overview_text, score in hits:
+            movie = dict(original_documents[original_idx])
+            movie['searched_overview'] = overview_text
+            movie['similarity_score'] = score
+            response.append(movie)
+        results.append(response)
+    return results
+
 @app.route('/completion', methods=['POST'])
 def completion():
+    start = time.perf_counter()
     try:
         data = request.json
         prompt = data.get('prompt')
@@ -151,7 +847,9 @@ def completion():
             "stream": False
         }
 
-        response = requests.post(API_URLS["generate"], json=payload)
+        with span("generate"):
+            response = requests.post(API_URLS["generate"], json=payload)
+        UPSTREAM_TTFB_SECONDS.observe("generate", response.elapsed.total_seconds())
         response.raise_for_status()
         result = response.json()
 
@@ -162,9 +860,12 @@ def completion():
     except Exception as e:
         logging.error(f"Error in completion endpoint: {str(e)}", exc_info=True)
         return jsonify({'error': str(e)}), 500
+    finally:
+        REQUEST_SECONDS.observe("completion", time.perf_counter() - start)
 
 @app.route('/chat', methods=['POST'])
 def chat():
+    start = time.perf_counter()
     try:
         data = request.json
         messages = data.get('messages', [])
@@ -172,6 +873,32 @@ def chat():
         if not messages:
             return jsonify({'error': 'No messages provided'}), 400
 
+        context = None
+        if data.get('rag'):
+            # Answer from retrieved movies; the chat model prefills the conversation while we search
+            generation = generations.current
+            mode = data.get('mode', 'hybrid')
+            if mode not in SEARCH_MODES:
+                return jsonify({'error': f"Unknown search mode '{mode}'"}), 400
+            if mode == "facets" and generation.facets is None:
+                return jsonify({'error': "Facet search is not available: the database has no annotation facets"}), 400
+            try:
+                top_k, min_similarity, nprobe, ef_search = search_options(data, RAG["top_k"], RAG["min_similarity"])
+                mask = filter_mask(data.get('filters'), generation.metadata)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            if RAG["warm_prefix"]:
+                threading.Thread(target=warm_chat_prefix, args=(rag_prefix(messages),), daemon=True).start()
+            query = data.get('query') or messages[-1].get('content', '')
+            with span("rag_retrieve"):
+                hits = search_hits(query, generation.documents, generation.index, generation.records, top_k,
+                                   min_similarity, nprobe, ef_search, lexical=generation.lexical, mode=mode, mask=mask,
+                                   facets=generation.facets, vectors=generation.vectors,
+                                   result_cache=generation.result_cache)
+            logging.info(f"Retrieved {len(hits)} movies as chat context for '{query}'")
+            context = json_array(generation.records.hit_payload(*hit) for hit in hits)
+            messages = rag_messages(messages, hits, generation.records)
+
         payload = {
             "model": MODELS["chat"],
             "messages": messages,
@@ -179,13 +906,25 @@ def chat():
         }
 
         response = requests.post(API_URLS["chat"], json=payload, stream=True)
+        UPSTREAM_TTFB_SECONDS.observe("chat", response.elapsed.total_seconds())
         response.raise_for_status()
 
         def generate():
+            if context is not None:
+                yield sse_event("movies", context)
+            first = True
+            lines = 0
             for line in response.iter_lines():
                 if line:
-                    yield f"data: {line.decode('utf-8')}\n\n"
-                    logging.info(f"data: {line.decode('utf-8')}\n\n")
+                    if first:
+                        STAGE_SECONDS.observe("chat_first_token", time.perf_counter() - start)
+                        first = False
+                    lines += 1
+                    yield b"data: " + line + b"\n\n"
+                    if sampled(logging.DEBUG, METRICS["log_sample_rate"]):
+                        logging.debug(f"data: {line.decode('utf-8')}")
+            EVENTS.inc("chat_line", lines)
+            REQUEST_SECONDS.observe("chat", time.perf_counter() - start)
 
         return Response(generate(), mimetype='text/event-stream')
     except Exception as e:
@@ -194,6 +933,7 @@ def chat():
 
 @app.route('/search', methods=['POST'])
 def search():
+    start = time.perf_counter()
     try:
         data = request.json
         if not data or 'query' not in data:
@@ -202,28 +942,137 @@ def search():
         query = data['query']
         logging.info(f"Received search query: {query}")
 
-        response = search_movies(query, documents, index, original_documents)
+        mode = data.get('mode', 'hybrid')
+        if mode not in SEARCH_MODES:
+            return jsonify({'error': f"Unknown search mode '{mode}'"}), 400
+
+        generation = generations.current  # held for the whole request, even if a reload swaps it meanwhile
+        try:
+            top_k, min_similarity, nprobe, ef_search = search_options(data)
+            mask = filter_mask(data.get('filters'), generation.metadata)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
 
-        logging.info(f"Search completed. Found {len(response)} results.")
+        body, count = search_movies_json(query, generation.documents, generation.index, generation.records, top_k,
+                                         min_similarity, nprobe=nprobe, ef_search=ef_search,
+                                         lexical=generation.lexical, mode=mode, mask=mask,
+                                         rerank=data.get('rerank', RERANK["default"]), facets=generation.facets,
+                                         vectors=generation.vectors, result_cache=generation.result_cache)
 
-        return jsonify(response)
+        logging.info(f"Search completed. Found {count} results.")
+
+        return Response(body, mimetype='application/json')
     except Exception as e:
         logging.error(f"Error in search endpoint: {str(e)}", exc_info=True)
         return jsonify({'error': str(e)}), 500
+    finally:
+        REQUEST_SECONDS.observe("search", time.perf_counter() - start)
+
+@app.route('/search/stream', methods=['POST'])
+def search_stream():
+    try:
+        data = request.json
+        if not data or 'query' not in data:
+            return jsonify({'error': 'No query provided'}), 400
+        if data.get('mode', 'hybrid') not in SEARCH_MODES:
+            return jsonify({'error': f"Unknown search mode '{data['mode']}'"}), 400
+
+        generation = generations.current
+        try:
+            top_k, min_similarity, nprobe, ef_search = search_options(data)
+            mask = filter_mask(data.get('filters'), generation.metadata)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        logging.info(f"Received streamed search query: {data['query']}")
+        events = stream_search_events(data['query'], generation, top_k, min_similarity, nprobe, ef_search,
+                                      data.get('mode', 'hybrid'), mask,
+                                      data.get('rerank', RERANK["default"]))
+        return Response(stream_with_context(events), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    except Exception as e:
+        logging.error(f"Error in search stream endpoint: {str(e)}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/search/batch', methods=['POST'])
+def search_batch():
+    start = time.perf_counter()
+    try:
+        data = request.json
+        queries = data.get('queries') if data else None
+        if not queries or not all(isinstance(q, dict) and q.get('query') for q in queries):
+            return jsonify({'error': 'Provide a non-empty "queries" list of {"query", "top_k", "min_similarity"} objects'}), 400
+        if data.get('mode', 'dense') != 'dense':
+            # One stacked index.search serves the whole batch, so only dense retrieval is supported
+            return jsonify({'error': f"Batch search only supports mode 'dense', got '{data['mode']}'"}), 400
+
+        generation = generations.current
+        try:
+            for q in queries:
+                search_options(q)
+            _, _, nprobe, ef_search = search_options(data)
+            mask = filter_mask(data.get('filters'), generation.metadata)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        logging.info(f"Received batch of {len(queries)} search queries")
+        results = search_batch_hits(queries, generation.documents, generation.index, generation.records,
+                                    nprobe=nprobe, ef_search=ef_search, mask=mask,
+                                    vectors=generation.vectors)
+
+        def generate():
+            # One NDJSON line per query, in request order
+            for i, hits, error in results:
+                head = json.dumps({'index': i, 'query': queries[i]['query']})[:-1].encode('utf-8')
+                if error is not None:
+                    yield head + b',"error":' + json.dumps(error).encode('utf-8') + b'}\n'
+                else:
+                    yield head + b',"results":' + json_array(generation.records.hit_payload(*hit) for hit in hits) + b'}\n'
+            REQUEST_SECONDS.observe("search_batch", time.perf_counter() - start)
+
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    except Exception as e:
+        logging.error(f"Error in search batch endpoint: {str(e)}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify({
+        "query_embeddings": query_cache.stats(),
+        "embedding_client": embedding_client().stats(),
+        "embedding_batcher": embedding_batcher().stats(),
+        "reranker": reranker.stats(),
+        "results": generations.current.result_cache.stats() if generations.current.result_cache is not None else None,
+        "shards": generations.current.index.stats() if isinstance(generations.current.index, ShardedIndex) else None,
+        "generations": generations.stats()
+    })
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+@app.route('/admin/reload', methods=['POST'])
+def admin_reload():
+    try:
+        if RELOAD["token"] and request.headers.get('X-Admin-Token') != RELOAD["token"]:
+            return jsonify({'error': 'Invalid admin token'}), 403
+        data = request.get_json(silent=True) or {}
+        return jsonify(generations.reload(force=data.get('force', False)))
+    except Exception as e:
+        logging.error(f"Error in admin reload endpoint: {str(e)}", exc_info=True)
+        return jsonify({'error': str(e), **generations.stats()}), 500
 
 if __name__ == "__main__":
     create_new_db = False  # Set this to True to recreate the database
+    update_existing_db = False  # Set this to True to embed only new or changed movies
 
     if create_new_db:
         create_and_save_db(JSON_FILE, DB_FILE)
+    elif update_existing_db:
+        update_db(JSON_FILE, DB_FILE)
 
     try:
-        documents, index = load_db(DB_FILE)
-        logging.info(f"Loaded {len(documents)} documents and FAISS index with dimension {index.d}")
-
-        with open(JSON_FILE, "r") as f:
-            original_documents = json.load(f)
-        logging.info(f"Loaded {len(original_documents)} original documents")
+        generations = open_generations(DB_FILE, JSON_FILE)
     except Exception as e:
         logging.error(f"Error loading database: {str(e)}", exc_info=True)
         raise